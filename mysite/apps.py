@@ -0,0 +1,10 @@
+from django.apps import AppConfig
+
+
+class MysiteConfig(AppConfig):
+    name = 'mysite'
+
+    def ready(self):
+        from django.db.backends.signals import connection_created
+        from .sqlite import configure_connection
+        connection_created.connect(configure_connection, dispatch_uid='mysite.sqlite')
@@ -3,6 +3,11 @@ ASGI config for mysite project.
 
 It exposes the ASGI callable as a module-level variable named ``application``.
 
+Deploy with an ASGI server (e.g. ``uvicorn mysite.asgi:application``) to serve
+the live results stream (polls:results_stream), which keeps connections open.
+Set POLLS_ASYNC_VIEWS=1 to serve the other polls pages with the native async
+views as well.
+
 For more information on this file, see
 https://docs.djangoproject.com/en/4.0/howto/deployment/asgi/
 """
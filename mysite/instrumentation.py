@@ -0,0 +1,235 @@
+"""
+Per-request performance instrumentation.
+
+PerformanceMiddleware measures for every request
+    - the number of SQL queries and the time spent in the database (execute wrapper)
+    - the time spent rendering templates (InstrumentedDjangoTemplates backend)
+    - the total time spent in the view/middleware stack below it
+and reports them in a Server-Timing header and as a log line on the 'mysite.perf'
+logger, tagged with the resolved URL name (e.g. polls:index).
+Request durations are kept per URL name in a rolling window, perf_stats returns
+p50/p95/p99 of those as JSON, together with the counters of the callables
+listed in PERF_STATS_PROVIDERS.
+"""
+
+import contextvars
+import logging
+import threading
+import time
+from collections import deque
+from contextlib import ExitStack
+
+from asgiref.sync import iscoroutinefunction, markcoroutinefunction, sync_to_async
+from django.conf import settings
+from django.db import connections
+from django.http import HttpResponseForbidden, JsonResponse
+from django.template.backends.django import DjangoTemplates
+from django.utils.module_loading import import_string
+
+logger = logging.getLogger('mysite.perf')
+
+_current = contextvars.ContextVar('perf_request_metrics', default=None)
+
+
+class RequestMetrics:
+    __slots__ = ('queries', 'db_time', 'template_time')
+
+    def __init__(self):
+        self.queries = 0
+        self.db_time = 0.0
+        self.template_time = 0.0
+
+    def __call__(self, execute, sql, params, many, context):
+        #execute wrapper, installed on every database connection during the request
+        start = time.perf_counter()
+        try:
+            return execute(sql, params, many, context)
+        finally:
+            self.db_time += time.perf_counter() - start
+            self.queries += 1
+
+
+class EndpointStats:
+    """
+    Rolling window of request durations (ms) and query counts for one endpoint
+    """
+
+    def __init__(self, window):
+        self.durations = deque(maxlen=window)
+        self.queries = deque(maxlen=window)
+        self.count = 0
+
+    def add(self, duration, queries):
+        self.durations.append(duration)
+        self.queries.append(queries)
+        self.count += 1
+
+    def summary(self):
+        durations = sorted(self.durations)
+        samples = len(durations)
+        if not samples:
+            return {'count': self.count, 'samples': 0}
+
+        def percentile(p):
+            return durations[min(samples - 1, int(p / 100 * samples))]
+
+        return {
+            'count': self.count,
+            'samples': samples,
+            'mean_ms': round(sum(durations) / samples, 3),
+            'p50_ms': round(percentile(50), 3),
+            'p95_ms': round(percentile(95), 3),
+            'p99_ms': round(percentile(99), 3),
+            'max_ms': round(durations[-1], 3),
+            'queries_mean': round(sum(self.queries) / samples, 2),
+        }
+
+
+class PerformanceStats:
+
+    def __init__(self, window=1000):
+        self.window = window
+        self._endpoints = {}
+        self._lock = threading.Lock()
+
+    def record(self, endpoint, duration, queries):
+        stats = self._endpoints.get(endpoint)
+        if stats is None:
+            with self._lock:
+                stats = self._endpoints.setdefault(endpoint, EndpointStats(self.window))
+        stats.add(duration, queries)
+
+    def summary(self):
+        with self._lock:
+            endpoints = list(self._endpoints.items())
+        return {name: stats.summary() for name, stats in sorted(endpoints)}
+
+    def reset(self):
+        with self._lock:
+            self._endpoints.clear()
+
+
+stats = PerformanceStats(getattr(settings, 'PERF_STATS_WINDOW', 1000))
+
+
+def endpoint_name(request):
+    match = getattr(request, 'resolver_match', None)
+    return match.view_name if match is not None else 'unresolved'
+
+
+class PerformanceMiddleware:
+    #works in both sync and async stacks, so it doesn't force async views into threads
+    sync_capable = True
+    async_capable = True
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+        if iscoroutinefunction(get_response):
+            markcoroutinefunction(self)
+
+    def __call__(self, request):
+        if iscoroutinefunction(self):
+            return self.__acall__(request)
+        metrics = RequestMetrics()
+        token = _current.set(metrics)
+        start = time.perf_counter()
+        try:
+            with self.instrument(metrics):
+                response = self.get_response(request)
+        finally:
+            _current.reset(token)
+        total = (time.perf_counter() - start) * 1000
+        self.report(request, response, metrics, total)
+        return response
+
+    async def __acall__(self, request):
+        metrics = RequestMetrics()
+        token = _current.set(metrics)
+        start = time.perf_counter()
+        #database connections are per thread, the async ORM runs its queries in the
+        #thread of sync_to_async, so the wrappers are installed there
+        stack = await sync_to_async(self.instrument)(metrics)
+        try:
+            response = await self.get_response(request)
+        finally:
+            await sync_to_async(stack.close)()
+            _current.reset(token)
+        total = (time.perf_counter() - start) * 1000
+        self.report(request, response, metrics, total)
+        return response
+
+    def instrument(self, metrics):
+        stack = ExitStack()
+        for alias in connections:
+            stack.enter_context(connections[alias].execute_wrapper(metrics))
+        return stack
+
+    def report(self, request, response, metrics, total):
+        db_ms = metrics.db_time * 1000
+        template_ms = metrics.template_time * 1000
+        endpoint = endpoint_name(request)
+        timing = (
+            f'db;dur={db_ms:.2f};desc="{metrics.queries} queries", '
+            f'tpl;dur={template_ms:.2f}, total;dur={total:.2f}'
+        )
+        if response.has_header('Server-Timing'):
+            timing = f"{response['Server-Timing']}, {timing}"
+        response['Server-Timing'] = timing
+        stats.record(endpoint, total, metrics.queries)
+        if logger.isEnabledFor(logging.INFO):
+            logger.info(
+                'endpoint=%s method=%s status=%s total_ms=%.2f db_ms=%.2f queries=%d tpl_ms=%.2f',
+                endpoint, request.method, response.status_code, total, db_ms, metrics.queries, template_ms,
+                extra={
+                    'endpoint': endpoint,
+                    'status': response.status_code,
+                    'total_ms': total,
+                    'db_ms': db_ms,
+                    'queries': metrics.queries,
+                    'template_ms': template_ms,
+                },
+            )
+
+
+#template backend that adds the render time to the current request's metrics
+class InstrumentedDjangoTemplates(DjangoTemplates):
+
+    def from_string(self, template_code):
+        return InstrumentedTemplate(super().from_string(template_code))
+
+    def get_template(self, template_name):
+        return InstrumentedTemplate(super().get_template(template_name))
+
+
+class InstrumentedTemplate:
+
+    def __init__(self, template):
+        self.template = template
+
+    def __getattr__(self, name):
+        return getattr(self.template, name)
+
+    def render(self, context=None, request=None):
+        metrics = _current.get()
+        if metrics is None:
+            return self.template.render(context, request)
+        start = time.perf_counter()
+        try:
+            return self.template.render(context, request)
+        finally:
+            metrics.template_time += time.perf_counter() - start
+
+
+#stats endpoint
+"""
+Only available for staff users and requests from PERF_STATS_ALLOWED_IPS (empty by default).
+"""
+def perf_stats(request):
+    user = getattr(request, 'user', None)
+    is_staff = user is not None and user.is_active and user.is_staff
+    if not is_staff and request.META.get('REMOTE_ADDR') not in getattr(settings, 'PERF_STATS_ALLOWED_IPS', []):
+        return HttpResponseForbidden()
+    data = {'endpoints': stats.summary()}
+    for name, provider in getattr(settings, 'PERF_STATS_PROVIDERS', {}).items():
+        data[name] = import_string(provider)()
+    return JsonResponse(data)
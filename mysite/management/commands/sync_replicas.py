@@ -0,0 +1,32 @@
+# Copy the primary sqlite database to the read replicas, see mysite/routers.py
+
+import time
+
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+
+from mysite.sqlite import copy_database
+
+
+class Command(BaseCommand):
+    help = 'Copy the primary database to every replica of DATABASE_REPLICAS (sqlite replication stand-in)'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--interval', type=float, default=0,
+                            help='Keep copying every INTERVAL seconds (0 => copy once)')
+
+    def handle(self, *args, **options):
+        aliases = settings.DATABASE_REPLICAS
+        if not aliases:
+            raise CommandError('No replicas configured, set DJANGO_DB_REPLICAS')
+        source = settings.DATABASES['default']
+        if source['ENGINE'] != 'django.db.backends.sqlite3':
+            raise CommandError('sync_replicas only copies sqlite databases, use the replication of the database server')
+        while True:
+            start = time.perf_counter()
+            for alias in aliases:
+                copy_database(str(source['NAME']), str(settings.DATABASES[alias]['NAME']))
+            self.stdout.write(f'Copied to {len(aliases)} replica(s) in {(time.perf_counter() - start) * 1000:.1f}ms')
+            if not options['interval']:
+                break
+            time.sleep(options['interval'])
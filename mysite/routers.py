@@ -0,0 +1,115 @@
+"""
+Primary/replica database routing.
+
+Writes always go to the primary ('default'). Reads of the polls models go to a
+random replica of settings.DATABASE_REPLICAS, but only inside GET/HEAD requests
+to the polls pages, which ReplicaRoutingMiddleware marks. Everything else reads
+from the primary: management commands, background threads, the admin and
+requests that write.
+
+Read-your-writes: a request that wrote (e.g. a vote) sets a cookie that sends
+the reads of the same client to the primary for READ_YOUR_WRITES_SECONDS, so the
+results page shows the vote even if the replicas lag behind.
+"""
+
+import random
+import time
+from contextlib import contextmanager
+from contextvars import ContextVar
+
+from asgiref.sync import iscoroutinefunction
+from django.conf import settings
+from django.urls import reverse
+from django.utils.decorators import sync_and_async_middleware
+
+
+PIN_COOKIE = 'polls_primary'
+
+#True while handling a request whose reads may go to a replica
+_replica_reads = ContextVar('replica_reads', default=False)
+
+
+def replicas():
+    return getattr(settings, 'DATABASE_REPLICAS', [])
+
+
+def sticky_seconds():
+    return getattr(settings, 'READ_YOUR_WRITES_SECONDS', 5)
+
+
+class PrimaryReplicaRouter:
+
+    def db_for_read(self, model, **hints):
+        if model._meta.app_label == 'polls' and _replica_reads.get():
+            aliases = replicas()
+            if aliases:
+                return random.choice(aliases)
+        return 'default'
+
+    def db_for_write(self, model, **hints):
+        return 'default'
+
+    def allow_relation(self, obj1, obj2, **hints):
+        #the replicas hold the same data as the primary
+        return True
+
+    def allow_migrate(self, db, app_label, model_name=None, **hints):
+        #replicas are copies of the primary (see the sync_replicas command)
+        return db == 'default'
+
+
+@contextmanager
+def primary_reads():
+    #reads inside go to the primary, e.g. to fill a cache right after a change
+    token = _replica_reads.set(False)
+    try:
+        yield
+    finally:
+        _replica_reads.reset(token)
+
+
+def is_pinned(request):
+    try:
+        return float(request.COOKIES.get(PIN_COOKIE, 0)) > time.time()
+    except ValueError:
+        return False
+
+
+def reads_from_replica(request):
+    return (
+        bool(replicas())
+        and request.method in ('GET', 'HEAD')
+        and request.path_info.startswith(reverse('polls:index'))
+        and not is_pinned(request)
+    )
+
+
+def pin_to_primary(request, response):
+    #after a successful write the client reads its own writes from the primary for a while
+    if replicas() and request.method not in ('GET', 'HEAD', 'OPTIONS') and response.status_code < 400:
+        until = time.time() + sticky_seconds()
+        response.set_cookie(PIN_COOKIE, f'{until:.3f}', max_age=sticky_seconds(), httponly=True, samesite='Lax')
+    return response
+
+
+@sync_and_async_middleware
+def ReplicaRoutingMiddleware(get_response):
+
+    if iscoroutinefunction(get_response):
+        async def middleware(request):
+            token = _replica_reads.set(reads_from_replica(request))
+            try:
+                response = await get_response(request)
+            finally:
+                _replica_reads.reset(token)
+            return pin_to_primary(request, response)
+    else:
+        def middleware(request):
+            token = _replica_reads.set(reads_from_replica(request))
+            try:
+                response = get_response(request)
+            finally:
+                _replica_reads.reset(token)
+            return pin_to_primary(request, response)
+
+    return middleware
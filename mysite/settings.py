@@ -10,6 +10,7 @@ For the full list of settings and their values, see
 https://docs.djangoproject.com/en/4.0/ref/settings/
 """
 
+import os
 from pathlib import Path
 
 # Build paths inside the project like this: BASE_DIR / 'subdir'.
@@ -41,9 +42,14 @@ INSTALLED_APPS = [
 
     #further includes
     'polls',
+    'mysite.apps.MysiteConfig',  #project level hooks, e.g. sqlite tuning
 ]
 
 MIDDLEWARE = [
+    #outermost, so it sees the complete request (see mysite/instrumentation.py)
+    'mysite.instrumentation.PerformanceMiddleware',
+    #sends reads of the polls pages to the replicas (see mysite/routers.py)
+    'mysite.routers.ReplicaRoutingMiddleware',
     'django.middleware.security.SecurityMiddleware',
     'django.contrib.sessions.middleware.SessionMiddleware',
     'django.middleware.common.CommonMiddleware',
@@ -57,10 +63,17 @@ ROOT_URLCONF = 'mysite.urls'
 
 TEMPLATES = [
     {
-        'BACKEND': 'django.template.backends.django.DjangoTemplates',
+        #DjangoTemplates backend that measures render time for the PerformanceMiddleware
+        'BACKEND': 'mysite.instrumentation.InstrumentedDjangoTemplates',
         'DIRS': [BASE_DIR / 'templates'],
-        'APP_DIRS': True,
         'OPTIONS': {
+            #compiled templates are kept in memory (and reloaded on changes by runserver)
+            'loaders': [
+                ('django.template.loaders.cached.Loader', [
+                    'django.template.loaders.filesystem.Loader',
+                    'django.template.loaders.app_directories.Loader',
+                ]),
+            ],
             'context_processors': [
                 'django.template.context_processors.debug',
                 'django.template.context_processors.request',
@@ -76,14 +89,93 @@ WSGI_APPLICATION = 'mysite.wsgi.application'
 
 # Database
 # https://docs.djangoproject.com/en/4.0/ref/settings/#databases
+# the sqlite file can be moved with the DJANGO_DB_NAME environment variable
 
 DATABASES = {
     'default': {
         'ENGINE': 'django.db.backends.sqlite3',
-        'NAME': BASE_DIR / 'db.sqlite3',
+        'NAME': os.environ.get('DJANGO_DB_NAME', BASE_DIR / 'db.sqlite3'),
     }
 }
 
+# Database profile, selected with the DJANGO_DB_PROFILE environment variable
+# 'development' (default): plain sqlite as above
+# 'production': WAL journal, busy timeout, bigger cache/mmap (applied by mysite/sqlite.py)
+#               and persistent connections with health checks
+
+DB_PROFILE = os.environ.get('DJANGO_DB_PROFILE', 'development')
+
+SQLITE_PRAGMAS = {}
+
+if DB_PROFILE == 'production':
+    DATABASES['default'].update({
+        'CONN_MAX_AGE': 600,
+        'CONN_HEALTH_CHECKS': True,
+    })
+    SQLITE_PRAGMAS = {
+        'journal_mode': 'WAL',
+        'synchronous': 'NORMAL',
+        'busy_timeout': 5000,         # ms
+        'mmap_size': 268435456,       # 256 MiB
+        'cache_size': -65536,         # 64 MiB
+        'temp_store': 'MEMORY',
+    }
+
+
+# Read replicas, comma separated sqlite files in the DJANGO_DB_REPLICAS environment variable
+# They're copies of the primary made by 'manage.py sync_replicas' (see mysite/routers.py).
+# READ_YOUR_WRITES_SECONDS: reads of a client go to the primary for this long after it wrote
+
+DATABASE_REPLICAS = []
+
+for number, path in enumerate(filter(None, os.environ.get('DJANGO_DB_REPLICAS', '').split(',')), 1):
+    alias = f'replica{number}'
+    #tests use the primary test database for the replicas
+    DATABASES[alias] = {**DATABASES['default'], 'NAME': path, 'TEST': {'MIRROR': 'default'}}
+    DATABASE_REPLICAS.append(alias)
+
+DATABASE_ROUTERS = ['mysite.routers.PrimaryReplicaRouter']
+
+READ_YOUR_WRITES_SECONDS = 5
+
+
+# Cache
+# https://docs.djangoproject.com/en/4.0/topics/cache/
+# Question versions, cached pages, the publication schedule and vote dedup tokens have to
+# be shared by all worker processes: set DJANGO_CACHE_URL to redis://host:6379/0 (Redis)
+# or host:11211 (Memcached) in every deployment with more than one worker.
+# Without it each process has its own LocMemCache, only fit for tests and runserver.
+# POLLS_WORKER_PROCESSES (WEB_CONCURRENCY environment variable, as read by gunicorn):
+# with more than one worker a per process cache fails the system checks (polls/checks.py)
+
+CACHE_URL = os.environ.get('DJANGO_CACHE_URL', '')
+
+if CACHE_URL.startswith(('redis://', 'rediss://')):
+    CACHES = {
+        'default': {
+            'BACKEND': 'django.core.cache.backends.redis.RedisCache',
+            'LOCATION': CACHE_URL,
+        }
+    }
+elif CACHE_URL:
+    CACHES = {
+        'default': {
+            'BACKEND': 'django.core.cache.backends.memcached.PyMemcacheCache',
+            'LOCATION': CACHE_URL,
+        }
+    }
+else:
+    CACHES = {
+        'default': {
+            'BACKEND': 'django.core.cache.backends.locmem.LocMemCache',
+            'LOCATION': 'polls',
+            #culling at the default 300 entries would drop version and lock keys
+            'OPTIONS': {'MAX_ENTRIES': 100000},
+        }
+    }
+
+POLLS_WORKER_PROCESSES = int(os.environ.get('WEB_CONCURRENCY', '1'))
+
 
 # Password validation
 # https://docs.djangoproject.com/en/4.0/ref/settings/#auth-password-validators
@@ -121,7 +213,174 @@ USE_TZ = True
 
 STATIC_URL = 'static/'
 
+# collectstatic target, served by mysite.staticfiles.serve when DEBUG is off
+STATIC_ROOT = BASE_DIR / 'staticfiles'
+
+# content-hashed file names with gzip variants outside of development (see mysite/staticfiles.py),
+# the manifest storage needs collectstatic to have run
+
+STORAGES = {
+    'default': {
+        'BACKEND': 'django.core.files.storage.FileSystemStorage',
+    },
+    'staticfiles': {
+        'BACKEND': (
+            'django.contrib.staticfiles.storage.StaticFilesStorage' if DEBUG
+            else 'mysite.staticfiles.GzipManifestStaticFilesStorage'
+        ),
+    },
+}
+
 # Default primary key field type
 # https://docs.djangoproject.com/en/4.0/ref/settings/#default-auto-field
 
 DEFAULT_AUTO_FIELD = 'django.db.models.BigAutoField'
+
+
+# Performance instrumentation
+# number of requests per endpoint kept for the percentiles of /perf/stats/
+# PERF_STATS_PROVIDERS: additional counters included in /perf/stats/
+# PERF_STATS_ALLOWED_IPS: addresses allowed to read /perf/stats/ besides staff users,
+# keep it empty behind a reverse proxy on the same host (every client is 127.0.0.1 there)
+
+PERF_STATS_WINDOW = 1000
+
+PERF_STATS_ALLOWED_IPS = []
+
+PERF_STATS_PROVIDERS = {
+    'vote_buffer': 'polls.votebuffer.buffer_stats',
+    'question_cache': 'polls.cache.cache_stats',
+    'live_results': 'polls.live.live_stats',
+    'vote_dedup': 'polls.dedup.dedup_stats',
+    'page_cache': 'polls.pagecache.page_cache_stats',
+}
+
+
+# Polls views
+# POLLS_ASYNC_VIEWS: use the native async views of polls/async_views.py,
+# for ASGI deployments (POLLS_ASYNC_VIEWS=1 environment variable)
+
+POLLS_ASYNC_VIEWS = os.environ.get('POLLS_ASYNC_VIEWS') == '1'
+
+
+# Polls vote buffer
+# FLUSH_EVERY: number of pending votes that triggers a write (1 => write on every vote)
+# FLUSH_INTERVAL_MS: pending votes are written at the latest after this time (0 => off)
+# LOCK_RETRIES / LOCK_RETRY_DELAY_MS: retries with exponential backoff when the database is locked
+
+POLLS_VOTE_BUFFER = {
+    'FLUSH_EVERY': 1,
+    'FLUSH_INTERVAL_MS': 0,
+    'LOCK_RETRIES': 5,
+    'LOCK_RETRY_DELAY_MS': 10,
+}
+
+
+# Polls vote deduplication (see polls/dedup.py)
+# BACKEND: 'memory' (per process) or 'cache' (shared through the CACHE alias, used with DJANGO_CACHE_URL)
+# MAX_ENTRIES: tokens kept by the memory backend, TTL: seconds a token is remembered
+
+POLLS_VOTE_DEDUP = {
+    'BACKEND': 'cache' if CACHE_URL else 'memory',
+    'MAX_ENTRIES': 10000,
+    'TTL': 600,
+    'CACHE': 'default',
+}
+
+
+# Polls question cache (see polls/cache.py)
+# cache alias and lifetime in seconds of cached questions
+
+POLLS_CACHE = 'default'
+
+POLLS_QUESTION_CACHE_TIMEOUT = 300
+
+
+# Polls page cache of the index and category pages (see polls/pagecache.py)
+# TIMEOUT: seconds a page is fresh (changes and publications invalidate it earlier), STALE: seconds an expired page is served while one request rebuilds it
+# LOCK_TIMEOUT: seconds until the rebuild lock of a crashed worker expires
+# WAIT_MS: how long requests wait for the first rendering of a page instead of rendering it as well
+
+POLLS_PAGE_CACHE = {
+    'ENABLED': True,
+    'TIMEOUT': 300,
+    'STALE': 300,
+    'LOCK_TIMEOUT': 10,
+    'WAIT_MS': 1000,
+}
+
+
+# Polls publication scheduler (see polls/scheduler.py)
+# THREAD: publish future questions from a background thread started by the first request,
+# otherwise requests and manage.py publish_questions --loop publish them
+# MAX_SLEEP: seconds the thread sleeps at most before checking the schedule again
+
+POLLS_SCHEDULER = {
+    'THREAD': False,
+    'MAX_SLEEP': 60,
+}
+
+# number of questions per page of a category
+
+POLLS_CATEGORY_PAGE_SIZE = 20
+
+# admin: rows counted exactly in the question changelist (estimated beyond),
+# choices per page of the question change form, vote shards set by the 'shard votes' action
+
+POLLS_ADMIN_EXACT_COUNT_LIMIT = 10000
+
+POLLS_ADMIN_CHOICES_PER_PAGE = 50
+
+POLLS_ADMIN_VOTE_SHARDS = 16
+
+# results per page of polls/search/
+
+POLLS_SEARCH_PAGE_SIZE = 20
+
+# questions per query of the streaming export (polls/export/, export_polls)
+
+POLLS_EXPORT_CHUNK_SIZE = 1000
+
+# max-age (seconds) of polls/<id>/results.json for browsers and reverse proxies
+
+POLLS_RESULTS_JSON_MAX_AGE = 5
+
+# number of question ids accepted by polls/results/batch
+
+POLLS_BATCH_RESULTS_MAX_IDS = 100
+
+
+# Polls bulk ballot endpoint polls/ballots/ (see polls/ballots.py)
+# POLLS_BALLOT_API_KEYS: accepted bearer keys, comma separated in the POLLS_BALLOT_API_KEYS environment variable
+# POLLS_BALLOT_MAX_ITEMS: ballots per request, POLLS_BALLOT_MAX_COUNT: votes per ballot
+
+POLLS_BALLOT_API_KEYS = [key for key in os.environ.get('POLLS_BALLOT_API_KEYS', '').split(',') if key]
+
+POLLS_BALLOT_MAX_ITEMS = 10000
+
+POLLS_BALLOT_MAX_COUNT = 1000
+
+
+# Polls vote event log (see polls/trends.py)
+# POLLS_VOTE_EVENTS: append flushed votes to the log for trends
+# POLLS_VOTE_EVENT_RETENTION_DAYS: raw events are pruned after this, the rollups are kept
+# POLLS_TREND_JSON_MAX_AGE: max-age (seconds) of polls/<id>/trend.json, rollups change hourly
+
+POLLS_VOTE_EVENTS = True
+
+POLLS_VOTE_EVENT_RETENTION_DAYS = 7
+
+POLLS_TREND_JSON_MAX_AGE = 300
+
+
+# Polls live results (server-sent events, see polls/live.py)
+# POLLS_LIVE_RESULTS: the results page opens the live stream, needs an ASGI server
+# to keep it open (on with POLLS_ASYNC_VIEWS, under WSGI the stream answers 204)
+# vote deltas are sent to viewers at most once per tick,
+# a keep-alive comment is sent after HEARTBEAT_S seconds without votes
+
+POLLS_LIVE_RESULTS = POLLS_ASYNC_VIEWS
+
+POLLS_LIVE_TICK_MS = 500
+
+POLLS_LIVE_HEARTBEAT_S = 15
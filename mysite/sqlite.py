@@ -0,0 +1,48 @@
+"""
+SQLite connection tuning.
+
+The PRAGMAs in settings.SQLITE_PRAGMAS are applied to every new SQLite connection
+through the connection_created signal (connected in MysiteConfig.ready()).
+The production database profile uses them for WAL journaling, a busy timeout
+instead of immediate "database is locked" errors and a larger page cache / mmap.
+
+copy_database() is the replication stand-in for the read replicas (sync_replicas command).
+"""
+
+import sqlite3
+
+from django.conf import settings
+
+
+def apply_sqlite_pragmas(dbapi_connection, pragmas):
+    """
+    Apply {name: value} PRAGMAs to a sqlite3 connection
+    """
+    cursor = dbapi_connection.cursor()
+    try:
+        for name, value in pragmas.items():
+            cursor.execute(f'PRAGMA {name} = {value}')
+    finally:
+        cursor.close()
+
+
+def copy_database(source_path, target_path):
+    """
+    Copy a sqlite database file with the online backup API, the target is
+    replaced in a single transaction
+    """
+    source = sqlite3.connect(source_path)
+    target = sqlite3.connect(target_path)
+    try:
+        source.backup(target)
+    finally:
+        target.close()
+        source.close()
+
+
+def configure_connection(sender, connection, **kwargs):
+    if connection.vendor != 'sqlite':
+        return
+    pragmas = getattr(settings, 'SQLITE_PRAGMAS', {})
+    if pragmas:
+        apply_sqlite_pragmas(connection.connection, pragmas)
@@ -0,0 +1,91 @@
+# Fingerprinted, precompressed static files
+'''
+collectstatic with GzipManifestStaticFilesStorage copies every file under a name
+containing a hash of its content (style.css -> style.4f3c2a1b9e7d.css) and writes
+a gzip variant next to the text files. Since the content of a hashed name never
+changes, serve() sends it with a far-future, immutable Cache-Control header and
+browsers don't revalidate it on repeat page loads. Files without a hash in their
+name are sent with revalidation.
+
+serve() is meant for deployments without a web server in front (DEBUG = False),
+runserver serves the static files itself in development.
+'''
+
+import gzip
+import mimetypes
+import os
+
+from django.conf import settings
+from django.contrib.staticfiles.storage import ManifestStaticFilesStorage, staticfiles_storage
+from django.core.exceptions import SuspiciousFileOperation
+from django.http import FileResponse, Http404, HttpResponseNotModified
+from django.utils._os import safe_join
+from django.utils.http import http_date
+from django.views.decorators.http import require_safe
+from django.views.static import was_modified_since
+
+
+COMPRESSIBLE = ('.css', '.js', '.svg', '.txt', '.html', '.json', '.map', '.xml')
+
+IMMUTABLE = 'public, max-age=31536000, immutable'
+
+
+class GzipManifestStaticFilesStorage(ManifestStaticFilesStorage):
+
+    def post_process(self, paths, dry_run=False, **options):
+        names = set()
+        for name, hashed_name, processed in super().post_process(paths, dry_run, **options):
+            if hashed_name and not isinstance(processed, Exception):
+                names.update((name, hashed_name))
+            yield name, hashed_name, processed
+        if not dry_run:
+            for name in names:
+                self.compress(name)
+
+    def compress(self, name):
+        #files that don't get smaller aren't worth a variant
+        if not name.endswith(COMPRESSIBLE):
+            return
+        path = self.path(name)
+        with open(path, 'rb') as f:
+            data = f.read()
+        #mtime=0 makes the output reproducible
+        compressed = gzip.compress(data, compresslevel=9, mtime=0)
+        if len(compressed) < len(data):
+            with open(path + '.gz', 'wb') as f:
+                f.write(compressed)
+
+
+def is_immutable(path):
+    #hashed names of the manifest, their content never changes
+    names = getattr(staticfiles_storage, '_immutable_names', None)
+    if names is None:
+        names = staticfiles_storage._immutable_names = set(getattr(staticfiles_storage, 'hashed_files', {}).values())
+    return path in names
+
+
+@require_safe
+def serve(request, path):
+    try:
+        full_path = safe_join(settings.STATIC_ROOT, path)
+    except SuspiciousFileOperation:
+        raise Http404('Not found')
+    if not os.path.isfile(full_path):
+        raise Http404('Not found')
+    content_type, encoding = mimetypes.guess_type(full_path)
+    immutable = is_immutable(path)
+    mtime = os.stat(full_path).st_mtime
+    if not immutable and not was_modified_since(request.META.get('HTTP_IF_MODIFIED_SINCE'), mtime):
+        return HttpResponseNotModified()
+    content_type = content_type or 'application/octet-stream'
+    filename = os.path.basename(full_path)
+    accepts_gzip = 'gzip' in request.META.get('HTTP_ACCEPT_ENCODING', '')
+    if accepts_gzip and os.path.isfile(full_path + '.gz'):
+        response = FileResponse(open(full_path + '.gz', 'rb'), content_type=content_type, filename=filename)
+        response['Content-Encoding'] = 'gzip'
+    else:
+        response = FileResponse(open(full_path, 'rb'), content_type=content_type, filename=filename)
+    response['Vary'] = 'Accept-Encoding'
+    response['Last-Modified'] = http_date(mtime)
+    response['Cache-Control'] = IMMUTABLE if immutable else 'public, max-age=0, must-revalidate'
+    return response
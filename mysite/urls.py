@@ -13,10 +13,23 @@ Including another URLconf
     1. Import the include() function: from django.urls import include, path
     2. Add a URL to urlpatterns:  path('blog/', include('blog.urls'))
 """
+import re
+
+from django.conf import settings
 from django.contrib import admin
-from django.urls import path, include
+from django.urls import path, include, re_path
+
+from .instrumentation import perf_stats
+from .staticfiles import serve as serve_static
 
 urlpatterns = [
     path('polls/', include('polls.urls')),  # all request that start with polls/ are passed to urlconf of the polls app
     path('admin/', admin.site.urls),
+    path('perf/stats/', perf_stats, name='perf_stats'),  # per endpoint latency percentiles
 ]
+
+#without DEBUG, runserver doesn't serve static files: hashed files are sent with immutable caching
+if not settings.DEBUG:
+    urlpatterns.append(
+        re_path(r'^%s(?P<path>.*)$' % re.escape(settings.STATIC_URL.lstrip('/')), serve_static, name='static'),
+    )
@@ -1,29 +1,149 @@
 # Admin form customization
+'''
+The question admin is built for large tables:
+- the changelist counts exactly only up to POLLS_ADMIN_EXACT_COUNT_LIMIT rows
+  and estimates beyond that, instead of a COUNT(*) over the whole table
+- the category is joined in the changelist query, 'published recently' is computed by the database
+- the choices of a question are edited one page (POLLS_ADMIN_CHOICES_PER_PAGE) at a time
+- bulk actions are single UPDATE statements
+'''
 
-from django.contrib import admin
-from .models import Question, Choice, Category
+import datetime
+
+from django.conf import settings
+from django.contrib import admin, messages
+from django.core.paginator import Paginator
+from django.db import transaction
+from django.db.models import BooleanField, Case, Max, Q, Value, When
+from django.forms.models import BaseInlineFormSet
+from django.utils import timezone
+from django.utils.functional import cached_property
+
+from .cache import invalidate_question
+from .models import Question, Choice, ChoiceVoteShard, Category
+from .pagecache import bump_content_version
+from .scheduler import schedule_changed
+from .search import fts_query, matching_ids, search_available
+from .shards import set_vote_shards
+
+
+class EstimatedCountPaginator(Paginator):
+    #exact counts up to a limit, above it the id range of an unfiltered table or the limit
+
+    @cached_property
+    def count(self):
+        limit = getattr(settings, 'POLLS_ADMIN_EXACT_COUNT_LIMIT', 10000)
+        #counting a limited subquery stops after limit + 1 rows
+        count = self.object_list[:limit + 1].count()
+        if count <= limit:
+            return count
+        if not self.object_list.query.where:
+            return max(self.object_list.aggregate(max_pk=Max('pk'))['max_pk'], count)
+        return limit
+
+
+class PaginatedChoiceFormSet(BaseInlineFormSet):
+    #only one page of choices is rendered and saved, the page is a query parameter of the change form
+    page_number = None
+    page_size = 50
+
+    def get_queryset(self):
+        if not hasattr(self, 'page'):
+            self.page = Paginator(super().get_queryset(), self.page_size).get_page(self.page_number)
+        return self.page.object_list
 
 
 class ChoiceInline(admin.TabularInline):
     #choices are shown inline with corresponding question
     model = Choice
     extra = 0
+    formset = PaginatedChoiceFormSet
+    template = 'admin/polls/question/paginated_tabular.html'
+
+    def get_formset(self, request, obj=None, **kwargs):
+        formset = super().get_formset(request, obj, **kwargs)
+        formset.page_number = request.GET.get('choice_page')
+        formset.page_size = getattr(settings, 'POLLS_ADMIN_CHOICES_PER_PAGE', 50)
+        return formset
+
 
 class QuestionAdmin(admin.ModelAdmin):
     fieldsets = [
         (None,               {'fields': ['question_text']}),
         ('Date information', {'fields': ['pub_date']}),
         ('Category', {'fields': ['question_category']}),
+        #sharded vote counters for very popular questions, see shards.py
+        ('Votes', {'fields': ['vote_shards'], 'classes': ['collapse']}),
     ]
+    #changed with the shard actions, which create the shard rows (shards.set_vote_shards())
+    readonly_fields = ['vote_shards']
 
     inlines = [ChoiceInline]
     #columns of displayed list of questions:
-    list_display = ('question_text', 'pub_date', 'was_published_recently')
+    list_display = ('question_text', 'pub_date', 'question_category', 'published_recently')
+    #categories are fetched with the questions instead of one query per row
+    list_select_related = ['question_category']
     #additional filter for list of questions:
     list_filter = ['pub_date']
     #search capability:
     search_fields = ['question_text']
+    paginator = EstimatedCountPaginator
+    #no second count over the whole table on filtered pages
+    show_full_result_count = False
+    actions = ['publish_now', 'reset_votes', 'shard_votes', 'unshard_votes']
+
+    def get_queryset(self, request):
+        now = timezone.now()
+        return super().get_queryset(request).annotate(published_recently=Case(
+            When(Q(pub_date__gte=now - datetime.timedelta(days=1), pub_date__lte=now), then=Value(True)),
+            default=Value(False),
+            output_field=BooleanField(),
+        ))
+
+    #same as Question.was_published_recently(), computed in the changelist query
+    @admin.display(boolean=True, ordering='published_recently', description='Published recently?')
+    def published_recently(self, obj):
+        return obj.published_recently
+
+    def get_search_results(self, request, queryset, search_term):
+        #uses the full-text index instead of LIKE '%term%' scans (see search.py)
+        if not search_available() or fts_query(search_term) is None:
+            return super().get_search_results(request, queryset, search_term)
+        return queryset.filter(pk__in=matching_ids(search_term)), False
+
+    @admin.action(description='Publish selected questions now')
+    def publish_now(self, request, queryset):
+        question_ids = list(queryset.values_list('pk', flat=True))
+        updated = Question.objects.filter(pk__in=question_ids).update(pub_date=timezone.now(), is_live=True)
+        invalidate_question(*question_ids)
+        bump_content_version()
+        schedule_changed()
+        self.message_user(request, f'Published {updated} question(s).', messages.SUCCESS)
+
+    @admin.action(description='Reset votes of selected questions')
+    def reset_votes(self, request, queryset):
+        question_ids = list(queryset.values_list('pk', flat=True))
+        with transaction.atomic():
+            Choice.objects.filter(question_id__in=question_ids).update(votes=0)
+            ChoiceVoteShard.objects.filter(choice__question_id__in=question_ids).update(votes=0)
+            updated = Question.objects.filter(pk__in=question_ids).update(total_votes=0)
+        invalidate_question(*question_ids)
+        self.message_user(request, f'Reset the votes of {updated} question(s).', messages.SUCCESS)
+
+    def _set_vote_shards(self, request, queryset, shards):
+        question_ids = list(queryset.values_list('pk', flat=True))
+        for question_id in question_ids:
+            set_vote_shards(question_id, shards)
+        invalidate_question(*question_ids)
+        self.message_user(request, f'{len(question_ids)} question(s) count votes in {shards} shard(s).', messages.SUCCESS)
+
+    @admin.action(description='Spread the votes of selected questions over shards')
+    def shard_votes(self, request, queryset):
+        self._set_vote_shards(request, queryset, getattr(settings, 'POLLS_ADMIN_VOTE_SHARDS', 16))
+
+    @admin.action(description='Count the votes of selected questions without shards')
+    def unshard_votes(self, request, queryset):
+        self._set_vote_shards(request, queryset, 1)
 
 admin.site.register(Question, QuestionAdmin)
 admin.site.register(Category)
-
@@ -5,3 +5,14 @@ from django.apps import AppConfig
 class PollsConfig(AppConfig):
     default_auto_field = 'django.db.models.BigAutoField'
     name = 'polls'
+
+    def ready(self):
+        #connect signal handlers
+        from . import signals
+        #deployment checks, e.g. a cache shared by all workers (see checks.py)
+        from . import checks
+        #publication scheduler thread, started by the first request (see scheduler.py)
+        from django.core.signals import request_started
+        from .scheduler import scheduler_settings, start_scheduler_thread
+        if scheduler_settings()['THREAD']:
+            request_started.connect(start_scheduler_thread, dispatch_uid='polls_scheduler_thread')
@@ -0,0 +1,103 @@
+# Native async request handlers
+'''
+Async versions of the views in views.py for ASGI deployments, enabled with the
+POLLS_ASYNC_VIEWS setting (see urls.py). They use the async ORM and cache
+interfaces, so no worker thread is held while waiting for the database or for
+slow clients. Templates are rendered after all querysets have been evaluated.
+'''
+
+from asgiref.sync import sync_to_async
+from django.http import Http404, HttpResponseRedirect
+from django.shortcuts import render
+from django.urls import reverse
+
+from .cache import aget_question_with_choices
+from .dedup import get_dedup_store, new_vote_token, vote_token_key
+from .live import live_results_enabled
+from .models import Question, Choice, Category
+from .scheduler import aensure_published
+from .views import category_context, category_page_queryset
+from .votebuffer import get_vote_buffer
+
+
+async def get_question_or_404(question_id, published_only=False):
+    if published_only:
+        await aensure_published()
+    try:
+        question, choices = await aget_question_with_choices(question_id)
+    except Question.DoesNotExist:
+        raise Http404('No question found matching the query')
+    if published_only and not question.is_published():
+        raise Http404('No question found matching the query')
+    return question, choices
+
+
+#list of recently published questions
+async def index(request):
+    await aensure_published()
+    latest_question_list = [
+        question async for question in Question.objects.published().order_by('-pub_date')[:8]
+    ]
+    category_list = [category async for category in Category.objects.order_by('name')]
+    return render(request, 'polls/index.html', {
+        'latest_question_list': latest_question_list,
+        'category_list': category_list,
+    })
+
+
+#detailed view for a chosen question
+async def detail(request, pk):
+    question, choices = await get_question_or_404(pk, published_only=True)
+    return render(request, 'polls/detail.html', {
+        'question': question,
+        'choices': choices,
+        'vote_token': new_vote_token(),
+    })
+
+
+#results view for a chosen question (votes)
+async def results(request, pk):
+    question, choices = await get_question_or_404(pk)
+    return render(request, 'polls/results.html', {
+        'question': question, 'choices': choices, 'live_results': live_results_enabled(),
+    })
+
+
+#voting handler, repeated submissions of a form are detected by its token (see dedup.py)
+async def vote(request, question_id):
+    token_key = vote_token_key(request, question_id)
+    dedup = get_dedup_store()
+    if token_key is not None and not await dedup.aclaim(token_key):
+        return HttpResponseRedirect(reverse('polls:results', args=(question_id,)))
+    voted = False
+    try:
+        question, choices = await get_question_or_404(question_id)
+        try:
+            choice_id = await Choice.objects.filter(
+                question_id=question.id, pk=request.POST['choice']).values_list('id', flat=True).aget()
+        except (KeyError, ValueError, Choice.DoesNotExist):
+            return render(request, 'polls/detail.html', {
+                'question': question,
+                'choices': choices,
+                'vote_token': new_vote_token(),
+                'error_message': "You didn't select a choice",
+            })
+        voted = True
+        #adding a vote may flush the buffer, which writes to the database
+        await sync_to_async(get_vote_buffer().add)(question.id, choice_id)
+        return HttpResponseRedirect(reverse('polls:results', args=(question.id,)))
+    finally:
+        if token_key is not None and not voted:
+            await dedup.arelease(token_key)
+
+
+#category view
+async def show_category(request, slug):
+    await aensure_published()
+    try:
+        category = await Category.objects.aget(slug=slug)
+    except Category.DoesNotExist:
+        raise Http404('No category found matching the query')
+    cursor = request.GET.get('after')
+    category_question_list = [question async for question in category_page_queryset(category, cursor)]
+    return render(request, 'polls/category.html', category_context(category, cursor, category_question_list))
@@ -0,0 +1,103 @@
+# Bulk ballot ingestion for kiosks and edge collectors
+'''
+Collectors gather votes offline and send them in batches to polls/ballots/:
+
+    POST  Authorization: Bearer <one of POLLS_BALLOT_API_KEYS>
+    {"ballots": [[question_id, choice_id, count], ...]}
+
+Every choice is checked to belong to its question, and the question to be
+published (live with at least two choices), with one query per INCREMENT_CHUNK
+choices. The valid ballots are summed per choice and applied in one transaction
+by apply_vote_increments(), whose UPDATE statements pick the amount of each row
+with a CASE expression (shards.increment()). Lock errors are retried like the
+writes of the vote buffer (LOCK_RETRIES of POLLS_VOTE_BUFFER). Invalid ballots
+are reported with their index and don't affect the others.
+'''
+
+import hmac
+from collections import defaultdict
+
+from django.conf import settings
+
+from .models import MAX_ID, Choice
+from .shards import chunked
+from .votebuffer import apply_vote_increments, retry_on_lock, vote_buffer_settings
+
+
+def api_keys():
+    return getattr(settings, 'POLLS_BALLOT_API_KEYS', [])
+
+
+def max_ballots():
+    return getattr(settings, 'POLLS_BALLOT_MAX_ITEMS', 10000)
+
+
+def max_count():
+    return getattr(settings, 'POLLS_BALLOT_MAX_COUNT', 1000)
+
+
+def is_authorized(request):
+    scheme, _, key = request.headers.get('Authorization', '').partition(' ')
+    if scheme.lower() != 'bearer' or not key:
+        return False
+    #compares with every key, so the time taken doesn't tell which one is close
+    return any([hmac.compare_digest(key.encode(), valid.encode()) for valid in api_keys()])
+
+
+def parse_ballot(item):
+    """
+    Return (question_id, choice_id, count) of a ballot, raise ValueError for malformed ones
+    """
+    if not isinstance(item, (list, tuple)) or len(item) not in (2, 3):
+        raise ValueError('expected [question_id, choice_id, count]')
+    question_id, choice_id, count = (*item, 1) if len(item) == 2 else item
+    #bool is an int, but not a valid id or count
+    if not all(type(value) is int for value in (question_id, choice_id, count)):
+        raise ValueError('question_id, choice_id and count have to be integers')
+    #larger ids can't be looked up in the database
+    if not (1 <= question_id <= MAX_ID and 1 <= choice_id <= MAX_ID):
+        raise ValueError(f'question_id and choice_id have to be between 1 and {MAX_ID}')
+    if not 1 <= count <= max_count():
+        raise ValueError(f'count has to be between 1 and {max_count()}')
+    return question_id, choice_id, count
+
+
+def ingest_ballots(items):
+    """
+    Validate and apply a batch of ballots, returns (accepted ballots, votes, errors)
+    where errors are {'index': ..., 'error': ...} of the rejected ballots
+    """
+    errors = []
+    ballots = []
+    for index, item in enumerate(items):
+        try:
+            ballots.append((index, *parse_ballot(item)))
+        except ValueError as e:
+            errors.append({'index': index, 'error': str(e)})
+    choice_ids = {choice_id for index, question_id, choice_id, count in ballots}
+    choices = {}
+    for chunk in chunked(choice_ids):
+        choices.update({
+            pk: (question_id, is_live and choice_count >= 2)
+            for pk, question_id, is_live, choice_count in Choice.objects.filter(pk__in=chunk).values_list(
+                'pk', 'question_id', 'question__is_live', 'question__choice_count')
+        })
+    increments = defaultdict(int)
+    accepted = 0
+    for index, question_id, choice_id, count in ballots:
+        if choices.get(choice_id, (None,))[0] != question_id:
+            errors.append({'index': index, 'error': 'choice does not belong to the question'})
+            continue
+        #stricter than the vote form, which takes votes for any question by id:
+        #collectors only get questions that are shown to visitors
+        if not choices[choice_id][1]:
+            errors.append({'index': index, 'error': 'question is not published'})
+            continue
+        increments[(question_id, choice_id)] += count
+        accepted += 1
+    if increments:
+        options = vote_buffer_settings()
+        retry_on_lock(lambda: apply_vote_increments(increments),
+                      options['LOCK_RETRIES'], options['LOCK_RETRY_DELAY_MS'] / 1000)
+    errors.sort(key=lambda error: error['index'])
+    return accepted, sum(increments.values()), errors
@@ -0,0 +1,388 @@
+# Benchmark helpers for the polls read paths, used by the bench_polls command
+'''
+seed_dataset() creates a reproducible dataset with skewed distributions: a few
+categories hold most questions, most questions have few choices and a few choices
+get most votes. run_benchmarks() drives the endpoints through the test client or
+a local WSGI server and reports requests/s, latency percentiles and queries per
+request (taken from the Server-Timing header of the PerformanceMiddleware).
+
+measure_connections() compares what open connections cost: under ASGI every live
+results stream is a suspended coroutine, under WSGI every held connection needs a
+worker thread.
+
+vote_stress() measures parallel vote throughput on a single question, with one
+counter row per choice or with sharded counters (see shards.py).
+
+ballot_ingest() measures the votes per second of the bulk ballot endpoint (see ballots.py).
+'''
+
+import asyncio
+import datetime
+import http.client
+import json
+import random
+import re
+import secrets
+import threading
+import time
+import tracemalloc
+from urllib.parse import urlencode
+from itertools import islice
+from wsgiref.simple_server import WSGIRequestHandler, WSGIServer, make_server
+
+from asgiref.sync import async_to_sync
+from django.contrib.auth.models import User
+from django.core.handlers.wsgi import WSGIHandler
+from django.db import connections as db_connections
+from django.db.models import Count
+from django.test import AsyncClient, Client, override_settings
+from django.urls import reverse
+from django.utils import timezone
+
+from .importer import PollImporter
+from .models import Question, Choice, Category
+from .shards import rollup_vote_shards, set_vote_shards
+from .votebuffer import apply_vote_increments, retry_on_lock
+
+
+PRESETS = {
+    'small': 1000,
+    'medium': 100000,
+    'large': 1000000,
+}
+
+QUERIES = re.compile(r'desc="(\d+) queries"')
+
+
+def zipf_weights(count, exponent=1.1):
+    return [1 / (rank + 1) ** exponent for rank in range(count)]
+
+
+def generate_records(questions, categories=20, max_choices=10, seed=0):
+    """
+    Yield import_polls records with skewed category, choice and vote distributions
+    """
+    rng = random.Random(seed)
+    slugs = [f'bench-category-{i}' for i in range(categories)]
+    category_weights = zipf_weights(categories)
+    now = timezone.now()
+    for i in range(questions):
+        #mostly 2-4 choices, rarely up to max_choices
+        choice_count = min(2 + int(rng.expovariate(0.7)), max_choices)
+        votes = [int(rng.paretovariate(1.2)) - 1 for c in range(choice_count)]
+        #about 2% of the questions are scheduled in the future
+        days = rng.uniform(-365, 0) if rng.random() > 0.02 else rng.uniform(0, 30)
+        yield {
+            'question_text': f'Benchmark question {i}?',
+            'pub_date': now + datetime.timedelta(days=days),
+            'category': rng.choices(slugs, category_weights)[0],
+            'choices': [{'choice_text': f'Choice {c}', 'votes': votes[c]} for c in range(choice_count)],
+        }
+
+
+def seed_dataset(questions, categories=20, max_choices=10, seed=0, chunk_size=5000):
+    importer = PollImporter()
+    records = enumerate(generate_records(questions, categories, max_choices, seed), 1)
+    while True:
+        chunk = list(islice(records, chunk_size))
+        if not chunk:
+            break
+        importer.import_chunk(chunk)
+
+
+def default_endpoints():
+    """
+    (name, url) of the benchmarked read paths, using the most voted published question
+    and the biggest category
+    """
+    question = Question.objects.published().order_by('-total_votes').first()
+    category = Category.objects.annotate(questions=Count('question')).order_by('-questions').first()
+    endpoints = [('index', reverse('polls:index'))]
+    if question is not None:
+        endpoints += [
+            ('detail', reverse('polls:detail', args=(question.id,))),
+            ('results', reverse('polls:results', args=(question.id,))),
+            ('results_json', reverse('polls:results_json', args=(question.id,))),
+            ('search', reverse('polls:search') + '?' + urlencode({'q': question.question_text})),
+        ]
+        #a dashboard of the most voted questions
+        ids = Question.objects.published().order_by('-total_votes').values_list('pk', flat=True)[:50]
+        endpoints.append(('results_batch', reverse('polls:results_batch') + '?ids=' + ','.join(map(str, ids))))
+    if category is not None:
+        endpoints.append(('category', reverse('polls:category', args=(category.slug,))))
+    return endpoints
+
+
+def stream_url():
+    question = Question.objects.published().order_by('-total_votes').first()
+    return reverse('polls:results_stream', args=(question.id,))
+
+
+def admin_endpoints():
+    """
+    (name, url) of the question changelist, a changelist search and the change
+    form of the question with the most choices
+    """
+    changelist = reverse('admin:polls_question_changelist')
+    endpoints = [
+        ('admin_changelist', changelist),
+        ('admin_search', changelist + '?' + urlencode({'q': 'question 1'})),
+    ]
+    question = Question.objects.order_by('-choice_count').first()
+    if question is not None:
+        endpoints.append(('admin_change', reverse('admin:polls_question_change', args=(question.id,))))
+    return endpoints
+
+
+def admin_client():
+    #test client logged in as a benchmark superuser
+    user = User.objects.filter(username='bench-admin').first()
+    if user is None:
+        user = User.objects.create_superuser('bench-admin', 'bench-admin@example.com', None)
+    client = Client()
+    client.force_login(user)
+    return client
+
+
+def percentile(values, p):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(p / 100 * len(values)))]
+
+
+def summarize(latencies, queries, elapsed, errors):
+    return {
+        'requests': len(latencies),
+        'errors': errors,
+        'rps': round(len(latencies) / elapsed, 2) if elapsed else 0,
+        'p50_ms': round(percentile(latencies, 50) * 1000, 3),
+        'p95_ms': round(percentile(latencies, 95) * 1000, 3),
+        'p99_ms': round(percentile(latencies, 99) * 1000, 3),
+        'queries_per_request': round(sum(queries) / len(queries), 2),
+    }
+
+
+class ClientDriver:
+    #requests through django.test.Client, no network involved
+
+    def __init__(self, client=None):
+        self.client = client or Client()
+
+    def get(self, url):
+        response = self.client.get(url)
+        return response.status_code, response.get('Server-Timing', '')
+
+    def close(self):
+        pass
+
+
+class QuietHandler(WSGIRequestHandler):
+    def log_message(self, format, *args):
+        pass
+
+
+class WSGIServerDriver:
+    #requests over HTTP against a wsgiref server running in a thread
+
+    def __init__(self):
+        self.server = make_server('127.0.0.1', 0, WSGIHandler(), WSGIServer, QuietHandler)
+        self.thread = threading.Thread(target=self.server.serve_forever, daemon=True)
+        self.thread.start()
+        self.connection = http.client.HTTPConnection('127.0.0.1', self.server.server_port)
+
+    def get(self, url):
+        #the test environment only allows the 'testserver' host
+        self.connection.request('GET', url, headers={'Host': 'testserver'})
+        response = self.connection.getresponse()
+        response.read()
+        return response.status, response.getheader('Server-Timing', '')
+
+    def close(self):
+        self.connection.close()
+        self.server.shutdown()
+        self.server.server_close()
+
+
+def run_endpoint(driver, url, requests, warmup=10):
+    for i in range(warmup):
+        driver.get(url)
+    latencies = []
+    queries = []
+    errors = 0
+    start = time.perf_counter()
+    for i in range(requests):
+        request_start = time.perf_counter()
+        status, timing = driver.get(url)
+        latencies.append(time.perf_counter() - request_start)
+        match = QUERIES.search(timing)
+        queries.append(int(match.group(1)) if match else 0)
+        if status >= 400:
+            errors += 1
+    return summarize(latencies, queries, time.perf_counter() - start, errors)
+
+
+def run_benchmarks(driver, endpoints=None, requests=200, warmup=10):
+    return {
+        name: run_endpoint(driver, url, requests, warmup)
+        for name, url in (endpoints or default_endpoints())
+    }
+
+
+async def _open_streams(url, connections):
+    client = AsyncClient()
+    responses = await asyncio.gather(*(client.get(url) for i in range(connections)))
+    streams = [response.streaming_content for response in responses]
+    #the first event proves the stream is established and subscribed
+    await asyncio.gather(*(anext(stream) for stream in streams))
+    return streams
+
+
+def _measure_asgi(url, connections):
+    async def run():
+        tracemalloc.start()
+        streams = await _open_streams(url, connections)
+        memory = tracemalloc.get_traced_memory()[0]
+        threads = threading.active_count()
+        tracemalloc.stop()
+        for stream in streams:
+            await stream.aclose()
+        return memory, threads
+    #async_to_sync keeps the ORM calls of the views on this thread's connection
+    return async_to_sync(run)()
+
+
+def _measure_wsgi(url, connections):
+    #a worker thread per connection, held until every connection was served
+    release = threading.Event()
+    served = threading.Barrier(connections + 1)
+
+    def worker():
+        try:
+            Client().get(url)
+            served.wait()
+            release.wait()
+        finally:
+            db_connections.close_all()
+
+    tracemalloc.start()
+    workers = [threading.Thread(target=worker, daemon=True) for i in range(connections)]
+    for thread in workers:
+        thread.start()
+    served.wait()
+    memory = tracemalloc.get_traced_memory()[0]
+    threads = threading.active_count()
+    tracemalloc.stop()
+    release.set()
+    for thread in workers:
+        thread.join()
+    return memory, threads
+
+
+def measure_connections(mode, url, connections=100):
+    """
+    Hold the given number of connections open concurrently under 'asgi' (live results
+    streams) or 'wsgi' (a thread per request) and report Python heap and threads used
+    """
+    baseline_threads = threading.active_count()
+    start = time.perf_counter()
+    if mode == 'asgi':
+        memory, threads = _measure_asgi(url, connections)
+    else:
+        memory, threads = _measure_wsgi(url, connections)
+    return {
+        'connections': connections,
+        'open_s': round(time.perf_counter() - start, 3),
+        'threads': threads - baseline_threads,
+        #thread stacks are not traced, they come on top for wsgi (threading.stack_size())
+        'heap_kb_per_connection': round(memory / connections / 1024, 2),
+    }
+
+
+def vote_stress(question, threads=8, votes=100, shards=1):
+    """
+    Apply votes for the choices of a question from parallel threads, one vote per
+    transaction, with the given number of vote shards. The shards are rolled up and
+    removed again afterwards.
+    """
+    choice_ids = list(question.choice_set.values_list('pk', flat=True))
+    set_vote_shards(question.id, shards)
+    start_barrier = threading.Barrier(threads + 1)
+    retries = []
+
+    def worker(seed):
+        rng = random.Random(seed)
+        try:
+            start_barrier.wait()
+            for i in range(votes):
+                increments = {(question.id, rng.choice(choice_ids)): 1}
+                retry_on_lock(lambda: apply_vote_increments(increments), retries=50, delay=0.001,
+                              on_retry=lambda: retries.append(1))
+        finally:
+            db_connections.close_all()
+
+    workers = [threading.Thread(target=worker, args=(seed,)) for seed in range(threads)]
+    for thread in workers:
+        thread.start()
+    start_barrier.wait()
+    start = time.perf_counter()
+    for thread in workers:
+        thread.join()
+    elapsed = time.perf_counter() - start
+    rollup_vote_shards([question.id])
+    set_vote_shards(question.id, 1)
+    return {
+        'shards': shards,
+        'threads': threads,
+        'votes': threads * votes,
+        'votes_per_s': round(threads * votes / elapsed, 2),
+        'lock_retries': len(retries),
+    }
+
+
+def compare_results(results, baseline, threshold=0.1):
+    """
+    Return a description of every endpoint that got slower than the baseline by more
+    than the threshold (relative), in throughput, p95 latency or queries per request
+    """
+    regressions = []
+    for name, result in results.items():
+        base = baseline.get(name)
+        if base is None:
+            continue
+        if result['rps'] < base['rps'] * (1 - threshold):
+            regressions.append(f"{name}: {result['rps']} requests/s, baseline {base['rps']}")
+        if result['p95_ms'] > base['p95_ms'] * (1 + threshold):
+            regressions.append(f"{name}: p95 {result['p95_ms']}ms, baseline {base['p95_ms']}ms")
+        if result['queries_per_request'] > base['queries_per_request']:
+            regressions.append(
+                f"{name}: {result['queries_per_request']} queries/request, baseline {base['queries_per_request']}")
+    return regressions
+
+
+def ballot_ingest(batches=10, batch_size=10000, questions=200, seed=0):
+    """
+    Post batches of single-vote ballots for the choices of the newest published
+    questions to polls/ballots/ through the test client
+    """
+    rng = random.Random(seed)
+    question_ids = list(Question.objects.published().order_by('-pub_date').values_list('pk', flat=True)[:questions])
+    choices = list(Choice.objects.filter(question_id__in=question_ids).values_list('question_id', 'pk'))
+    key = secrets.token_urlsafe()
+    client = Client()
+    votes = 0
+    elapsed = 0
+    with override_settings(POLLS_BALLOT_API_KEYS=[key], POLLS_BALLOT_MAX_ITEMS=batch_size):
+        for i in range(batches):
+            body = json.dumps({'ballots': [[*rng.choice(choices), 1] for j in range(batch_size)]})
+            start = time.perf_counter()
+            response = client.post(
+                reverse('polls:ballots'), body, content_type='application/json', HTTP_AUTHORIZATION=f'Bearer {key}',
+            )
+            elapsed += time.perf_counter() - start
+            votes += response.json()['votes']
+    return {
+        'batches': batches,
+        'batch_size': batch_size,
+        'choices': len(choices),
+        'votes': votes,
+        'votes_per_s': round(votes / elapsed, 2),
+    }
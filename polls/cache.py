@@ -0,0 +1,230 @@
+# Read-through cache for a question together with its choices
+'''
+A question and its ordered choices are stored as one compact tuple under a
+versioned key:
+
+    polls:question:<generation>:<question id>:<version>
+
+The version of a question is bumped whenever the question, one of its choices
+or its votes change (see signals.py and votebuffer.py), the generation is bumped
+when categories change. Old entries are never served again and simply expire.
+Versions are derived from time.time_ns(), so a version lost from the cache is
+never reused and the version doubles as a modification timestamp. Reads create
+the version of a question only once it was found, unknown ids leave no keys behind.
+
+Writes bump the versions right away and once more when their transaction commits:
+a concurrent reader that misses the cache before the commit still reads the old
+rows and may store them under the first new version, the second one retires them.
+'''
+
+import threading
+import time
+
+from django.conf import settings
+from django.core.cache import caches
+from django.db import transaction
+
+from .models import MAX_ID, Question, Choice
+
+
+VERSION_KEY = 'polls:question-version:%s'
+GENERATION_KEY = 'polls:generation'
+ENTRY_KEY = 'polls:question:%s:%s:%s'
+
+
+def get_cache():
+    return caches[getattr(settings, 'POLLS_CACHE', 'default')]
+
+
+def cache_timeout():
+    return getattr(settings, 'POLLS_QUESTION_CACHE_TIMEOUT', 300)
+
+
+class CacheStats:
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def incr(self, name, amount=1):
+        with self._lock:
+            setattr(self, name, getattr(self, name) + amount)
+
+    def as_dict(self):
+        lookups = self.hits + self.misses
+        return {
+            'hits': self.hits,
+            'misses': self.misses,
+            'evictions': self.evictions,
+            'hit_ratio': self.hits / lookups if lookups else 0,
+        }
+
+
+stats = CacheStats()
+
+
+def cache_stats():
+    return stats.as_dict()
+
+
+def new_version():
+    return '%x' % time.time_ns()
+
+
+def version_timestamp(version):
+    """
+    Seconds since the epoch at which the version was created
+    """
+    return int(version, 16) / 1e9
+
+
+def get_versions(question_id, create=True):
+    """
+    Return (generation, version) of a question, creating them if they're unknown
+    (the version stays None with create=False)
+    """
+    cache = get_cache()
+    version_key = VERSION_KEY % question_id
+    values = cache.get_many([GENERATION_KEY, version_key])
+    generation = values.get(GENERATION_KEY)
+    version = values.get(version_key)
+    if generation is None:
+        cache.add(GENERATION_KEY, new_version(), None)
+        generation = cache.get(GENERATION_KEY)
+    if version is None and create:
+        cache.add(version_key, new_version(), None)
+        version = cache.get(version_key)
+    return generation, version
+
+
+async def aget_versions(question_id, create=True):
+    #async variant of get_versions() for the async views
+    cache = get_cache()
+    version_key = VERSION_KEY % question_id
+    values = await cache.aget_many([GENERATION_KEY, version_key])
+    generation = values.get(GENERATION_KEY)
+    version = values.get(version_key)
+    if generation is None:
+        await cache.aadd(GENERATION_KEY, new_version(), None)
+        generation = await cache.aget(GENERATION_KEY)
+    if version is None and create:
+        await cache.aadd(version_key, new_version(), None)
+        version = await cache.aget(version_key)
+    return generation, version
+
+
+def now_and_on_commit(func):
+    #runs func now, for reads in the writing transaction, and again after the commit (see above)
+    func()
+    if transaction.get_connection().in_atomic_block:
+        transaction.on_commit(func)
+
+
+def invalidate_question(*question_ids):
+    def bump():
+        get_cache().set_many({VERSION_KEY % pk: new_version() for pk in question_ids}, None)
+
+    now_and_on_commit(bump)
+    stats.incr('evictions', len(question_ids))
+
+
+def invalidate_all():
+    now_and_on_commit(lambda: get_cache().set(GENERATION_KEY, new_version(), None))
+    stats.incr('evictions')
+
+
+def _pack(question, choices):
+    return (
+        question.question_text,
+        question.pub_date,
+        question.question_category_id,
+        question.choice_count,
+        question.total_votes,
+        question.is_live,
+        tuple((choice.id, choice.choice_text, choice.votes) for choice in choices),
+    )
+
+
+def _unpack(question_id, blob):
+    question_text, pub_date, category_id, choice_count, total_votes, is_live, choice_rows = blob
+    question = Question(
+        id=question_id,
+        question_text=question_text,
+        pub_date=pub_date,
+        question_category_id=category_id,
+        choice_count=choice_count,
+        total_votes=total_votes,
+        is_live=is_live,
+    )
+    choices = [
+        Choice(id=choice_id, question_id=question_id, choice_text=choice_text, votes=votes)
+        for choice_id, choice_text, votes in choice_rows
+    ]
+    return question, choices
+
+
+def add_shard_votes(question, choices):
+    #counts including the votes of sharded counters that weren't rolled up yet (see shards.py)
+    for choice in choices:
+        choice.votes += choice.shard_votes
+        question.total_votes += choice.shard_votes
+
+
+def get_question_with_choices(question_id):
+    """
+    Return (question, ordered list of choices), from the cache if possible.
+    Raises Question.DoesNotExist for unknown ids.
+    """
+    question_id = int(question_id)
+    if not 1 <= question_id <= MAX_ID:
+        raise Question.DoesNotExist
+    cache = get_cache()
+    generation, version = get_versions(question_id, create=False)
+    if version is not None:
+        blob = cache.get(ENTRY_KEY % (generation, question_id, version))
+        if blob is not None:
+            stats.incr('hits')
+            return _unpack(question_id, blob)
+    stats.incr('misses')
+    #created before the rows are read, like the versions of writes
+    created = new_version()
+    #filled from the primary: a lagging replica would store old counts under the new version
+    question = Question.objects.using('default').get(pk=question_id)
+    choices = list(Choice.objects.using('default').filter(question_id=question_id).with_shard_votes().order_by('id'))
+    add_shard_votes(question, choices)
+    if version is None and not cache.add(VERSION_KEY % question_id, created, None):
+        #the question changed (or was read) meanwhile, the rows may be older than its version
+        return question, choices
+    cache.set(ENTRY_KEY % (generation, question_id, version or created), _pack(question, choices), cache_timeout())
+    return question, choices
+
+
+async def aget_question_with_choices(question_id):
+    #async variant of get_question_with_choices(), using the async cache and ORM interfaces
+    question_id = int(question_id)
+    if not 1 <= question_id <= MAX_ID:
+        raise Question.DoesNotExist
+    cache = get_cache()
+    generation, version = await aget_versions(question_id, create=False)
+    if version is not None:
+        blob = await cache.aget(ENTRY_KEY % (generation, question_id, version))
+        if blob is not None:
+            stats.incr('hits')
+            return _unpack(question_id, blob)
+    stats.incr('misses')
+    created = new_version()
+    question = await Question.objects.using('default').aget(pk=question_id)
+    choices = [
+        choice async for choice in
+        Choice.objects.using('default').filter(question_id=question_id).with_shard_votes().order_by('id')
+    ]
+    add_shard_votes(question, choices)
+    if version is None and not await cache.aadd(VERSION_KEY % question_id, created, None):
+        return question, choices
+    await cache.aset(ENTRY_KEY % (generation, question_id, version or created), _pack(question, choices), cache_timeout())
+    return question, choices
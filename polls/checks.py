@@ -0,0 +1,39 @@
+# System checks of the deployment settings, registered in PollsConfig.ready()
+'''
+The question cache, the page cache, the publication scheduler and the vote dedup
+store keep their state in the cache (or in memory). A per process cache is fine for
+one process, with several workers an invalidation, publication or dedup claim in
+one worker would never reach the others and they would keep serving stale results.
+'''
+
+from django.conf import settings
+from django.core import checks
+
+#backends whose entries live in one process only
+PER_PROCESS_BACKENDS = (
+    'django.core.cache.backends.locmem.LocMemCache',
+    'django.core.cache.backends.dummy.DummyCache',
+)
+
+
+@checks.register(checks.Tags.caches)
+def check_shared_cache(app_configs, **kwargs):
+    workers = getattr(settings, 'POLLS_WORKER_PROCESSES', 1)
+    if workers <= 1:
+        return []
+    errors = []
+    alias = getattr(settings, 'POLLS_CACHE', 'default')
+    backend = settings.CACHES.get(alias, {}).get('BACKEND')
+    if backend in PER_PROCESS_BACKENDS:
+        errors.append(checks.Error(
+            f'The polls cache {alias!r} ({backend}) is not shared by the {workers} worker processes.',
+            hint='Set DJANGO_CACHE_URL to a Redis or Memcached server.',
+            id='polls.E001',
+        ))
+    if getattr(settings, 'POLLS_VOTE_DEDUP', {}).get('BACKEND', 'memory') == 'memory':
+        errors.append(checks.Error(
+            f'The memory vote dedup store is not shared by the {workers} worker processes.',
+            hint="Use POLLS_VOTE_DEDUP['BACKEND'] = 'cache' with a shared cache.",
+            id='polls.E002',
+        ))
+    return errors
@@ -0,0 +1,61 @@
+# Maintenance of the denormalized Question.choice_count / Question.total_votes columns
+
+from django.db.models import Count, IntegerField, OuterRef, Subquery, Sum, Value
+from django.db.models.functions import Coalesce
+
+from .cache import invalidate_all, invalidate_question
+from .models import Question, Choice
+from .pagecache import bump_content_version
+
+
+def choice_count_subquery():
+    return Coalesce(Subquery(
+        Choice.objects.filter(question=OuterRef('pk'))
+        .order_by().values('question').annotate(n=Count('pk')).values('n'),
+        output_field=IntegerField(),
+    ), Value(0))
+
+
+def total_votes_subquery():
+    return Coalesce(Subquery(
+        Choice.objects.filter(question=OuterRef('pk'))
+        .order_by().values('question').annotate(n=Sum('votes')).values('n'),
+        output_field=IntegerField(),
+    ), Value(0))
+
+
+def update_question_counters(question_ids=None):
+    """
+    Recompute the counters from the Choice table with a single UPDATE.
+    Without question_ids every question is recomputed.
+    """
+    questions = Question.objects.all()
+    if question_ids is not None:
+        questions = questions.filter(pk__in=question_ids)
+    updated = questions.update(
+        choice_count=choice_count_subquery(),
+        total_votes=total_votes_subquery(),
+    )
+    if question_ids is None:
+        invalidate_all()
+    elif question_ids:
+        invalidate_question(*question_ids)
+    #the choice count decides whether a question is listed
+    bump_content_version()
+    return updated
+
+
+def find_counter_drift():
+    """
+    Return (question id, stored counters, actual counters) for every question whose
+    stored counters don't match the Choice table
+    """
+    questions = Question.objects.annotate(
+        actual_choice_count=choice_count_subquery(),
+        actual_total_votes=total_votes_subquery(),
+    ).values_list('pk', 'choice_count', 'total_votes', 'actual_choice_count', 'actual_total_votes')
+    return [
+        (pk, (choice_count, total_votes), (actual_choice_count, actual_total_votes))
+        for pk, choice_count, total_votes, actual_choice_count, actual_total_votes in questions.iterator()
+        if (choice_count, total_votes) != (actual_choice_count, actual_total_votes)
+    ]
@@ -0,0 +1,176 @@
+# Idempotency tokens for vote submissions
+'''
+Every rendering of the vote form carries a fresh random token. The vote handler
+claims the token before touching the database: a double click or a client retry
+sends the same token again and is answered with the results redirect right away,
+without a query or a write.
+
+Claimed tokens are kept in a bounded store, configured with POLLS_VOTE_DEDUP:
+    BACKEND      'memory' (per process) or 'cache' (shared, through the cache framework)
+    MAX_ENTRIES  memory backend: the oldest tokens are evicted beyond this
+    TTL          seconds a token is remembered
+    CACHE        cache alias of the cache backend
+'''
+
+import secrets
+import threading
+import time
+from collections import OrderedDict
+
+from django.conf import settings
+from django.core.cache import caches
+from django.core.signals import setting_changed
+from django.dispatch import receiver
+
+
+DEFAULTS = {
+    'BACKEND': 'memory',
+    'MAX_ENTRIES': 10000,
+    'TTL': 600,
+    'CACHE': 'default',
+}
+
+KEY = 'polls:vote-token:%s'
+
+#longer tokens are not ours, they're ignored rather than stored
+MAX_TOKEN_LENGTH = 64
+
+
+def new_vote_token():
+    return secrets.token_urlsafe(16)
+
+
+class DedupStats:
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.claims = 0
+        self.duplicates = 0
+        self.evictions = 0
+
+    def incr(self, name, amount=1):
+        with self._lock:
+            setattr(self, name, getattr(self, name) + amount)
+
+
+class MemoryDedupStore:
+    #claimed tokens in claim order, with a common TTL the oldest entries are always in front
+
+    def __init__(self, max_entries=10000, ttl=600):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.stats = DedupStats()
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def claim(self, token):
+        """
+        Remember the token, returns False if it was already claimed
+        """
+        now = time.monotonic()
+        with self._lock:
+            while self._entries and next(iter(self._entries.values())) <= now:
+                self._entries.popitem(last=False)
+            if token in self._entries:
+                self.stats.incr('duplicates')
+                return False
+            self._entries[token] = now + self.ttl
+            self.stats.incr('claims')
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+                self.stats.incr('evictions')
+            return True
+
+    def release(self, token):
+        #forget a token whose vote wasn't written, so the submission can be repeated
+        with self._lock:
+            self._entries.pop(token, None)
+
+    async def aclaim(self, token):
+        return self.claim(token)
+
+    async def arelease(self, token):
+        self.release(token)
+
+    @property
+    def entries(self):
+        return len(self._entries)
+
+
+class CacheDedupStore:
+    #shared by all processes using the cache, size limits are up to the cache backend
+
+    def __init__(self, cache='default', ttl=600):
+        self.cache = caches[cache]
+        self.ttl = ttl
+        self.stats = DedupStats()
+
+    def claim(self, token):
+        return self._counted(self.cache.add(KEY % token, 1, self.ttl))
+
+    def release(self, token):
+        self.cache.delete(KEY % token)
+
+    async def aclaim(self, token):
+        return self._counted(await self.cache.aadd(KEY % token, 1, self.ttl))
+
+    async def arelease(self, token):
+        await self.cache.adelete(KEY % token)
+
+    def _counted(self, added):
+        self.stats.incr('claims' if added else 'duplicates')
+        return added
+
+    @property
+    def entries(self):
+        #not known, the cache doesn't tell
+        return None
+
+
+def vote_token_key(request, question_id):
+    """
+    Dedup key of the token submitted with a vote, None without a (valid) token
+    """
+    token = request.POST.get('vote_token', '')
+    if not token or len(token) > MAX_TOKEN_LENGTH:
+        return None
+    return f'{question_id}:{token}'
+
+
+_store = None
+_store_lock = threading.Lock()
+
+
+def get_dedup_store():
+    """
+    Return the process wide dedup store, configured from settings.POLLS_VOTE_DEDUP
+    """
+    global _store
+    if _store is None:
+        with _store_lock:
+            if _store is None:
+                options = {**DEFAULTS, **getattr(settings, 'POLLS_VOTE_DEDUP', {})}
+                if options['BACKEND'] == 'cache':
+                    _store = CacheDedupStore(options['CACHE'], options['TTL'])
+                else:
+                    _store = MemoryDedupStore(options['MAX_ENTRIES'], options['TTL'])
+    return _store
+
+
+def dedup_stats():
+    store = get_dedup_store()
+    return {
+        'entries': store.entries,
+        'claims': store.stats.claims,
+        #every duplicate is a vote write that didn't happen
+        'writes_saved': store.stats.duplicates,
+        'evictions': store.stats.evictions,
+    }
+
+
+@receiver(setting_changed)
+def reset_dedup_store(setting, **kwargs):
+    #rebuild the store when the setting is overridden (tests)
+    global _store
+    if setting == 'POLLS_VOTE_DEDUP':
+        _store = None
@@ -0,0 +1,113 @@
+# Streaming export of all questions with their category, choices and votes
+'''
+Questions are read with QuerySet.iterator() and their choices are fetched with one
+query per chunk of questions, so memory usage is bounded by the chunk size and the
+first bytes are produced right away.
+
+csv:    one row per choice (a question without choices gets one row without choice)
+ndjson: one object per question, in the format accepted by import_polls
+'''
+
+import csv
+import json
+import zlib
+from itertools import groupby, islice
+
+from .models import Question, Choice
+
+
+CSV_HEADER = ['question_id', 'question_text', 'pub_date', 'category', 'choice_id', 'choice_text', 'votes']
+
+CONTENT_TYPES = {
+    'csv': 'text/csv',
+    'ndjson': 'application/x-ndjson',
+}
+
+
+def iter_question_chunks(chunk_size):
+    """
+    Yield lists of (question, choices) with at most chunk_size questions
+    """
+    questions = (
+        Question.objects.select_related('question_category')
+        .order_by('pk')
+        .iterator(chunk_size=chunk_size)
+    )
+    while True:
+        chunk = list(islice(questions, chunk_size))
+        if not chunk:
+            return
+        choices = (
+            Choice.objects.filter(question_id__in=[question.id for question in chunk])
+            .with_shard_votes()
+            .order_by('question_id', 'id')
+        )
+        choices_by_question = {
+            question_id: list(group)
+            for question_id, group in groupby(choices.iterator(), key=lambda choice: choice.question_id)
+        }
+        #counts including the votes of sharded counters, see shards.py
+        for question_choices in choices_by_question.values():
+            for choice in question_choices:
+                choice.votes += choice.shard_votes
+        yield [(question, choices_by_question.get(question.id, [])) for question in chunk]
+
+
+class LineBuffer:
+    #file-like object for csv.writer that just returns what is written
+    def write(self, value):
+        return value
+
+
+def iter_csv(chunk_size):
+    writer = csv.writer(LineBuffer())
+    yield writer.writerow(CSV_HEADER)
+    for chunk in iter_question_chunks(chunk_size):
+        rows = []
+        for question, choices in chunk:
+            category = question.question_category.slug if question.question_category else ''
+            columns = [question.id, question.question_text, question.pub_date.isoformat(), category]
+            for choice in choices or [None]:
+                if choice is None:
+                    rows.append(writer.writerow(columns + ['', '', '']))
+                else:
+                    rows.append(writer.writerow(columns + [choice.id, choice.choice_text, choice.votes]))
+        yield ''.join(rows)
+
+
+def iter_ndjson(chunk_size):
+    for chunk in iter_question_chunks(chunk_size):
+        lines = []
+        for question, choices in chunk:
+            category = question.question_category
+            lines.append(json.dumps({
+                'id': question.id,
+                'question_text': question.question_text,
+                'pub_date': question.pub_date.isoformat(),
+                'category': category.slug if category else None,
+                'category_name': category.name if category else None,
+                'choices': [
+                    {'id': choice.id, 'choice_text': choice.choice_text, 'votes': choice.votes}
+                    for choice in choices
+                ],
+            }) + '\n')
+        yield ''.join(lines)
+
+
+def gzip_stream(chunks):
+    #compresses on the fly, every chunk is flushed so the client receives data continuously
+    compressor = zlib.compressobj(6, zlib.DEFLATED, 31)
+    for chunk in chunks:
+        data = compressor.compress(chunk) + compressor.flush(zlib.Z_SYNC_FLUSH)
+        if data:
+            yield data
+    yield compressor.flush()
+
+
+def iter_export(format, chunk_size=1000, compress=False):
+    """
+    Yield the export as bytes
+    """
+    chunks = iter_csv(chunk_size) if format == 'csv' else iter_ndjson(chunk_size)
+    chunks = (chunk.encode() for chunk in chunks)
+    return gzip_stream(chunks) if compress else chunks
@@ -0,0 +1,139 @@
+# Bulk import of polls from JSONL or CSV files
+'''
+Records are read one at a time and inserted in chunks with bulk_create, so memory
+usage doesn't depend on the size of the input.
+
+JSONL: one object per line
+    {"question_text": "...", "pub_date": "2022-03-21T16:31:00", "category": "food",
+     "choices": ["Pizza", {"choice_text": "Pasta", "votes": 3}]}
+
+CSV: header question_text,pub_date,category,choices
+    choices are separated by '|'
+'''
+
+import csv
+import datetime
+import json
+
+from django.db import transaction
+from django.utils import timezone
+from django.utils.dateparse import parse_datetime
+
+from .models import Question, Choice, Category
+from .pagecache import bump_content_version
+from .scheduler import schedule_changed
+
+
+class RecordError(ValueError):
+    pass
+
+
+def read_jsonl(file):
+    for line_number, line in enumerate(file, 1):
+        line = line.strip()
+        if not line:
+            continue
+        try:
+            yield line_number, json.loads(line)
+        except json.JSONDecodeError as e:
+            raise RecordError(f'line {line_number}: {e}')
+
+
+def read_csv(file):
+    reader = csv.DictReader(file)
+    for row in reader:
+        choices = row.get('choices') or ''
+        row['choices'] = [choice for choice in choices.split('|') if choice]
+        yield reader.line_num, row
+
+
+def read_records(file, format):
+    """
+    Yield (line number, record) from an open text file
+    """
+    if format == 'csv':
+        return read_csv(file)
+    return read_jsonl(file)
+
+
+def parse_pub_date(value):
+    if isinstance(value, datetime.datetime):
+        pub_date = value
+    else:
+        pub_date = parse_datetime(value or '')
+        if pub_date is None:
+            raise ValueError(f'invalid pub_date {value!r}')
+    if timezone.is_naive(pub_date):
+        pub_date = timezone.make_aware(pub_date)
+    return pub_date
+
+
+def parse_choice(value):
+    if isinstance(value, str):
+        return value, 0
+    return value.get('choice_text') or value.get('text') or '', int(value.get('votes') or 0)
+
+
+class PollImporter:
+    """
+    Inserts chunks of records, resolving categories through an in-memory slug map
+    """
+
+    def __init__(self):
+        self.load_categories()
+
+    def load_categories(self):
+        self.categories = dict(Category.objects.values_list('slug', 'id'))
+
+    def category_id(self, slug, name=None):
+        if not slug:
+            return None
+        if slug not in self.categories:
+            category = Category.objects.create(name=name or slug.replace('-', ' ').title(), slug=slug)
+            self.categories[slug] = category.id
+        return self.categories[slug]
+
+    def import_chunk(self, records):
+        """
+        Insert the (line number, record) pairs in one transaction,
+        returns the number of inserted rows (questions and choices)
+        """
+        try:
+            return self._import_chunk(records)
+        except Exception:
+            #categories created in the rolled back transaction are gone
+            self.load_categories()
+            raise
+
+    def _import_chunk(self, records):
+        questions = []
+        question_choices = []
+        with transaction.atomic():
+            for line_number, record in records:
+                try:
+                    choices = [parse_choice(choice) for choice in record.get('choices') or []]
+                    pub_date = parse_pub_date(record.get('pub_date'))
+                    question = Question(
+                        question_text=record['question_text'],
+                        pub_date=pub_date,
+                        #bulk_create() doesn't call save(), future questions are published by the scheduler
+                        is_live=pub_date <= timezone.now(),
+                        question_category_id=self.category_id(record.get('category'), record.get('category_name')),
+                        choice_count=len(choices),
+                        total_votes=sum(votes for text, votes in choices),
+                    )
+                except (KeyError, TypeError, ValueError, AttributeError) as e:
+                    raise RecordError(f'line {line_number}: {e!r}')
+                questions.append(question)
+                question_choices.append(choices)
+            Question.objects.bulk_create(questions)
+            choices = [
+                Choice(question_id=question.id, choice_text=text, votes=votes)
+                for question, rows in zip(questions, question_choices)
+                for text, votes in rows
+            ]
+            Choice.objects.bulk_create(choices, batch_size=500)
+        #bulk_create() sends no signals, cached pages are refreshed here
+        bump_content_version()
+        schedule_changed()
+        return len(questions) + len(choices)
@@ -0,0 +1,176 @@
+# Live results: in-process pub/sub for vote count deltas
+'''
+The vote path publishes {choice_id: n} deltas per question with publish(), from any
+thread. For every question with connected viewers a single task on the event loop
+collects the published deltas once per tick (POLLS_LIVE_TICK_MS) and hands the
+combined frame to all subscribers. A viewer that falls behind gets its pending
+frames merged, so the cost per tick doesn't depend on the number of viewers and
+no viewer causes database queries.
+
+Every published batch gets the next sequence number of its channel. A viewer reads
+its first results with the hub's write_lock held (views.read_results()), which
+apply_vote_increments() holds while it writes and publishes votes, and keeps the
+sequence of those results: batches up to it are already counted and are dropped.
+
+Only ASGI servers keep the stream open, POLLS_LIVE_RESULTS turns the live updates of
+the results page on (by default with POLLS_ASYNC_VIEWS).
+'''
+
+import asyncio
+import threading
+from collections import defaultdict
+
+from django.conf import settings
+
+
+def tick_seconds():
+    return getattr(settings, 'POLLS_LIVE_TICK_MS', 500) / 1000
+
+
+def live_results_enabled():
+    return getattr(settings, 'POLLS_LIVE_RESULTS', False)
+
+
+def merge(batches):
+    deltas = defaultdict(int)
+    for sequence, batch in batches:
+        for choice_id, count in batch.items():
+            deltas[choice_id] += count
+    return dict(deltas)
+
+
+class Frame:
+    #the batches of one tick, merged once for all subscribers
+
+    def __init__(self, batches):
+        self.batches = batches
+        self.first = batches[0][0]
+        self.last = batches[-1][0]
+        self.deltas = merge(batches)
+
+    def deltas_after(self, sequence):
+        if sequence < self.first:
+            return self.deltas
+        #only for the frame a subscriber's first results fall into
+        return merge([batch for batch in self.batches if batch[0] > sequence])
+
+
+class Subscription:
+
+    def __init__(self):
+        self.frames = []
+        #batches up to this sequence are included in the results the viewer has
+        self.sequence = 0
+        self.event = asyncio.Event()
+
+    def push(self, frame):
+        self.frames.append(frame)
+        self.event.set()
+
+    async def next(self, timeout=None):
+        """
+        Wait for the next (merged) deltas not included in the viewer's results yet,
+        returns an empty dict on timeout
+        """
+        loop = asyncio.get_running_loop()
+        deadline = None if timeout is None else loop.time() + timeout
+        while True:
+            try:
+                await asyncio.wait_for(self.event.wait(), None if deadline is None else max(deadline - loop.time(), 0))
+            except asyncio.TimeoutError:
+                return {}
+            self.event.clear()
+            frames, self.frames = self.frames, []
+            deltas = merge(
+                (frame.last, frame.deltas_after(self.sequence)) for frame in frames
+            )
+            if frames:
+                self.sequence = max(self.sequence, frames[-1].last)
+            if deltas:
+                return deltas
+
+
+class ResultsChannel:
+
+    def __init__(self, hub, question_id):
+        self.hub = hub
+        self.question_id = question_id
+        self.subscribers = set()
+        self.pending = []
+        self.sequence = 0
+        self.lock = threading.Lock()
+        self.task = None
+
+    def publish(self, deltas):
+        with self.lock:
+            self.sequence += 1
+            self.pending.append((self.sequence, deltas))
+
+    async def run(self):
+        #one aggregation per tick for all subscribers of the question
+        while self.subscribers:
+            await asyncio.sleep(tick_seconds())
+            with self.lock:
+                batches, self.pending = self.pending, []
+            if batches:
+                self.hub.frames += 1
+                frame = Frame(batches)
+                for subscription in self.subscribers:
+                    subscription.push(frame)
+
+
+class LiveResultsHub:
+
+    def __init__(self):
+        self.channels = {}
+        self.frames = 0
+        #held while votes are written and published, and while first results are read
+        self.write_lock = threading.Lock()
+
+    def publish(self, question_id, deltas):
+        """
+        Publish vote deltas of a question, a no-op if nobody is watching it
+        """
+        channel = self.channels.get(question_id)
+        if channel is not None:
+            channel.publish(deltas)
+
+    def sequence(self, question_id):
+        #sequence of the last batch published for a question with viewers
+        channel = self.channels.get(question_id)
+        return channel.sequence if channel is not None else 0
+
+    def subscribe(self, question_id):
+        #has to be called from the event loop
+        channel = self.channels.get(question_id)
+        if channel is None:
+            channel = self.channels[question_id] = ResultsChannel(self, question_id)
+        subscription = Subscription()
+        channel.subscribers.add(subscription)
+        if channel.task is None or channel.task.done():
+            channel.task = asyncio.get_running_loop().create_task(channel.run())
+        return subscription
+
+    def unsubscribe(self, question_id, subscription):
+        channel = self.channels.get(question_id)
+        if channel is None:
+            return
+        channel.subscribers.discard(subscription)
+        if not channel.subscribers:
+            del self.channels[question_id]
+            if channel.task is not None:
+                channel.task.cancel()
+
+    def stats(self):
+        return {
+            'channels': len(self.channels),
+            'subscribers': sum(len(channel.subscribers) for channel in list(self.channels.values())),
+            'frames': self.frames,
+        }
+
+
+hub = LiveResultsHub()
+
+
+def live_stats():
+    return hub.stats()
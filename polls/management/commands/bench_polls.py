@@ -0,0 +1,100 @@
+# Benchmark the polls read paths on a seeded throwaway database, see polls/bench.py
+
+import json
+
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection
+from django.test.utils import setup_test_environment, teardown_test_environment
+
+from polls import bench
+from polls.models import Question
+
+
+class Command(BaseCommand):
+    help = 'Seed a benchmark dataset and report requests/s, latency percentiles and queries per request'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--preset', choices=sorted(bench.PRESETS), default='small',
+                            help='Dataset size: small (1k), medium (100k) or large (1M questions)')
+        parser.add_argument('--questions', type=int, help='Number of questions, overrides --preset')
+        parser.add_argument('--categories', type=int, default=20)
+        parser.add_argument('--seed', type=int, default=0, help='Random seed of the dataset')
+        parser.add_argument('--requests', type=int, default=200, help='Measured requests per endpoint')
+        parser.add_argument('--warmup', type=int, default=10, help='Unmeasured requests per endpoint')
+        parser.add_argument('--server', choices=['client', 'wsgi'], default='client',
+                            help='Drive the endpoints through the test client or a local WSGI server')
+        parser.add_argument('--admin', action='store_true',
+                            help='Also measure the question changelist and change form (through the test client)')
+        parser.add_argument('--connections', type=int, default=0,
+                            help='Also measure the cost of this many concurrent open connections under ASGI and WSGI')
+        parser.add_argument('--vote-stress', type=int, default=0, metavar='THREADS',
+                            help='Also measure parallel votes on one question from this many threads')
+        parser.add_argument('--vote-shards', type=int, default=16,
+                            help='Vote shards of the sharded run of --vote-stress (default 16)')
+        parser.add_argument('--ballots', type=int, default=0, metavar='BATCHES',
+                            help='Also measure bulk ballot ingestion with this many batches of 10000 votes')
+        parser.add_argument('--output', help='Write the results as JSON to this file')
+        parser.add_argument('--baseline', help='Compare with the results in this JSON file')
+        parser.add_argument('--threshold', type=float, default=0.1,
+                            help='Allowed relative regression against the baseline (default 0.1)')
+
+    def handle(self, *args, **options):
+        questions = options['questions'] or bench.PRESETS[options['preset']]
+        #the benchmark runs on a throwaway test database, like the test suite
+        setup_test_environment()
+        old_name = connection.creation.create_test_db(verbosity=0, autoclobber=True)
+        try:
+            self.stderr.write(f'Seeding {questions} questions...')
+            bench.seed_dataset(questions, options['categories'], seed=options['seed'])
+            driver = bench.WSGIServerDriver() if options['server'] == 'wsgi' else bench.ClientDriver()
+            try:
+                results = bench.run_benchmarks(driver, requests=options['requests'], warmup=options['warmup'])
+            finally:
+                driver.close()
+            if options['admin']:
+                results.update(bench.run_benchmarks(
+                    bench.ClientDriver(bench.admin_client()), bench.admin_endpoints(),
+                    requests=options['requests'], warmup=options['warmup'],
+                ))
+            if options['connections']:
+                url = bench.stream_url()
+                connections = {
+                    mode: bench.measure_connections(mode, url, options['connections'])
+                    for mode in ('asgi', 'wsgi')
+                }
+            if options['vote_stress']:
+                question = Question.objects.published().order_by('-total_votes').first()
+                vote_stress = {
+                    name: bench.vote_stress(question, threads=options['vote_stress'], shards=shards)
+                    for name, shards in (('single_row', 1), ('sharded', options['vote_shards']))
+                }
+            if options['ballots']:
+                ballots = bench.ballot_ingest(batches=options['ballots'])
+        finally:
+            connection.creation.destroy_test_db(old_name, verbosity=0)
+            teardown_test_environment()
+
+        report = {
+            'dataset': {'questions': questions, 'categories': options['categories'], 'seed': options['seed']},
+            'server': options['server'],
+            'endpoints': results,
+        }
+        if options['connections']:
+            report['connections'] = connections
+        if options['vote_stress']:
+            report['vote_stress'] = vote_stress
+        if options['ballots']:
+            report['ballots'] = ballots
+        output = json.dumps(report, indent=2)
+        if options['output']:
+            with open(options['output'], 'w') as f:
+                f.write(output)
+        self.stdout.write(output)
+
+        if options['baseline']:
+            with open(options['baseline']) as f:
+                baseline = json.load(f)
+            regressions = bench.compare_results(results, baseline['endpoints'], options['threshold'])
+            if regressions:
+                raise CommandError('Performance regressions:\n' + '\n'.join(regressions))
+            self.stderr.write(self.style.SUCCESS('No regressions against the baseline'))
@@ -0,0 +1,43 @@
+# Measure the cold start of the WSGI and ASGI applications, see polls/startup.py
+
+import json
+import os
+import tempfile
+
+from django.core.management.base import BaseCommand, CommandError
+
+from polls import startup
+
+
+class Command(BaseCommand):
+    help = 'Report import times, application load time and first request latency of fresh interpreters'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--url', default='/polls/', help='Path of the measured request (default /polls/)')
+        parser.add_argument('--runs', type=int, default=3, help='Fresh interpreters per application (default 3)')
+        parser.add_argument('--database',
+                            help='Sqlite file to serve from, by default a migrated throwaway database')
+        parser.add_argument('--output', help='Write the results as JSON to this file')
+        parser.add_argument('--check', action='store_true',
+                            help='Fail if the results exceed polls.startup.STARTUP_BUDGET or unwanted modules are imported')
+
+    def handle(self, *args, **options):
+        with tempfile.TemporaryDirectory() as directory:
+            database = options['database']
+            if database is None:
+                database = os.path.join(directory, 'db.sqlite3')
+                self.stderr.write('Migrating a throwaway database...')
+                startup.prepare_database(database)
+            results = startup.measure_startup(options['url'], options['runs'], database)
+
+        output = json.dumps(results, indent=2)
+        if options['output']:
+            with open(options['output'], 'w') as f:
+                f.write(output)
+        self.stdout.write(output)
+
+        if options['check']:
+            problems = startup.check_budget(results)
+            if problems:
+                raise CommandError('Startup budget exceeded:\n' + '\n'.join(problems))
+            self.stderr.write(self.style.SUCCESS('Within the startup budget'))
@@ -0,0 +1,27 @@
+# Verify (and optionally repair) the denormalized counters of questions
+
+from django.core.management.base import BaseCommand
+
+from polls.counters import find_counter_drift, update_question_counters
+
+
+class Command(BaseCommand):
+    help = 'Compare Question.choice_count/total_votes with the Choice table and repair drift'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--repair', action='store_true', help='Recompute the counters of drifted questions')
+
+    def handle(self, *args, **options):
+        drift = find_counter_drift()
+        for pk, stored, actual in drift:
+            self.stdout.write(
+                f'Question {pk}: stored choice_count={stored[0]} total_votes={stored[1]}, '
+                f'actual choice_count={actual[0]} total_votes={actual[1]}'
+            )
+        if not drift:
+            self.stdout.write(self.style.SUCCESS('All question counters are in sync'))
+        elif options['repair']:
+            update_question_counters([pk for pk, stored, actual in drift])
+            self.stdout.write(self.style.SUCCESS(f'Repaired {len(drift)} question(s)'))
+        else:
+            self.stdout.write(self.style.WARNING(f'{len(drift)} question(s) drifted, run with --repair to fix'))
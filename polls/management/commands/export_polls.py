@@ -0,0 +1,31 @@
+# Stream all questions with their choices and votes to a file or stdout, see polls/export.py
+
+from django.conf import settings
+from django.core.management.base import BaseCommand
+
+from polls.export import CONTENT_TYPES, iter_export
+
+
+class Command(BaseCommand):
+    help = 'Export questions, categories, choices and votes as CSV or NDJSON'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--format', choices=sorted(CONTENT_TYPES), default='csv')
+        parser.add_argument('--gzip', action='store_true', help='Compress the output')
+        parser.add_argument('--chunk-size', type=int, default=getattr(settings, 'POLLS_EXPORT_CHUNK_SIZE', 1000))
+        parser.add_argument('-o', '--output', help='Output file (default: stdout)')
+
+    def handle(self, *args, **options):
+        chunks = iter_export(options['format'], options['chunk_size'], options['gzip'])
+        if options['output']:
+            with open(options['output'], 'wb') as f:
+                for chunk in chunks:
+                    f.write(chunk)
+        elif hasattr(self.stdout, 'buffer'):
+            for chunk in chunks:
+                self.stdout.buffer.write(chunk)
+            self.stdout.buffer.flush()
+        else:
+            #text stream without binary buffer (e.g. StringIO)
+            for chunk in chunks:
+                self.stdout.write(chunk.decode(), ending='')
@@ -0,0 +1,67 @@
+# Stream a JSONL or CSV file of polls into the database, see polls/importer.py for the format
+
+import json
+import os
+import time
+from itertools import islice
+
+from django.core.management.base import BaseCommand, CommandError
+
+from polls.importer import PollImporter, RecordError, read_records
+
+
+class Command(BaseCommand):
+    help = 'Import questions with their choices and categories from a JSONL or CSV file'
+
+    def add_arguments(self, parser):
+        parser.add_argument('path', help='JSONL or CSV file')
+        parser.add_argument('--format', choices=['jsonl', 'csv'], help='Input format (default: from the file extension)')
+        parser.add_argument('--chunk-size', type=int, default=1000, help='Questions per transaction')
+        parser.add_argument('--checkpoint', help='Checkpoint file (default: <path>.checkpoint)')
+        parser.add_argument('--restart', action='store_true', help='Ignore an existing checkpoint')
+
+    def handle(self, *args, **options):
+        path = options['path']
+        format = options['format'] or ('csv' if path.lower().endswith('.csv') else 'jsonl')
+        chunk_size = options['chunk_size']
+        checkpoint = options['checkpoint'] or f'{path}.checkpoint'
+        if chunk_size < 1:
+            raise CommandError('--chunk-size has to be positive')
+
+        #records that were committed by a previous, failed run are skipped
+        done = 0
+        if os.path.exists(checkpoint) and not options['restart']:
+            with open(checkpoint) as f:
+                done = json.load(f)['records']
+            self.stdout.write(f'Resuming after {done} records')
+
+        importer = PollImporter()
+        imported_rows = 0
+        start = time.perf_counter()
+        try:
+            with open(path, newline='', encoding='utf-8') as file:
+                records = islice(read_records(file, format), done, None)
+                while True:
+                    chunk = list(islice(records, chunk_size))
+                    if not chunk:
+                        break
+                    imported_rows += importer.import_chunk(chunk)
+                    done += len(chunk)
+                    self.write_checkpoint(checkpoint, done)
+                    elapsed = time.perf_counter() - start
+                    self.stdout.write(f'{done} records, {imported_rows / elapsed:.0f} rows/s')
+        except (OSError, RecordError) as e:
+            raise CommandError(f'Import stopped after {done} records: {e}')
+
+        if os.path.exists(checkpoint):
+            os.remove(checkpoint)
+        elapsed = time.perf_counter() - start
+        self.stdout.write(self.style.SUCCESS(
+            f'Imported {imported_rows} rows in {elapsed:.1f}s ({imported_rows / max(elapsed, 1e-9):.0f} rows/s)'
+        ))
+
+    def write_checkpoint(self, checkpoint, records):
+        #write and rename, so a crash never leaves a broken checkpoint
+        with open(f'{checkpoint}.tmp', 'w') as f:
+            json.dump({'records': records}, f)
+        os.replace(f'{checkpoint}.tmp', checkpoint)
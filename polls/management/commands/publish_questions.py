@@ -0,0 +1,28 @@
+# Publish questions whose pub_date has been reached, see polls/scheduler.py
+
+import time
+
+from django.core.management.base import BaseCommand
+from django.db import close_old_connections
+
+from polls.scheduler import publish_due, scheduler_settings, seconds_until_next
+
+
+class Command(BaseCommand):
+    help = 'Make questions whose pub_date has been reached live, once or in a loop until the next publication'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--loop', action='store_true',
+                            help='Keep running, sleeping until the next publication')
+        parser.add_argument('--max-sleep', type=float, default=None,
+                            help='Seconds to sleep at most between checks (default POLLS_SCHEDULER MAX_SLEEP)')
+
+    def handle(self, *args, **options):
+        max_sleep = options['max_sleep'] or scheduler_settings()['MAX_SLEEP']
+        while True:
+            question_ids = publish_due()
+            self.stdout.write(f'Published {len(question_ids)} question(s)')
+            if not options['loop']:
+                break
+            time.sleep(seconds_until_next(max_sleep))
+            close_old_connections()
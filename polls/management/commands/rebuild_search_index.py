@@ -0,0 +1,15 @@
+# Rebuild the full-text search index of questions, see polls/search.py
+
+from django.core.management.base import BaseCommand, CommandError
+
+from polls.search import rebuild_search_index, search_available
+
+
+class Command(BaseCommand):
+    help = 'Repopulate the FTS5 search table from the question table'
+
+    def handle(self, *args, **options):
+        if not search_available():
+            raise CommandError('The full-text search index is only available on SQLite')
+        count = rebuild_search_index()
+        self.stdout.write(self.style.SUCCESS(f'Indexed {count} question(s)'))
@@ -0,0 +1,33 @@
+# Fold sharded vote counters into Choice.votes, or change the shards of a question
+
+from django.core.management.base import BaseCommand, CommandError
+
+from polls.models import Question
+from polls.shards import rollup_vote_shards, set_vote_shards
+
+
+class Command(BaseCommand):
+    help = 'Roll up the votes of sharded counters into Choice.votes and Question.total_votes'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--question', type=int, action='append', dest='questions',
+                            help='Only roll up this question (can be repeated)')
+        parser.add_argument('--set-shards', type=int,
+                            help='Change the number of vote shards of the given questions (1 => no sharding)')
+
+    def handle(self, *args, **options):
+        questions = options['questions']
+        if options['set_shards'] is not None:
+            if not questions:
+                raise CommandError('--set-shards requires --question')
+            if options['set_shards'] < 1:
+                raise CommandError('--set-shards has to be at least 1')
+            for question_id in questions:
+                if not Question.objects.filter(pk=question_id).exists():
+                    raise CommandError(f'Question {question_id} does not exist')
+                set_vote_shards(question_id, options['set_shards'])
+            self.stdout.write(self.style.SUCCESS(
+                f"Question(s) {', '.join(map(str, questions))} use {options['set_shards']} vote shard(s)"))
+            return
+        votes = rollup_vote_shards(questions)
+        self.stdout.write(self.style.SUCCESS(f'Rolled up {votes} vote(s)'))
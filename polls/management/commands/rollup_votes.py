@@ -0,0 +1,13 @@
+# Compact the vote event log into hourly and daily buckets, see polls/trends.py
+
+from django.core.management.base import BaseCommand
+
+from polls.trends import rollup_votes
+
+
+class Command(BaseCommand):
+    help = 'Roll up closed hours of the vote event log and prune events past the retention window'
+
+    def handle(self, *args, **options):
+        buckets, pruned = rollup_votes()
+        self.stdout.write(self.style.SUCCESS(f'Rolled up {buckets} hourly bucket(s), pruned {pruned} event(s)'))
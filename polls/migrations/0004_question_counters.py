@@ -0,0 +1,38 @@
+# Generated by Django 4.2.30 on 2026-10-18 08:08
+
+from django.db import migrations, models
+from django.db.models import Count, IntegerField, OuterRef, Subquery, Sum, Value
+from django.db.models.functions import Coalesce
+
+
+def backfill_counters(apps, schema_editor):
+    Question = apps.get_model('polls', 'Question')
+    Choice = apps.get_model('polls', 'Choice')
+    choices = Choice.objects.filter(question=OuterRef('pk')).order_by().values('question')
+    Question.objects.update(
+        choice_count=Coalesce(Subquery(
+            choices.annotate(n=Count('pk')).values('n'), output_field=IntegerField()), Value(0)),
+        total_votes=Coalesce(Subquery(
+            choices.annotate(n=Sum('votes')).values('n'), output_field=IntegerField()), Value(0)),
+    )
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('polls', '0003_question_question_category_alter_category_name'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='question',
+            name='choice_count',
+            field=models.IntegerField(default=0, editable=False),
+        ),
+        migrations.AddField(
+            model_name='question',
+            name='total_votes',
+            field=models.IntegerField(default=0, editable=False),
+        ),
+        migrations.RunPython(backfill_counters, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,31 @@
+# Generated by Django 4.2.30 on 2026-10-18 08:08
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('polls', '0004_question_counters'),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name='category',
+            name='name',
+            field=models.CharField(db_index=True, default='', max_length=100),
+        ),
+        migrations.AlterField(
+            model_name='category',
+            name='slug',
+            field=models.SlugField(unique=True),
+        ),
+        migrations.AddIndex(
+            model_name='question',
+            index=models.Index(fields=['-pub_date'], name='polls_question_pub_date_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='question',
+            index=models.Index(fields=['question_category', 'pub_date'], name='polls_question_cat_pub_idx'),
+        ),
+    ]
@@ -0,0 +1,32 @@
+# Generated by Django 4.2.30 on 2026-10-18 08:22
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('polls', '0005_access_path_indexes'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='question',
+            name='vote_shards',
+            field=models.PositiveSmallIntegerField(default=1),
+        ),
+        migrations.CreateModel(
+            name='ChoiceVoteShard',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('shard', models.PositiveSmallIntegerField()),
+                ('votes', models.IntegerField(default=0)),
+                ('choice', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='vote_shards', to='polls.choice')),
+            ],
+        ),
+        migrations.AddConstraint(
+            model_name='choicevoteshard',
+            constraint=models.UniqueConstraint(fields=('choice', 'shard'), name='polls_choice_vote_shard_unique'),
+        ),
+    ]
@@ -0,0 +1,75 @@
+# Full-text search index of questions (SQLite FTS5), see polls/search.py
+
+from django.db import migrations
+
+
+CREATE_SQL = [
+    """
+    CREATE VIRTUAL TABLE polls_question_fts USING fts5(
+        question_text, category_name, tokenize='unicode61 remove_diacritics 2'
+    )
+    """,
+    #triggers instead of signals, so bulk_create() and update() are covered as well
+    """
+    CREATE TRIGGER polls_question_fts_insert AFTER INSERT ON polls_question BEGIN
+        INSERT INTO polls_question_fts (rowid, question_text, category_name) VALUES (
+            new.id, new.question_text,
+            COALESCE((SELECT name FROM polls_category WHERE id = new.question_category_id), '')
+        );
+    END
+    """,
+    """
+    CREATE TRIGGER polls_question_fts_update AFTER UPDATE OF question_text, question_category_id ON polls_question BEGIN
+        DELETE FROM polls_question_fts WHERE rowid = old.id;
+        INSERT INTO polls_question_fts (rowid, question_text, category_name) VALUES (
+            new.id, new.question_text,
+            COALESCE((SELECT name FROM polls_category WHERE id = new.question_category_id), '')
+        );
+    END
+    """,
+    """
+    CREATE TRIGGER polls_question_fts_delete AFTER DELETE ON polls_question BEGIN
+        DELETE FROM polls_question_fts WHERE rowid = old.id;
+    END
+    """,
+    """
+    CREATE TRIGGER polls_category_fts_update AFTER UPDATE OF name ON polls_category BEGIN
+        UPDATE polls_question_fts SET category_name = new.name
+        WHERE rowid IN (SELECT id FROM polls_question WHERE question_category_id = new.id);
+    END
+    """,
+    """
+    INSERT INTO polls_question_fts (rowid, question_text, category_name)
+    SELECT q.id, q.question_text, COALESCE(c.name, '')
+    FROM polls_question q LEFT JOIN polls_category c ON c.id = q.question_category_id
+    """,
+]
+
+DROP_SQL = [
+    'DROP TRIGGER IF EXISTS polls_category_fts_update',
+    'DROP TRIGGER IF EXISTS polls_question_fts_delete',
+    'DROP TRIGGER IF EXISTS polls_question_fts_update',
+    'DROP TRIGGER IF EXISTS polls_question_fts_insert',
+    'DROP TABLE IF EXISTS polls_question_fts',
+]
+
+
+def run_sql(statements):
+    def run(apps, schema_editor):
+        #FTS5 is SQLite only, other databases fall back to LIKE searches
+        if schema_editor.connection.vendor != 'sqlite':
+            return
+        for statement in statements:
+            schema_editor.execute(statement)
+    return run
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('polls', '0007_vote_events'),
+    ]
+
+    operations = [
+        migrations.RunPython(run_sql(CREATE_SQL), run_sql(DROP_SQL)),
+    ]
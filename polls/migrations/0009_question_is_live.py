@@ -0,0 +1,39 @@
+# Generated by Django 4.2.30 on 2026-10-18 08:42
+
+from importlib import import_module
+
+from django.db import migrations, models
+from django.utils import timezone
+
+#adding a column makes SQLite rebuild the question table, which drops the
+#triggers of the search index, they are created again afterwards
+search = import_module('polls.migrations.0008_question_search')
+CREATE_TRIGGERS = search.CREATE_SQL[1:5]
+DROP_TRIGGERS = search.DROP_SQL[:4]
+
+
+def backfill_is_live(apps, schema_editor):
+    Question = apps.get_model('polls', 'Question')
+    Question.objects.filter(pub_date__lte=timezone.now()).update(is_live=True)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('polls', '0008_question_search'),
+    ]
+
+    operations = [
+        migrations.RunPython(search.run_sql(DROP_TRIGGERS), search.run_sql(CREATE_TRIGGERS)),
+        migrations.AddField(
+            model_name='question',
+            name='is_live',
+            field=models.BooleanField(default=False, editable=False),
+        ),
+        migrations.RunPython(backfill_is_live, migrations.RunPython.noop),
+        migrations.AddIndex(
+            model_name='question',
+            index=models.Index(fields=['is_live', 'pub_date'], name='polls_question_live_pub_idx'),
+        ),
+        migrations.RunPython(search.run_sql(CREATE_TRIGGERS), search.run_sql(DROP_TRIGGERS)),
+    ]
@@ -2,26 +2,35 @@
 # With these classes, django is able to create a python DB-access API
 
 import datetime
-from email.policy import default
-from xmlrpc.client import boolean
 
 from django.db import models
+from django.db.models import OuterRef, Subquery, Sum, Value
+from django.db.models.functions import Coalesce
 from django.utils import timezone
-from django.contrib import admin
 
 
+#ids are 64-bit signed integers (BigAutoField), larger numbers can't even be looked up
+MAX_ID = 2 ** 63 - 1
+
 
 class Category(models.Model):
     #fields
-    name = models.CharField(max_length=100, default='')
-    #slug for readable url paths
-    slug = models.SlugField()
+    name = models.CharField(max_length=100, default='', db_index=True)
+    #slug for readable url paths, unique since categories are looked up by it
+    slug = models.SlugField(unique=True)
 
     #methods
     def __str__(self):
         return self.name
 
 
+class QuestionQuerySet(models.QuerySet):
+
+    def published(self):
+        #questions visible to the public: live (see scheduler.py) and with at least 2 choices
+        return self.filter(is_live=True, choice_count__gte=2)
+
+
 class Question(models.Model):
     #fields
     question_text = models.CharField(max_length=200)
@@ -34,32 +43,135 @@ class Question(models.Model):
     hence ForeignKey is used here.
     """
     question_category = models.ForeignKey(Category, null=True, blank=True, default='', on_delete=models.SET_DEFAULT)
+    #denormalized counters
+    """
+    Kept in sync by the signal handlers in signals.py and by the vote buffer,
+    so listing pages don't have to count choices with a GROUP BY.
+    Use counters.update_question_counters() after bulk operations.
+    """
+    choice_count = models.IntegerField(default=0, editable=False)
+    total_votes = models.IntegerField(default=0, editable=False)
+    #number of ChoiceVoteShard rows per choice votes are spread over (1 => Choice.votes directly)
+    """
+    Meant for questions that get lots of votes at once, see shards.py.
+    Use shards.set_vote_shards() to change it, so the shard rows exist up front.
+    """
+    vote_shards = models.PositiveSmallIntegerField(default=1)
+    #pub_date has been reached
+    """
+    Set on save and flipped by the publication scheduler (scheduler.py) when the
+    pub_date of a future question arrives, so listings don't depend on the current time.
+    """
+    is_live = models.BooleanField(default=False, editable=False)
+
+    objects = QuestionQuerySet.as_manager()
+
+    class Meta:
+        #indexes matching the access paths of the views
+        indexes = [
+            #index page: newest published questions first
+            models.Index(fields=['-pub_date'], name='polls_question_pub_date_idx'),
+            #category page: questions of a category ordered by date
+            models.Index(fields=['question_category', 'pub_date'], name='polls_question_cat_pub_idx'),
+            #scheduler: the next question to publish
+            models.Index(fields=['is_live', 'pub_date'], name='polls_question_live_pub_idx'),
+        ]
 
     #methods
     def __str__(self):
         return self.question_text
 
-    #change column header in admin page
-    @admin.display(
-        boolean=True,
-        ordering='pub_date',
-        description='Published recently?',
-    )
+    def save(self, *args, **kwargs):
+        self.is_live = self.pub_date <= timezone.now()
+        #the counters are maintained in the database, stale in-memory values must not be written back
+        if not self._state.adding and kwargs.get('update_fields') is None:
+            kwargs['update_fields'] = [
+                field.name for field in self._meta.concrete_fields
+                if not field.primary_key and field.name not in ('choice_count', 'total_votes')
+            ]
+        elif kwargs.get('update_fields') is not None and 'pub_date' in kwargs['update_fields']:
+            #is_live follows pub_date
+            kwargs['update_fields'] = {*kwargs['update_fields'], 'is_live'}
+        super().save(*args, **kwargs)
+
+    def is_published(self):
+        #same rules as QuestionQuerySet.published(), for questions already loaded
+        return self.is_live and self.choice_count >= 2
 
     def was_published_recently(self):
         now = timezone.now()
         return now - datetime.timedelta(days=1) <= self.pub_date <= now
+
+    #change column header in admin page
+    """
+    Set as attributes rather than with @admin.display, so loading the models
+    doesn't import the admin.
+    """
+    was_published_recently.boolean = True
+    was_published_recently.admin_order_field = 'pub_date'
+    was_published_recently.short_description = 'Published recently?'
     
 
 
+class ChoiceQuerySet(models.QuerySet):
+
+    def with_shard_votes(self):
+        #votes of sharded counters that haven't been rolled up into Choice.votes yet
+        return self.annotate(shard_votes=Coalesce(Subquery(
+            ChoiceVoteShard.objects.filter(choice=OuterRef('pk'))
+            .order_by().values('choice').annotate(n=Sum('votes')).values('n'),
+            output_field=models.IntegerField(),
+        ), Value(0)))
+
+
 class Choice(models.Model):
     #fields
     question = models.ForeignKey(Question, on_delete=models.CASCADE)
     choice_text = models.CharField(max_length=200)
+    #votes that were rolled up, sharded questions keep newer votes in ChoiceVoteShard
     votes = models.IntegerField(default=0)
 
+    objects = ChoiceQuerySet.as_manager()
+
     #methods
     def __str__(self):
         return self.choice_text
 
 
+class ChoiceVoteShard(models.Model):
+    #one of Question.vote_shards counters of a choice, see shards.py
+    choice = models.ForeignKey(Choice, on_delete=models.CASCADE, related_name='vote_shards')
+    shard = models.PositiveSmallIntegerField()
+    votes = models.IntegerField(default=0)
+
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(fields=['choice', 'shard'], name='polls_choice_vote_shard_unique'),
+        ]
+
+    def __str__(self):
+        return f'{self.choice} #{self.shard}'
+
+
+
+
+class VoteEvent(models.Model):
+    #append-only log of flushed votes, one row per choice and flush (see trends.py)
+    choice = models.ForeignKey(Choice, on_delete=models.CASCADE)
+    created_at = models.DateTimeField(default=timezone.now, db_index=True)
+    count = models.PositiveIntegerField(default=1)
+
+
+class VoteRollup(models.Model):
+    #votes of a choice per hour or day, compacted from VoteEvent (see trends.py)
+    PERIODS = [('hour', 'Hour'), ('day', 'Day')]
+
+    choice = models.ForeignKey(Choice, on_delete=models.CASCADE)
+    period = models.CharField(max_length=4, choices=PERIODS)
+    bucket = models.DateTimeField()
+    votes = models.IntegerField(default=0)
+
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(fields=['choice', 'period', 'bucket'], name='polls_vote_rollup_unique'),
+        ]
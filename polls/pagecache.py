@@ -0,0 +1,273 @@
+# Full-page cache of the index and category pages
+'''
+The index and category pages are the same for every visitor, the rendered
+response is cached under its URL:
+
+    polls:page:<md5 of the path and key_params>  ->  (content version, expires at, content, content type)
+
+Only the query parameters a view reads (key_params of cached_page()) are part of
+the key, other parameters are served the same cached entry.
+
+The content version is bumped (bump_content_version()) whenever a question, a
+choice or a category changes or questions go live (see signals.py and
+scheduler.py). An entry is fresh while it is not expired and was rendered for
+the current content version, the pages don't depend on the current time.
+
+Regeneration is single-flight: the first request finding a stale entry takes a
+lock (cache.add) and renders the page, concurrent requests keep serving the stale
+copy meanwhile instead of all running the same queries. Entries are kept for
+STALE seconds after they expire for this. Without any copy (cold cache), requests
+wait up to WAIT_MS for the lock holder before rendering the page themselves.
+The lock holder reads from the primary database: a lagging replica would store an
+old page under the new content version.
+
+Configured with POLLS_PAGE_CACHE:
+    ENABLED       False disables the cache
+    TIMEOUT       seconds a page is fresh
+    STALE         seconds an expired page may still be served while it is rebuilt
+    LOCK_TIMEOUT  seconds after which the lock of a crashed worker is released
+    WAIT_MS       how long requests wait for the first rendering of a page
+'''
+
+import asyncio
+import hashlib
+import threading
+import time
+from functools import wraps
+from urllib.parse import urlencode
+
+from asgiref.sync import iscoroutinefunction
+from django.conf import settings
+from django.http import HttpResponse
+from django.utils.cache import has_vary_header
+from mysite.routers import primary_reads
+
+from .cache import get_cache, new_version, now_and_on_commit
+from .scheduler import aensure_published, ensure_published
+
+
+DEFAULTS = {
+    'ENABLED': True,
+    'TIMEOUT': 300,
+    'STALE': 300,
+    'LOCK_TIMEOUT': 10,
+    'WAIT_MS': 1000,
+}
+
+VERSION_KEY = 'polls:content-version'
+PAGE_KEY = 'polls:page:%s'
+LOCK_KEY = 'polls:page-lock:%s'
+
+POLL_INTERVAL = 0.01
+
+
+def page_cache_settings():
+    return {**DEFAULTS, **getattr(settings, 'POLLS_PAGE_CACHE', {})}
+
+
+class PageCacheStats:
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        self.hits = 0
+        self.stale = 0
+        self.misses = 0
+        self.regenerations = 0
+        self.regeneration_ms = 0.0
+        self.max_regeneration_ms = 0.0
+
+    def incr(self, name, amount=1):
+        with self._lock:
+            setattr(self, name, getattr(self, name) + amount)
+
+    def regenerated(self, ms):
+        with self._lock:
+            self.regenerations += 1
+            self.regeneration_ms += ms
+            self.max_regeneration_ms = max(self.max_regeneration_ms, ms)
+
+    def as_dict(self):
+        lookups = self.hits + self.stale + self.misses
+        return {
+            'hits': self.hits,
+            'stale': self.stale,
+            'misses': self.misses,
+            #stale copies are served from the cache as well
+            'hit_ratio': (self.hits + self.stale) / lookups if lookups else 0,
+            'regenerations': self.regenerations,
+            'avg_regeneration_ms': round(self.regeneration_ms / self.regenerations, 3) if self.regenerations else 0,
+            'max_regeneration_ms': round(self.max_regeneration_ms, 3),
+        }
+
+
+stats = PageCacheStats()
+
+
+def page_cache_stats():
+    return stats.as_dict()
+
+
+def bump_content_version():
+    #all cached pages become stale, they are rebuilt on their next request (again after the commit, see cache.py)
+    now_and_on_commit(lambda: get_cache().set(VERSION_KEY, new_version(), None))
+
+
+def is_cacheable_request(request):
+    return request.method in ('GET', 'HEAD') and page_cache_settings()['ENABLED']
+
+
+def page_key(request, key_params=()):
+    params = urlencode([(name, request.GET[name]) for name in key_params if name in request.GET])
+    return hashlib.md5(f'{request.path}?{params}'.encode()).hexdigest()
+
+
+def is_fresh(entry, version):
+    return entry is not None and entry[0] == version and entry[1] > time.time()
+
+
+def to_response(entry, state):
+    version, expires, content, content_type = entry
+    response = HttpResponse(content, content_type=content_type)
+    response['X-Page-Cache'] = state
+    return response
+
+
+def _render(response):
+    #template responses are rendered here instead of by the handler, to be stored
+    if hasattr(response, 'render') and callable(response.render):
+        response = response.render()
+    return response
+
+
+def _entry(response, version):
+    """
+    The cache entry of a response, None for responses that must not be shared
+    """
+    if (
+        response.status_code != 200 or response.streaming or response.cookies
+        or has_vary_header(response, 'Cookie')
+    ):
+        return None
+    config = page_cache_settings()
+    return (version, time.time() + config['TIMEOUT'], response.content, response['Content-Type'])
+
+
+def _store(cache, key, response, version, started):
+    entry = _entry(response, version)
+    if entry is not None:
+        config = page_cache_settings()
+        cache.set(PAGE_KEY % key, entry, config['TIMEOUT'] + config['STALE'])
+    stats.regenerated((time.perf_counter() - started) * 1000)
+    response['X-Page-Cache'] = 'miss'
+
+
+async def _astore(cache, key, response, version, started):
+    entry = _entry(response, version)
+    if entry is not None:
+        config = page_cache_settings()
+        await cache.aset(PAGE_KEY % key, entry, config['TIMEOUT'] + config['STALE'])
+    stats.regenerated((time.perf_counter() - started) * 1000)
+    response['X-Page-Cache'] = 'miss'
+
+
+def _lookup(cache, key):
+    values = cache.get_many([VERSION_KEY, PAGE_KEY % key])
+    version = values.get(VERSION_KEY)
+    if version is None:
+        cache.add(VERSION_KEY, new_version(), None)
+        version = cache.get(VERSION_KEY)
+    return version, values.get(PAGE_KEY % key)
+
+
+async def _alookup(cache, key):
+    values = await cache.aget_many([VERSION_KEY, PAGE_KEY % key])
+    version = values.get(VERSION_KEY)
+    if version is None:
+        await cache.aadd(VERSION_KEY, new_version(), None)
+        version = await cache.aget(VERSION_KEY)
+    return version, values.get(PAGE_KEY % key)
+
+
+def cached_page(view, key_params=()):
+    """
+    Serve the responses of a view from the page cache, see the module docstring.
+    key_params are the query parameters the view uses, other parameters don't make separate entries.
+    """
+    if iscoroutinefunction(view):
+        @wraps(view)
+        async def wrapper(request, *args, **kwargs):
+            if not is_cacheable_request(request):
+                return await view(request, *args, **kwargs)
+            config = page_cache_settings()
+            cache = get_cache()
+            key = page_key(request, key_params)
+            #questions going live bump the content version
+            await aensure_published()
+            version, entry = await _alookup(cache, key)
+            if is_fresh(entry, version):
+                stats.incr('hits')
+                return to_response(entry, 'hit')
+            #single flight: one request rebuilds the page
+            if await cache.aadd(LOCK_KEY % key, 1, config['LOCK_TIMEOUT']):
+                stats.incr('misses')
+                started = time.perf_counter()
+                try:
+                    with primary_reads():
+                        response = _render(await view(request, *args, **kwargs))
+                    await _astore(cache, key, response, version, started)
+                finally:
+                    await cache.adelete(LOCK_KEY % key)
+                return response
+            if entry is not None:
+                stats.incr('stale')
+                return to_response(entry, 'stale')
+            deadline = time.monotonic() + config['WAIT_MS'] / 1000
+            while time.monotonic() < deadline:
+                await asyncio.sleep(POLL_INTERVAL)
+                entry = await cache.aget(PAGE_KEY % key)
+                if entry is not None:
+                    stats.incr('hits')
+                    return to_response(entry, 'hit')
+            stats.incr('misses')
+            return await view(request, *args, **kwargs)
+    else:
+        @wraps(view)
+        def wrapper(request, *args, **kwargs):
+            if not is_cacheable_request(request):
+                return view(request, *args, **kwargs)
+            config = page_cache_settings()
+            cache = get_cache()
+            key = page_key(request, key_params)
+            #questions going live bump the content version
+            ensure_published()
+            version, entry = _lookup(cache, key)
+            if is_fresh(entry, version):
+                stats.incr('hits')
+                return to_response(entry, 'hit')
+            #single flight: one request rebuilds the page
+            if cache.add(LOCK_KEY % key, 1, config['LOCK_TIMEOUT']):
+                stats.incr('misses')
+                started = time.perf_counter()
+                try:
+                    with primary_reads():
+                        response = _render(view(request, *args, **kwargs))
+                    _store(cache, key, response, version, started)
+                finally:
+                    cache.delete(LOCK_KEY % key)
+                return response
+            if entry is not None:
+                stats.incr('stale')
+                return to_response(entry, 'stale')
+            deadline = time.monotonic() + config['WAIT_MS'] / 1000
+            while time.monotonic() < deadline:
+                time.sleep(POLL_INTERVAL)
+                entry = cache.get(PAGE_KEY % key)
+                if entry is not None:
+                    stats.incr('hits')
+                    return to_response(entry, 'hit')
+            stats.incr('misses')
+            return view(request, *args, **kwargs)
+    return wrapper
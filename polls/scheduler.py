@@ -0,0 +1,175 @@
+# Publication scheduler: flips Question.is_live when the pub_date of a question arrives
+'''
+Listings filter on the indexed Question.is_live flag instead of pub_date <= now,
+so their result only changes at known moments: when questions are written
+(signals.py, importer, admin) and when the pub_date of a future question is
+reached. The earliest pub_date of the questions that aren't live yet is kept in
+the cache:
+
+    polls:next-publication  ->  timestamp, 0 => nothing scheduled
+
+publish_due() flips the flag of every due question with one UPDATE and sends
+questions_published, which invalidates the cached questions and pages (see
+signals.py). Until the next publication, cached listings stay valid.
+
+publish_due() is run
+- by requests: ensure_published() costs one cache lookup until a publication is due
+- optionally by a background thread sleeping until the next publication
+  (POLLS_SCHEDULER['THREAD'], started with the first request)
+- by manage.py publish_questions [--loop]
+'''
+
+import threading
+import time
+
+from asgiref.sync import sync_to_async
+from django.conf import settings
+from django.db import close_old_connections, connection, transaction
+from django.db.models import Min
+from django.dispatch import Signal
+from django.utils import timezone
+
+from .cache import get_cache
+from .models import Question
+
+
+DEFAULTS = {
+    'THREAD': False,
+    'MAX_SLEEP': 60,
+}
+
+NEXT_KEY = 'polls:next-publication'
+#only one request at a time publishes due questions
+LOCK_KEY = 'polls:publishing'
+
+#sent with question_ids after questions went live
+questions_published = Signal()
+
+
+def scheduler_settings():
+    return {**DEFAULTS, **getattr(settings, 'POLLS_SCHEDULER', {})}
+
+
+def next_publication():
+    """
+    Timestamp of the next pub_date to reach, None if no question is waiting
+    """
+    cache = get_cache()
+    value = cache.get(NEXT_KEY)
+    if value is None:
+        #the primary, a lagging replica could still list published questions
+        pub_date = Question.objects.using('default').filter(is_live=False).aggregate(next=Min('pub_date'))['next']
+        value = pub_date.timestamp() if pub_date is not None else 0
+        cache.set(NEXT_KEY, value, None)
+    return value or None
+
+
+def schedule_changed():
+    #questions were written, the next publication is looked up again
+    get_cache().delete(NEXT_KEY)
+    if _thread is not None:
+        _thread.wake()
+
+
+def publish_due(now=None):
+    """
+    Make the questions whose pub_date has been reached live, returns their ids
+    """
+    now = now or timezone.now()
+    with transaction.atomic():
+        due = Question.objects.using('default').filter(is_live=False, pub_date__lte=now)
+        question_ids = list(due.values_list('pk', flat=True))
+        if question_ids:
+            Question.objects.filter(pk__in=question_ids).update(is_live=True)
+    get_cache().delete(NEXT_KEY)
+    if question_ids:
+        questions_published.send(sender=Question, question_ids=question_ids)
+    return question_ids
+
+
+def ensure_published():
+    """
+    Publish due questions if the next publication has been reached,
+    before serving content that depends on it
+    """
+    next_at = next_publication()
+    if next_at is None or next_at > time.time():
+        return []
+    cache = get_cache()
+    if not cache.add(LOCK_KEY, 1, 10):
+        return []
+    try:
+        return publish_due()
+    finally:
+        cache.delete(LOCK_KEY)
+
+
+async def aensure_published():
+    #async variant of ensure_published(), the database is only involved when a publication is due
+    value = await get_cache().aget(NEXT_KEY)
+    if value is not None and (not value or value > time.time()):
+        return []
+    return await sync_to_async(ensure_published)()
+
+
+def seconds_until_next(max_sleep):
+    next_at = next_publication()
+    if next_at is None:
+        return max_sleep
+    return min(max(next_at - time.time(), 0), max_sleep)
+
+
+class PublicationThread(threading.Thread):
+    #sleeps until the next publication, woken up early when questions are written
+
+    def __init__(self, max_sleep=60):
+        super().__init__(name='polls-publication-scheduler', daemon=True)
+        self.max_sleep = max_sleep
+        self._wakeup = threading.Event()
+        self._stopped = threading.Event()
+        self.runs = 0
+
+    def wake(self):
+        self._wakeup.set()
+
+    def stop(self):
+        self._stopped.set()
+        self._wakeup.set()
+
+    def run(self):
+        try:
+            while not self._stopped.is_set():
+                self._wakeup.clear()
+                publish_due()
+                self.runs += 1
+                self._wakeup.wait(seconds_until_next(self.max_sleep))
+                close_old_connections()
+        finally:
+            #runs in its own thread, which has its own db connection
+            connection.close()
+
+
+_thread = None
+_thread_lock = threading.Lock()
+
+
+def start_scheduler_thread(**kwargs):
+    """
+    Start the process wide scheduler thread, once (connected to request_started)
+    """
+    global _thread
+    if _thread is None:
+        with _thread_lock:
+            if _thread is None:
+                _thread = PublicationThread(scheduler_settings()['MAX_SLEEP'])
+                _thread.start()
+    return _thread
+
+
+def stop_scheduler_thread():
+    global _thread
+    with _thread_lock:
+        if _thread is not None:
+            _thread.stop()
+            _thread.join()
+            _thread = None
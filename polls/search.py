@@ -0,0 +1,92 @@
+# Full-text search of questions
+'''
+On SQLite the question text and category name are mirrored into the FTS5 table
+polls_question_fts (rowid = question id), kept in sync by triggers (migration
+0008_question_search). A search is a lookup in the inverted index ranked with
+bm25, instead of a LIKE '%term%' scan of the question table, so its cost
+depends on the number of matches rather than on the size of the table.
+
+Other databases fall back to icontains filters.
+'''
+
+import re
+
+from django.db import connection
+from django.db.models.expressions import RawSQL
+
+from .models import Question
+
+
+TABLE = 'polls_question_fts'
+
+#the question text weighs more than the category name in the ranking
+RANK = f'bm25({TABLE}, 10.0, 1.0)'
+
+MAX_TERMS = 10
+
+TERM = re.compile(r'\w+')
+
+
+def search_available():
+    return connection.vendor == 'sqlite'
+
+
+def fts_query(text):
+    """
+    FTS5 query matching all words of the user input, the last one as a prefix (the
+    user may still be typing it), None without words. Every word is quoted, so FTS5
+    operators and syntax in the input have no effect. Prefix searches of short
+    words touch many index entries, so the other words have to match exactly.
+    """
+    terms = TERM.findall(text)[:MAX_TERMS]
+    if not terms:
+        return None
+    return ' '.join([f'"{term}"' for term in terms[:-1]] + [f'"{terms[-1]}"*'])
+
+
+def matching_ids(text):
+    #subquery of the ids of all matching questions, for filter(pk__in=...)
+    return RawSQL(f'SELECT rowid FROM {TABLE} WHERE {TABLE} MATCH %s', [fts_query(text)])
+
+
+def search_questions(text, limit=20, offset=0):
+    """
+    Published questions matching the text, best match first
+    """
+    query = fts_query(text)
+    if query is None:
+        return []
+    if not search_available():
+        questions = Question.objects.published()
+        for term in TERM.findall(text)[:MAX_TERMS]:
+            questions = questions.filter(question_text__icontains=term)
+        return list(questions.order_by('-pub_date')[offset:offset + limit])
+    with connection.cursor() as cursor:
+        cursor.execute(
+            f'''
+            SELECT q.id FROM {TABLE} JOIN polls_question q ON q.id = {TABLE}.rowid
+            WHERE {TABLE} MATCH %s AND q.is_live AND q.choice_count >= 2
+            ORDER BY {RANK}, q.id LIMIT %s OFFSET %s
+            ''',
+            [query, limit, offset],
+        )
+        ids = [row[0] for row in cursor.fetchall()]
+    questions = Question.objects.in_bulk(ids)
+    return [questions[pk] for pk in ids if pk in questions]
+
+
+def rebuild_search_index():
+    """
+    Repopulate the search table from the question table, returns the number of indexed questions
+    """
+    with connection.cursor() as cursor:
+        cursor.execute(f'DELETE FROM {TABLE}')
+        cursor.execute(f'''
+            INSERT INTO {TABLE} (rowid, question_text, category_name)
+            SELECT q.id, q.question_text, COALESCE(c.name, '')
+            FROM polls_question q LEFT JOIN polls_category c ON c.id = q.question_category_id
+        ''')
+        count = cursor.rowcount
+        #merges the index segments for faster queries
+        cursor.execute(f"INSERT INTO {TABLE} ({TABLE}) VALUES ('optimize')")
+    return count
@@ -0,0 +1,134 @@
+# Sharded vote counters for questions that get lots of votes at once
+'''
+Every vote for a choice increments the same Choice row, so concurrent voters of a
+popular question queue up on that row lock. A question with vote_shards = N > 1
+spreads the votes of each choice over N ChoiceVoteShard rows instead, every
+batch of votes lands on a random shard:
+
+    Choice.votes            votes that were rolled up
+    ChoiceVoteShard.votes   votes since the last rollup, per shard
+
+The actual count of a choice is Choice.votes plus the sum of its shards
+(Choice.objects.with_shard_votes()), which is what the question cache stores.
+rollup_vote_shards() periodically folds the shards back into Choice.votes and
+Question.total_votes (manage.py rollup_vote_shards), so everything reading the
+plain columns catches up. Existing votes need no migration: they simply stay in
+Choice.votes when a question is switched to sharded counters.
+'''
+
+import random
+from collections import defaultdict
+
+from django.db import connection, transaction
+from django.db.models import F, IntegerField, Value
+from django.db.models.expressions import RawSQL
+
+from .models import Question, Choice, ChoiceVoteShard
+
+
+def _group_by_amount(counts):
+    by_amount = defaultdict(list)
+    for pk, count in counts.items():
+        by_amount[count].append(pk)
+    return by_amount
+
+
+#rows per UPDATE of increment(), each row takes 3 query parameters (older SQLite allows 999)
+INCREMENT_CHUNK = 300
+
+
+def chunked(items, size=INCREMENT_CHUNK):
+    #lists of at most size items, for statements with a query parameter per item
+    items = list(items)
+    for start in range(0, len(items), size):
+        yield items[start:start + size]
+
+
+def increment(model, field, counts):
+    """
+    Add {pk: n} to a counter column with one UPDATE per INCREMENT_CHUNK rows,
+    the amount of each row is picked by a CASE expression unless all are the same
+    """
+    pk_column = connection.ops.quote_name(model._meta.pk.column)
+    for chunk in map(dict, chunked(counts.items())):
+        amounts = set(chunk.values())
+        if len(amounts) == 1:
+            amount = Value(amounts.pop())
+        else:
+            #raw rather than Case(When(...)), which costs more to build than to run for big batches
+            amount = RawSQL(
+                f'CASE {pk_column}' + ' WHEN %s THEN %s' * len(chunk) + ' ELSE 0 END',
+                [value for row in chunk.items() for value in row],
+                output_field=IntegerField(),
+            )
+        model.objects.filter(pk__in=list(chunk)).update(**{field: F(field) + amount})
+
+
+def get_vote_shards(question_ids):
+    #{question id: shards} of the sharded questions among question_ids
+    return dict(
+        Question.objects.filter(pk__in=question_ids, vote_shards__gt=1).values_list('pk', 'vote_shards')
+    )
+
+
+def increment_shards(counts, shards):
+    """
+    Add {choice_id: n} votes to a random shard of each choice, shards is {choice_id: shard count}.
+    Has to run in a transaction.
+    """
+    by_shard = defaultdict(dict)
+    for choice_id, count in counts.items():
+        by_shard[random.randrange(shards[choice_id])][choice_id] = count
+    for shard, shard_counts in by_shard.items():
+        for count, choice_ids in _group_by_amount(shard_counts).items():
+            rows = ChoiceVoteShard.objects.filter(choice_id__in=choice_ids, shard=shard)
+            updated = rows.update(votes=F('votes') + count)
+            if updated < len(choice_ids):
+                #choices added after the question was sharded get their shard rows on first use
+                existing = set(rows.values_list('choice_id', flat=True))
+                ChoiceVoteShard.objects.bulk_create([
+                    ChoiceVoteShard(choice_id=choice_id, shard=shard, votes=count)
+                    for choice_id in choice_ids if choice_id not in existing
+                ])
+
+
+def rollup_vote_shards(question_ids=None):
+    """
+    Move the votes of the shards into Choice.votes and Question.total_votes,
+    returns the number of votes moved. The shard values are decremented rather
+    than reset, so votes added concurrently are kept.
+    """
+    shards = ChoiceVoteShard.objects.filter(votes__gt=0)
+    if question_ids is not None:
+        shards = shards.filter(choice__question_id__in=question_ids)
+    with transaction.atomic():
+        rows = list(shards.values_list('pk', 'choice_id', 'choice__question_id', 'votes'))
+        shard_counts = {}
+        choice_counts = defaultdict(int)
+        question_counts = defaultdict(int)
+        for pk, choice_id, question_id, votes in rows:
+            shard_counts[pk] = -votes
+            choice_counts[choice_id] += votes
+            question_counts[question_id] += votes
+        increment(ChoiceVoteShard, 'votes', shard_counts)
+        increment(Choice, 'votes', choice_counts)
+        increment(Question, 'total_votes', question_counts)
+    #the cached counts already include the shards, so nothing has to be invalidated
+    return sum(choice_counts.values())
+
+
+def set_vote_shards(question_id, shards):
+    """
+    Change the number of vote shards of a question, creating the shard rows of its choices.
+    The votes of the old shards are rolled up first.
+    """
+    with transaction.atomic():
+        rollup_vote_shards([question_id])
+        ChoiceVoteShard.objects.filter(choice__question_id=question_id).delete()
+        if shards > 1:
+            choice_ids = Choice.objects.filter(question_id=question_id).values_list('pk', flat=True)
+            ChoiceVoteShard.objects.bulk_create([
+                ChoiceVoteShard(choice_id=choice_id, shard=shard)
+                for choice_id in choice_ids for shard in range(shards)
+            ])
+        Question.objects.filter(pk=question_id).update(vote_shards=max(shards, 1))
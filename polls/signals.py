@@ -0,0 +1,63 @@
+# Signal handlers of the polls app, connected in PollsConfig.ready()
+
+from django.db.models.signals import post_delete, post_save, pre_save
+from django.dispatch import receiver
+
+from .cache import invalidate_all, invalidate_question
+from .counters import update_question_counters
+from .models import Question, Choice, Category
+from .pagecache import bump_content_version
+from .scheduler import questions_published, schedule_changed
+
+
+#keep Question.choice_count and Question.total_votes in sync
+"""
+This covers choices saved one by one, including the ChoiceInline of the admin.
+Bulk operations (bulk_create, QuerySet.update) don't send signals, they have to
+call update_question_counters() themselves.
+"""
+@receiver(pre_save, sender=Choice)
+def remember_previous_question(sender, instance, **kwargs):
+    #a choice may be moved to another question, the old one has to be recounted as well
+    instance._previous_question_id = None
+    if instance.pk is not None:
+        instance._previous_question_id = (
+            Choice.objects.filter(pk=instance.pk).values_list('question_id', flat=True).first()
+        )
+
+
+@receiver(post_save, sender=Choice)
+def choice_saved(sender, instance, raw=False, **kwargs):
+    if raw:
+        return
+    question_ids = {instance.question_id, getattr(instance, '_previous_question_id', None)}
+    question_ids.discard(None)
+    update_question_counters(question_ids)
+
+
+@receiver(post_delete, sender=Choice)
+def choice_deleted(sender, instance, **kwargs):
+    update_question_counters([instance.question_id])
+
+
+#invalidate cached questions and pages, see cache.py and pagecache.py
+@receiver(post_save, sender=Question)
+@receiver(post_delete, sender=Question)
+def question_changed(sender, instance, **kwargs):
+    invalidate_question(instance.pk)
+    bump_content_version()
+    #the pub_date may be the next one to publish
+    schedule_changed()
+
+
+@receiver(questions_published)
+def questions_went_live(sender, question_ids, **kwargs):
+    invalidate_question(*question_ids)
+    bump_content_version()
+
+
+@receiver(post_save, sender=Category)
+@receiver(post_delete, sender=Category)
+def category_changed(sender, instance, **kwargs):
+    invalidate_all()
+    bump_content_version()
@@ -0,0 +1,213 @@
+# Cold-start measurements: import time, application load and first request
+'''
+measure_startup() starts fresh interpreters with -X importtime, each one loads
+mysite.wsgi.application or mysite.asgi.application and sends it a request twice,
+like a newly started worker. Per application it reports (medians of the runs):
+
+    load_ms            importing the application module, which sets up Django
+    first_request_ms   the first request, which also imports the urlconf and views
+    second_request_ms  the same request again, for comparison
+    import_ms          total self time of the imports listed by -X importtime
+    modules            number of loaded modules
+    slowest_imports    the modules with the largest self import time
+
+Modules that Django loads with importlib.import_module() (settings, app configs,
+models, urlconfs) are missing from the -X importtime report, the modules they
+import are listed. check_budget() compares the results with STARTUP_BUDGET.
+
+Only the standard library is imported at module level: the probe runs as
+'python -m polls.startup' and has to load Django and the project from scratch.
+'''
+
+import ast
+import importlib.util
+import json
+import os
+import re
+import statistics
+import subprocess
+import sys
+import time
+
+
+#about twice the measured times (WSGI load 335 ms, first request 74 ms) and 641 modules with some headroom
+STARTUP_BUDGET = {
+    'load_ms': 700,
+    'first_request_ms': 200,
+    'modules': 680,
+}
+
+#heavy modules that are only needed by some requests or commands, they must not be loaded at startup
+UNWANTED_MODULES = ('xmlrpc.client', 'csv', 'polls.export', 'polls.importer', 'polls.bench')
+
+#imports the project modules had without using them. Django loads email, unicodedata and
+#the admin itself, so these are looked for in the sources rather than in sys.modules.
+UNWANTED_IMPORTS = {
+    'polls.models': ('email', 'xmlrpc', 'unicodedata', 'django.contrib.admin'),
+    'polls.views': ('email', 'xmlrpc', 'unicodedata'),
+}
+
+PROJECT_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+IMPORT_LINE = re.compile(r'import time:\s+(\d+) \|\s+(\d+) \|( *)(\S+)')
+
+
+def parse_importtime(output):
+    """
+    Return [(module, self us, cumulative us)] of -X importtime output, other lines are skipped
+    """
+    return [
+        (match.group(4), int(match.group(1)), int(match.group(2)))
+        for match in map(IMPORT_LINE.match, output.splitlines()) if match
+    ]
+
+
+def find_imports(module):
+    """
+    Return the absolute imports in the source of module, which isn't imported itself
+    """
+    with open(importlib.util.find_spec(module).origin) as f:
+        tree = ast.parse(f.read())
+    names = set()
+    for node in ast.walk(tree):
+        if isinstance(node, ast.Import):
+            names.update(alias.name for alias in node.names)
+        elif isinstance(node, ast.ImportFrom) and node.level == 0:
+            names.add(node.module)
+    return names
+
+
+def find_unwanted_imports(unwanted=UNWANTED_IMPORTS):
+    """
+    Return [(module, imported name)] of the UNWANTED_IMPORTS found in the sources
+    """
+    return [
+        (module, name)
+        for module, prefixes in unwanted.items() for name in sorted(find_imports(module))
+        if any(name == prefix or name.startswith(prefix + '.') for prefix in prefixes)
+    ]
+
+
+def wsgi_request(application, url):
+    from wsgiref.util import setup_testing_defaults
+    path, _, query = url.partition('?')
+    environ = {'PATH_INFO': path, 'QUERY_STRING': query, 'HTTP_HOST': 'localhost'}
+    setup_testing_defaults(environ)
+    status = []
+    body = application(environ, lambda value, headers, exc_info=None: status.append(value))
+    try:
+        for chunk in body:
+            pass
+    finally:
+        if hasattr(body, 'close'):
+            body.close()
+    return int(status[0].split()[0])
+
+
+def asgi_request(application, url):
+    import asyncio
+    path, _, query = url.partition('?')
+    scope = {
+        'type': 'http', 'asgi': {'version': '3.0'}, 'http_version': '1.1', 'method': 'GET',
+        'scheme': 'http', 'path': path, 'raw_path': path.encode(), 'query_string': query.encode(),
+        'root_path': '', 'headers': [(b'host', b'localhost')],
+        'client': ('127.0.0.1', 0), 'server': ('localhost', 80),
+    }
+    requests = [{'type': 'http.request', 'body': b'', 'more_body': False}]
+    messages = []
+
+    async def receive():
+        return requests.pop() if requests else {'type': 'http.disconnect'}
+
+    async def send(message):
+        messages.append(message)
+
+    asyncio.run(application(scope, receive, send))
+    return messages[0]['status']
+
+
+def probe(mode, url):
+    """
+    Load the application and time two requests, runs in the measured interpreter
+    """
+    os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'mysite.settings')
+    start = time.perf_counter()
+    if mode == 'asgi':
+        from mysite.asgi import application
+        request = asgi_request
+    else:
+        from mysite.wsgi import application
+        request = wsgi_request
+    result = {'load_ms': (time.perf_counter() - start) * 1000}
+    for name in ('first_request_ms', 'second_request_ms'):
+        start = time.perf_counter()
+        result['status'] = request(application, url)
+        result[name] = (time.perf_counter() - start) * 1000
+    result['modules'] = len(sys.modules)
+    result['unwanted'] = [name for name in UNWANTED_MODULES if name in sys.modules]
+    return result
+
+
+def run_probe(mode, url, env=None, top=10):
+    process = subprocess.run(
+        [sys.executable, '-X', 'importtime', '-m', 'polls.startup', mode, url],
+        cwd=PROJECT_DIR, env=env, capture_output=True, text=True, check=True,
+    )
+    result = json.loads(process.stdout.splitlines()[-1])
+    imports = parse_importtime(process.stderr)
+    result['import_ms'] = sum(self_us for name, self_us, cumulative in imports) / 1000
+    result['slowest_imports'] = [
+        (name, round(self_us / 1000, 3))
+        for name, self_us, cumulative in sorted(imports, key=lambda row: -row[1])[:top]
+    ]
+    return result
+
+
+def prepare_database(path):
+    #a migrated throwaway sqlite database for the probes
+    env = {**os.environ, 'DJANGO_DB_NAME': path}
+    subprocess.run(
+        [sys.executable, 'manage.py', 'migrate', '--no-input', '--verbosity', '0'],
+        cwd=PROJECT_DIR, env=env, check=True,
+    )
+
+
+def measure_startup(url='/polls/', runs=3, database=None, modes=('wsgi', 'asgi')):
+    """
+    Median cold-start measurements of `runs` fresh interpreters per application
+    """
+    env = {**os.environ}
+    if database is not None:
+        env['DJANGO_DB_NAME'] = database
+    results = {}
+    for mode in modes:
+        samples = [run_probe(mode, url, env) for i in range(runs)]
+        results[mode] = {
+            key: round(statistics.median(sample[key] for sample in samples), 3)
+            for key in ('load_ms', 'first_request_ms', 'second_request_ms', 'import_ms', 'modules')
+        }
+        results[mode].update({key: samples[-1][key] for key in ('status', 'unwanted', 'slowest_imports')})
+    return results
+
+
+def check_budget(results, budget=STARTUP_BUDGET):
+    """
+    Return descriptions of the budget violations of measure_startup() results
+    """
+    problems = []
+    for mode, result in results.items():
+        for key, limit in budget.items():
+            if result[key] > limit:
+                problems.append(f'{mode} {key}: {result[key]} > {limit}')
+        if result['unwanted']:
+            problems.append(f'{mode} imports {", ".join(result["unwanted"])}')
+        if result['status'] >= 500:
+            problems.append(f'{mode} first request failed with {result["status"]}')
+    for module, name in find_unwanted_imports():
+        problems.append(f'{module} imports {name}')
+    return problems
+
+
+if __name__ == '__main__':
+    mode, url = sys.argv[1:3]
+    print(json.dumps(probe(mode, url)))
@@ -1,13 +1,47 @@
 # Tests
 
+import asyncio
+import base64
+import csv
 import datetime
+import gzip
+import gc
+import json
+import os
+import tempfile
+import re
+import sqlite3
+import subprocess
+import sys
+import threading
+import time
+from io import StringIO
+from unittest import mock
 from secrets import choice
 from venv import create
 
-from django.test import TestCase
+from django.contrib.auth.models import User
+from django.core.management import CommandError, call_command
+from django.db import OperationalError, connection
+from django.db.models import Sum
+from asgiref.sync import iscoroutinefunction, sync_to_async
+from django.http import Http404, HttpResponse
+from django.test import AsyncRequestFactory, RequestFactory, SimpleTestCase, TestCase, TransactionTestCase, override_settings
+from django.test.utils import CaptureQueriesContext
 from django.utils import timezone
 from django.urls import reverse
-from .models import Question
+from mysite import instrumentation, routers
+from mysite.routers import PrimaryReplicaRouter, ReplicaRoutingMiddleware
+from mysite.sqlite import copy_database
+from .models import Question, Choice, ChoiceVoteShard, Category, VoteEvent, VoteRollup
+from . import async_views, ballots, bench, cache as question_cache, checks, pagecache, scheduler, startup
+from .live import LiveResultsHub, hub
+from .counters import find_counter_drift, update_question_counters
+from .dedup import MemoryDedupStore, dedup_stats
+from .shards import INCREMENT_CHUNK, set_vote_shards
+from .trends import rollup_votes
+from .views import read_results
+from .votebuffer import apply_vote_increments, get_vote_buffer, retry_on_lock
 
 
 #test cases for the question data model 
@@ -61,6 +95,10 @@ def create_two_choices(q):
 #test cases for the index view
 class QuestionIndexViewTests(TestCase):
 
+    def setUp(self):
+        #cached pages outlive the rolled back data of other tests
+        question_cache.get_cache().clear()
+
     def test_no_questions(self):
         """
         If no questions exist, an appropriate message is supposed to be displayed
@@ -200,4 +238,1886 @@ e.g.:
     -category view is supposed to have the same restrictions when showing questions as the index 
      view (future questions and questions with less than 2 choices)
 """
+def create_category_question(category, question_text, days):
+    question = create_question(question_text=question_text, days=days)
+    question.question_category = category
+    question.save()
+    create_two_choices(question)
+    return question
+
+
+class CategoryViewTests(TestCase):
+
+    def setUp(self):
+        question_cache.get_cache().clear()
+        self.category = Category.objects.create(name='Food', slug='food')
+        self.url = reverse('polls:category', args=('food',))
+
+    def test_category_questions(self):
+        """
+        The category page shows published questions of the category only, newest first
+        """
+        question1 = create_category_question(self.category, "Old question.", days=-10)
+        question2 = create_category_question(self.category, "New question.", days=-1)
+        create_category_question(self.category, "Future question.", days=5)
+        other = Category.objects.create(name='Football', slug='football')
+        create_category_question(other, "Other category.", days=-1)
+        single = create_question(question_text="Single choice.", days=-1)
+        single.question_category = self.category
+        single.save()
+        single.choice_set.create(choice_text="Only choice", votes=0)
+        response = self.client.get(self.url)
+        self.assertEqual(response.context['category_question_list'], [question2, question1])
+        self.assertIsNone(response.context['next_cursor'])
+
+    @override_settings(POLLS_CATEGORY_PAGE_SIZE=2)
+    def test_cursor_pagination(self):
+        """
+        Following the cursors visits every question exactly once, questions with the
+        same pub_date are ordered by id
+        """
+        questions = [create_category_question(self.category, f"Question {i}", days=-i) for i in range(5)]
+        same_date = create_question(question_text="Same date", days=0)
+        Question.objects.filter(pk=same_date.pk).update(
+            pub_date=questions[2].pub_date, question_category=self.category)
+        create_two_choices(same_date)
+        seen = []
+        cursor = None
+        while True:
+            response = self.client.get(self.url, {'after': cursor} if cursor else {})
+            page = response.context['category_question_list']
+            self.assertLessEqual(len(page), 2)
+            seen.extend(question.question_text for question in page)
+            cursor = response.context['next_cursor']
+            if cursor is None:
+                break
+        self.assertEqual(seen, ["Question 0", "Question 1", "Same date", "Question 2", "Question 3", "Question 4"])
+
+    def test_invalid_cursor(self):
+        response = self.client.get(self.url, {'after': 'not-a-cursor'})
+        self.assertEqual(response.status_code, 400)
+
+    def test_cursor_id_out_of_range(self):
+        cursor = base64.urlsafe_b64encode(f'{timezone.now().isoformat()}|{2 ** 64}'.encode()).decode()
+        response = self.client.get(self.url, {'after': cursor})
+        self.assertEqual(response.status_code, 400)
+
+    def test_unknown_category(self):
+        response = self.client.get(reverse('polls:category', args=('unknown',)))
+        self.assertEqual(response.status_code, 404)
+
+
+
+
+#test cases for the vote handler and the vote buffer
+class VoteViewTests(TestCase):
+
+    def test_vote_increments_choice(self):
+        """
+        With the default settings a vote is written to the database immediately
+        """
+        question = create_question(question_text="Past question.", days=-5)
+        create_two_choices(question)
+        choice = question.choice_set.first()
+        response = self.client.post(reverse('polls:vote', args=(question.id,)), {'choice': choice.id})
+        self.assertRedirects(response, reverse('polls:results', args=(question.id,)))
+        choice.refresh_from_db()
+        self.assertEqual(choice.votes, 1)
+
+    def test_vote_without_choice(self):
+        """
+        Posting without a choice redisplays the form with an error message
+        """
+        question = create_question(question_text="Past question.", days=-5)
+        create_two_choices(question)
+        response = self.client.post(reverse('polls:vote', args=(question.id,)), {})
+        self.assertContains(response, "select a choice")
+
+    def test_vote_does_not_overwrite_concurrent_votes(self):
+        """
+        Votes are added by the database, so a vote written in between by someone else is kept
+        """
+        question = create_question(question_text="Past question.", days=-5)
+        create_two_choices(question)
+        choice = question.choice_set.first()
+        Choice.objects.filter(pk=choice.pk).update(votes=10)
+        self.client.post(reverse('polls:vote', args=(question.id,)), {'choice': choice.id})
+        choice.refresh_from_db()
+        self.assertEqual(choice.votes, 11)
+
+    @override_settings(POLLS_VOTE_BUFFER={'FLUSH_EVERY': 3, 'FLUSH_INTERVAL_MS': 0})
+    def test_votes_are_flushed_in_batches(self):
+        """
+        With FLUSH_EVERY=3 votes are held back until the third one and then written at once
+        """
+        question = create_question(question_text="Past question.", days=-5)
+        create_two_choices(question)
+        choice1, choice2 = question.choice_set.all()
+        url = reverse('polls:vote', args=(question.id,))
+        self.client.post(url, {'choice': choice1.id})
+        self.client.post(url, {'choice': choice2.id})
+        choice1.refresh_from_db()
+        self.assertEqual(choice1.votes, 0)
+        self.assertEqual(get_vote_buffer().pending, 2)
+        self.client.post(url, {'choice': choice1.id})
+        choice1.refresh_from_db()
+        choice2.refresh_from_db()
+        self.assertEqual((choice1.votes, choice2.votes), (2, 1))
+        stats = get_vote_buffer().stats()
+        self.assertEqual(stats['pending'], 0)
+        self.assertEqual(stats['flushes'], 1)
+        self.assertEqual(stats['last_batch_size'], 3)
+
+
+#test cases for the native async views, called directly since urls.py picks them at import time
+class AsyncViewTests(TestCase):
+
+    def setUp(self):
+        question_cache.get_cache().clear()
+        self.factory = AsyncRequestFactory()
+        self.question = create_question(question_text="Past question.", days=-5)
+        create_two_choices(self.question)
+        self.choice1, self.choice2 = self.question.choice_set.all()
+
+    async def test_index(self):
+        await sync_to_async(create_question)(question_text="Future question.", days=5)
+        response = await async_views.index(self.factory.get('/polls/'))
+        self.assertContains(response, "Past question.")
+        self.assertNotContains(response, "Future question.")
+
+    async def test_detail(self):
+        future = await sync_to_async(create_question)(question_text="Future question.", days=5)
+        response = await async_views.detail(self.factory.get('/'), self.question.id)
+        self.assertContains(response, self.choice1.choice_text)
+        with self.assertRaises(Http404):
+            await async_views.detail(self.factory.get('/'), future.id)
+        with self.assertRaises(Http404):
+            await async_views.results(self.factory.get('/'), 9999)
+
+    async def test_vote(self):
+        request = self.factory.post('/', {'choice': self.choice2.id})
+        response = await async_views.vote(request, self.question.id)
+        self.assertEqual(response.status_code, 302)
+        self.assertEqual(response.url, reverse('polls:results', args=(self.question.id,)))
+        await sync_to_async(self.choice2.refresh_from_db)()
+        self.assertEqual(self.choice2.votes, 1)
+        response = await async_views.vote(self.factory.post('/', {}), self.question.id)
+        self.assertContains(response, "select a choice")
+
+    async def test_category(self):
+        category = await Category.objects.acreate(name='Food', slug='food')
+        await sync_to_async(create_category_question)(category, "Food question.", days=-1)
+        response = await async_views.show_category(self.factory.get('/polls/food/'), 'food')
+        self.assertContains(response, "Food question.")
+        self.assertNotContains(response, "Past question.")
+        with self.assertRaises(Http404):
+            await async_views.show_category(self.factory.get('/'), 'unknown')
+
+
+#test cases for idempotent vote submissions
+class VoteDedupTests(TestCase):
+
+    def setUp(self):
+        self.question = create_question(question_text="Past question.", days=-5)
+        create_two_choices(self.question)
+        self.choice = self.question.choice_set.first()
+        self.url = reverse('polls:vote', args=(self.question.id,))
+
+    def form_token(self):
+        response = self.client.get(reverse('polls:detail', args=(self.question.id,)))
+        return response.context['vote_token']
+
+    @override_settings(POLLS_VOTE_DEDUP={'BACKEND': 'memory', 'MAX_ENTRIES': 100, 'TTL': 60})
+    def test_repeated_submission_is_counted_once(self):
+        """
+        Submitting the same form twice counts one vote, the retry doesn't query the database
+        """
+        token = self.form_token()
+        self.assertNotEqual(token, self.form_token())
+        self.client.post(self.url, {'choice': self.choice.id, 'vote_token': token})
+        with self.assertNumQueries(0):
+            response = self.client.post(self.url, {'choice': self.choice.id, 'vote_token': token})
+        self.assertRedirects(response, reverse('polls:results', args=(self.question.id,)))
+        self.client.post(self.url, {'choice': self.choice.id, 'vote_token': self.form_token()})
+        self.choice.refresh_from_db()
+        self.assertEqual(self.choice.votes, 2)
+        stats = dedup_stats()
+        self.assertEqual((stats['claims'], stats['writes_saved']), (2, 1))
+
+    @override_settings(POLLS_VOTE_DEDUP={'BACKEND': 'memory', 'MAX_ENTRIES': 100, 'TTL': 60})
+    def test_failed_submission_can_be_repeated(self):
+        token = self.form_token()
+        response = self.client.post(self.url, {'vote_token': token})
+        self.assertContains(response, "select a choice")
+        self.client.post(self.url, {'choice': self.choice.id, 'vote_token': token})
+        self.choice.refresh_from_db()
+        self.assertEqual(self.choice.votes, 1)
+
+    @override_settings(POLLS_VOTE_DEDUP={'BACKEND': 'cache', 'TTL': 60, 'CACHE': 'default'})
+    def test_cache_backend(self):
+        token = self.form_token()
+        for i in range(3):
+            self.client.post(self.url, {'choice': self.choice.id, 'vote_token': token})
+        self.choice.refresh_from_db()
+        self.assertEqual(self.choice.votes, 1)
+        self.assertEqual(dedup_stats()['writes_saved'], 2)
+
+    def test_memory_store_is_bounded(self):
+        store = MemoryDedupStore(max_entries=2, ttl=60)
+        self.assertTrue(store.claim('a'))
+        self.assertTrue(store.claim('b'))
+        self.assertFalse(store.claim('a'))
+        self.assertTrue(store.claim('c'))
+        self.assertEqual((store.entries, store.stats.evictions), (2, 1))
+        #'a' was evicted, a claim after eviction succeeds again
+        self.assertTrue(store.claim('a'))
+        expiring = MemoryDedupStore(ttl=0)
+        self.assertTrue(expiring.claim('a'))
+        self.assertTrue(expiring.claim('a'))
+
+
+#test cases for the denormalized question counters
+class QuestionCounterTests(TestCase):
+
+    def test_saving_stale_question_keeps_counters(self):
+        """
+        Saving a question instance loaded before choices were added doesn't reset its counters
+        """
+        question = create_question(question_text="Past question.", days=-5)
+        create_two_choices(question)
+        question.question_text = "Changed question."
+        question.save()
+        question.refresh_from_db()
+        self.assertEqual((question.question_text, question.choice_count), ("Changed question.", 2))
+
+    def test_counters_follow_choices(self):
+        """
+        Creating, editing and deleting choices keeps choice_count and total_votes in sync
+        """
+        question = create_question(question_text="Past question.", days=-5)
+        choice = question.choice_set.create(choice_text="choice 1", votes=3)
+        question.choice_set.create(choice_text="choice 2", votes=4)
+        question.refresh_from_db()
+        self.assertEqual((question.choice_count, question.total_votes), (2, 7))
+        choice.votes = 10
+        choice.save()
+        question.refresh_from_db()
+        self.assertEqual(question.total_votes, 14)
+        choice.delete()
+        question.refresh_from_db()
+        self.assertEqual((question.choice_count, question.total_votes), (1, 4))
+
+    def test_vote_increments_total_votes(self):
+        question = create_question(question_text="Past question.", days=-5)
+        create_two_choices(question)
+        choice = question.choice_set.first()
+        self.client.post(reverse('polls:vote', args=(question.id,)), {'choice': choice.id})
+        question.refresh_from_db()
+        self.assertEqual(question.total_votes, 1)
+
+    def test_bulk_created_choices_need_recount(self):
+        """
+        bulk_create bypasses the signals, update_question_counters() fixes the counters
+        """
+        question = create_question(question_text="Past question.", days=-5)
+        Choice.objects.bulk_create([Choice(question=question, choice_text=str(i), votes=1) for i in range(3)])
+        question.refresh_from_db()
+        self.assertEqual(question.choice_count, 0)
+        update_question_counters([question.id])
+        question.refresh_from_db()
+        self.assertEqual((question.choice_count, question.total_votes), (3, 3))
+
+    def test_check_counters_command(self):
+        """
+        check_counters reports drift and repairs it with --repair
+        """
+        question = create_question(question_text="Past question.", days=-5)
+        create_two_choices(question)
+        Question.objects.filter(pk=question.pk).update(choice_count=5, total_votes=9)
+        out = StringIO()
+        call_command('check_counters', stdout=out)
+        self.assertIn('1 question(s) drifted', out.getvalue())
+        call_command('check_counters', '--repair', stdout=out)
+        question.refresh_from_db()
+        self.assertEqual((question.choice_count, question.total_votes), (2, 0))
+        out = StringIO()
+        call_command('check_counters', stdout=out)
+        self.assertIn('in sync', out.getvalue())
+
+
+#query plan regression tests
+"""
+Every query issued by the views is run through EXPLAIN QUERY PLAN.
+A plan step like 'SCAN polls_question' (without an index) means a full table scan.
+"""
+FULL_SCAN = re.compile(r'\bSCAN (\w+)(?! USING (?:COVERING )?INDEX)(?!\w)')
+
+
+def seed_polls(categories, questions_per_category, start=0):
+    """
+    Create categories with published questions that have two choices each
+    """
+    for c in range(start, start + categories):
+        category = Category.objects.create(name=f'Category {c}', slug=f'category-{c}')
+        for q in range(questions_per_category):
+            question = create_question(question_text=f'Question {c}/{q}', days=-q - 1)
+            question.question_category = category
+            question.save()
+            create_two_choices(question)
+
+
+class QueryPlanTests(TestCase):
+
+    def view_queries(self):
+        question = Question.objects.order_by('pk').first()
+        choice = question.choice_set.first()
+        requests = [
+            ('get', reverse('polls:index'), None),
+            ('get', reverse('polls:detail', args=(question.id,)), None),
+            ('get', reverse('polls:results', args=(question.id,)), None),
+            ('get', reverse('polls:category', args=('category-0',)), None),
+            ('post', reverse('polls:vote', args=(question.id,)), {'choice': choice.id}),
+        ]
+        for method, url, data in requests:
+            with CaptureQueriesContext(connection) as queries:
+                response = getattr(self.client, method)(url, data)
+            self.assertLess(response.status_code, 400, url)
+            for query in queries.captured_queries:
+                sql = query['sql']
+                if sql.startswith(('SELECT', 'UPDATE', 'DELETE')):
+                    yield url, sql
+
+    def assert_no_full_scans(self):
+        with connection.cursor() as cursor:
+            for url, sql in self.view_queries():
+                cursor.execute('EXPLAIN QUERY PLAN ' + sql)
+                plan = '\n'.join(row[-1] for row in cursor.fetchall())
+                self.assertIsNone(FULL_SCAN.search(plan), f'{url}: full table scan\n{sql}\n{plan}')
+
+    def test_views_use_indexes(self):
+        """
+        None of the view queries falls back to a full table scan,
+        also after the dataset grew and the planner statistics were updated
+        """
+        seed_polls(categories=2, questions_per_category=3)
+        self.assert_no_full_scans()
+        seed_polls(categories=8, questions_per_category=25, start=2)
+        with connection.cursor() as cursor:
+            cursor.execute('ANALYZE')
+        self.assert_no_full_scans()
+
+
+#test cases for the performance instrumentation middleware
+class PerformanceMiddlewareTests(TestCase):
+
+    def setUp(self):
+        instrumentation.stats.reset()
+
+    def test_server_timing_header(self):
+        """
+        Responses carry db, template and total timings in the Server-Timing header
+        """
+        question = create_question(question_text="Past question.", days=-5)
+        create_two_choices(question)
+        response = self.client.get(reverse('polls:detail', args=(question.id,)))
+        timing = response['Server-Timing']
+        self.assertRegex(timing, r'db;dur=[\d.]+;desc="\d+ queries"')
+        self.assertRegex(timing, r'tpl;dur=[\d.]+')
+        self.assertRegex(timing, r'total;dur=[\d.]+')
+
+    def test_query_count(self):
+        with CaptureQueriesContext(connection) as queries:
+            response = self.client.get(reverse('polls:index'))
+        self.assertIn(f'desc="{len(queries)} queries"', response['Server-Timing'])
+
+    async def test_async_middleware(self):
+        """
+        Under ASGI the middleware wraps async views without switching to a thread
+        """
+        async def view(request):
+            await Question.objects.acount()
+            return HttpResponse()
+        middleware = instrumentation.PerformanceMiddleware(view)
+        self.assertTrue(iscoroutinefunction(middleware))
+        response = await middleware(AsyncRequestFactory().get('/'))
+        self.assertIn('desc="1 queries"', response['Server-Timing'])
+
+    def test_stats_endpoint(self):
+        """
+        The stats endpoint reports percentiles per URL name
+        """
+        for i in range(3):
+            self.client.get(reverse('polls:index'))
+        self.client.get(reverse('polls:category', args=('unknown',)))
+        self.client.force_login(User.objects.create_user('staff', password='password', is_staff=True))
+        response = self.client.get(reverse('perf_stats'))
+        data = response.json()['endpoints']
+        self.assertEqual(data['polls:index']['count'], 3)
+        self.assertLessEqual(data['polls:index']['p50_ms'], data['polls:index']['p99_ms'])
+        self.assertEqual(data['polls:category']['count'], 1)
+
+    def test_stats_endpoint_is_internal(self):
+        """
+        Anonymous requests are refused, also from localhost (a reverse proxy on the same host)
+        """
+        self.assertEqual(self.client.get(reverse('perf_stats'), REMOTE_ADDR='10.1.2.3').status_code, 403)
+        self.assertEqual(self.client.get(reverse('perf_stats'), REMOTE_ADDR='127.0.0.1').status_code, 403)
+        with self.settings(PERF_STATS_ALLOWED_IPS=['10.1.2.3']):
+            self.assertEqual(self.client.get(reverse('perf_stats'), REMOTE_ADDR='10.1.2.3').status_code, 200)
+
+
+#test cases for the sharded vote counters
+class ShardedVoteTests(TestCase):
+
+    def setUp(self):
+        question_cache.get_cache().clear()
+        self.question = create_question(question_text="Popular question.", days=-5)
+        create_two_choices(self.question)
+        self.choice1, self.choice2 = self.question.choice_set.all()
+        Choice.objects.filter(pk=self.choice1.pk).update(votes=5)
+        update_question_counters([self.question.id])
+        set_vote_shards(self.question.id, 4)
+
+    def vote(self, choice, times=1):
+        for i in range(times):
+            self.client.post(reverse('polls:vote', args=(self.question.id,)), {'choice': choice.id})
+
+    def test_votes_go_to_shards(self):
+        """
+        Votes of a sharded question land in the shards, reads include them
+        """
+        self.assertEqual(ChoiceVoteShard.objects.filter(choice__question=self.question).count(), 8)
+        self.vote(self.choice1, 3)
+        self.vote(self.choice2)
+        self.choice1.refresh_from_db()
+        self.assertEqual(self.choice1.votes, 5)
+        data = self.client.get(reverse('polls:results_json', args=(self.question.id,))).json()
+        self.assertEqual(data['total'], 9)
+        self.assertEqual([choice['votes'] for choice in data['choices']], [8, 1])
+        #the plain columns only include rolled up votes, so they stay consistent
+        self.assertEqual(find_counter_drift(), [])
+
+    def test_rollup(self):
+        self.vote(self.choice1, 3)
+        self.vote(self.choice2, 2)
+        out = StringIO()
+        call_command('rollup_vote_shards', stdout=out)
+        self.assertIn('Rolled up 5 vote(s)', out.getvalue())
+        self.assertEqual(
+            list(self.question.choice_set.values_list('votes', flat=True)), [8, 2])
+        self.assertEqual(Question.objects.get(pk=self.question.pk).total_votes, 10)
+        self.assertFalse(ChoiceVoteShard.objects.filter(votes__gt=0).exists())
+        self.assertEqual(find_counter_drift(), [])
+
+    def test_unsharding_keeps_votes(self):
+        self.vote(self.choice2, 2)
+        call_command('rollup_vote_shards', question=[self.question.id], set_shards=1, stdout=StringIO())
+        self.assertFalse(ChoiceVoteShard.objects.exists())
+        self.vote(self.choice2)
+        self.choice2.refresh_from_db()
+        self.assertEqual(self.choice2.votes, 3)
+
+    def test_new_choice_gets_shards(self):
+        choice3 = self.question.choice_set.create(choice_text="Choice 3", votes=0)
+        self.vote(choice3, 2)
+        self.assertEqual(
+            ChoiceVoteShard.objects.filter(choice=choice3).aggregate(n=Sum('votes'))['n'], 2)
+
+
+class ShardedVoteStressTests(TransactionTestCase):
+
+    def test_parallel_votes_are_counted(self):
+        """
+        Votes from parallel threads are all counted, with and without shards
+        """
+        question = create_question(question_text="Popular question.", days=-5)
+        create_two_choices(question)
+        for shards in (1, 4):
+            result = bench.vote_stress(question, threads=4, votes=10, shards=shards)
+            self.assertEqual(result['votes'], 40)
+        self.assertEqual(Question.objects.get(pk=question.pk).total_votes, 80)
+        self.assertEqual(find_counter_drift(), [])
+
+
+#test cases for the vote event log and the trend rollups
+class VoteTrendTests(TestCase):
+
+    def setUp(self):
+        question_cache.get_cache().clear()
+        self.question = create_question(question_text="Past question.", days=-5)
+        create_two_choices(self.question)
+        self.choice1, self.choice2 = self.question.choice_set.all()
+
+    def log(self, hours_ago, choice, count):
+        VoteEvent.objects.create(
+            choice=choice, count=count, created_at=timezone.now() - datetime.timedelta(hours=hours_ago))
+
+    def test_votes_are_logged(self):
+        for choice in (self.choice1, self.choice1, self.choice2):
+            self.client.post(reverse('polls:vote', args=(self.question.id,)), {'choice': choice.id})
+        self.assertEqual(
+            VoteEvent.objects.filter(choice=self.choice1).aggregate(n=Sum('count'))['n'], 2)
+
+    def test_rollup_is_repeatable(self):
+        """
+        Closed hours are rolled up once per bucket, the current hour waits for the next run
+        """
+        self.log(3, self.choice1, 2)
+        self.log(3, self.choice1, 1)
+        self.log(3, self.choice2, 4)
+        self.log(2, self.choice1, 5)
+        self.log(0, self.choice1, 7)
+        self.assertEqual(rollup_votes()[0], 3)
+        self.assertEqual(rollup_votes()[0], 1)
+        hourly = VoteRollup.objects.filter(period='hour')
+        self.assertEqual(hourly.aggregate(n=Sum('votes'))['n'], 12)
+        self.assertEqual(hourly.filter(choice=self.choice1).count(), 2)
+        daily = VoteRollup.objects.filter(period='day')
+        self.assertEqual(daily.aggregate(n=Sum('votes'))['n'], 12)
+
+    @override_settings(POLLS_VOTE_EVENT_RETENTION_DAYS=1)
+    def test_prune(self):
+        self.log(50, self.choice1, 1)
+        self.log(2, self.choice1, 1)
+        out = StringIO()
+        call_command('rollup_votes', stdout=out)
+        self.assertIn('pruned 1 event(s)', out.getvalue())
+        self.assertEqual(VoteEvent.objects.count(), 1)
+        self.assertEqual(VoteRollup.objects.filter(period='hour').aggregate(n=Sum('votes'))['n'], 2)
+
+    def test_trend_endpoint(self):
+        """
+        The trend endpoint reads the rollups only
+        """
+        self.log(3, self.choice1, 2)
+        self.log(3, self.choice2, 1)
+        self.log(2, self.choice2, 4)
+        rollup_votes()
+        url = reverse('polls:trend_json', args=(self.question.id,))
+        self.client.get(url)
+        with CaptureQueriesContext(connection) as queries:
+            data = self.client.get(url).json()
+        self.assertEqual(len(queries), 1)
+        self.assertNotIn('polls_voteevent', queries[0]['sql'])
+        self.assertEqual([bucket['total'] for bucket in data['buckets']], [3, 4])
+        self.assertEqual(data['buckets'][1]['votes'], {str(self.choice2.id): 4})
+        data = self.client.get(url, {'period': 'day'}).json()
+        self.assertEqual(sum(bucket['total'] for bucket in data['buckets']), 7)
+        self.assertEqual(self.client.get(url, {'period': 'week'}).status_code, 400)
+        for days in ('-100000000', '0', '367', '99999999999999999999'):
+            self.assertEqual(self.client.get(url, {'days': days}).status_code, 400)
+        self.assertEqual(self.client.get(url, {'days': '366'}).status_code, 200)
+        self.assertEqual(self.client.get(reverse('polls:trend_json', args=(9999,))).status_code, 404)
+
+
+#test cases for the full-text search
+class SearchTests(TestCase):
+
+    def setUp(self):
+        self.food = Category.objects.create(name='Food', slug='food')
+        self.pizza = create_category_question(self.food, "Which pizza topping is best?", days=-2)
+        self.pasta = create_category_question(self.food, "Favourite pasta shape?", days=-1)
+        self.sport = create_question(question_text="Best pizza place near the stadium?", days=-1)
+        create_two_choices(self.sport)
+        create_category_question(self.food, "Future pizza poll?", days=5)
+
+    def search(self, query, **params):
+        return self.client.get(reverse('polls:search'), {'q': query, **params})
+
+    def test_ranked_published_results(self):
+        """
+        Only published questions are found, matches in the question text rank first
+        """
+        response = self.search('pizza')
+        self.assertEqual(set(response.context['search_question_list']), {self.pizza, self.sport})
+        trucks = create_question(question_text="Food trucks or restaurants?", days=-3)
+        create_two_choices(trucks)
+        response = self.search('food')
+        self.assertEqual(response.context['search_question_list'][0], trucks)
+        self.assertEqual(len(response.context['search_question_list']), 3)
+        response = self.search('pizz')
+        self.assertEqual(len(response.context['search_question_list']), 2)
+
+    def test_index_follows_changes(self):
+        Question.objects.filter(pk=self.pasta.pk).update(question_text="Favourite noodle shape?")
+        self.assertEqual(self.search('pasta').context['search_question_list'], [])
+        self.assertEqual(self.search('noodle').context['search_question_list'], [self.pasta])
+        Category.objects.filter(pk=self.food.pk).update(name='Cooking')
+        self.assertEqual(len(self.search('cooking').context['search_question_list']), 2)
+        self.pasta.delete()
+        self.assertEqual(self.search('noodle').context['search_question_list'], [])
+
+    def test_query_syntax_is_ignored(self):
+        self.assertEqual(self.search('pizza" OR NEAR(').status_code, 200)
+        self.assertEqual(self.search('***').context['search_question_list'], [])
+        self.assertEqual(self.search('pizza', page='x').status_code, 400)
+
+    @override_settings(POLLS_SEARCH_PAGE_SIZE=1)
+    def test_pagination(self):
+        response = self.search('pizza')
+        self.assertEqual(response.context['next_page'], 2)
+        response = self.search('pizza', page=2)
+        self.assertIsNone(response.context['next_page'])
+        self.assertEqual(response.context['previous_page'], 1)
+
+    def test_full_text_query_plan(self):
+        with connection.cursor() as cursor:
+            cursor.execute(
+                "EXPLAIN QUERY PLAN SELECT rowid FROM polls_question_fts WHERE polls_question_fts MATCH ?",
+                ['"pizza"*'])
+            plan = ' '.join(row[-1] for row in cursor.fetchall())
+        self.assertIn('VIRTUAL TABLE INDEX', plan)
+
+    def test_admin_search(self):
+        User.objects.create_superuser('admin', 'admin@example.com', 'password')
+        self.client.login(username='admin', password='password')
+        response = self.client.get(reverse('admin:polls_question_changelist'), {'q': 'pizza'})
+        self.assertEqual(response.context['cl'].result_count, 3)
+
+    def test_rebuild(self):
+        out = StringIO()
+        call_command('rebuild_search_index', stdout=out)
+        self.assertIn('Indexed 4 question(s)', out.getvalue())
+        self.assertEqual(len(self.search('pizza').context['search_question_list']), 2)
+
+
+#test cases for the question admin at scale
+class QuestionAdminTests(TestCase):
+
+    def setUp(self):
+        question_cache.get_cache().clear()
+        user = User.objects.create_superuser('admin', 'admin@example.com', 'password')
+        self.client.force_login(user)
+        self.changelist = reverse('admin:polls_question_changelist')
+
+    @override_settings(POLLS_ADMIN_EXACT_COUNT_LIMIT=5)
+    def test_estimated_count(self):
+        """
+        Beyond the limit the changelist count is estimated, filtered lists stop at the limit
+        """
+        questions = [create_question(question_text=f"Question {i}", days=-i) for i in range(8)]
+        response = self.client.get(self.changelist)
+        self.assertEqual(response.context['cl'].result_count, questions[-1].id)
+        response = self.client.get(self.changelist, {'pub_date__gte': '2000-01-01'})
+        self.assertEqual(response.context['cl'].result_count, 5)
+        questions[-1].delete()
+        Question.objects.filter(pk__gt=questions[4].pk).delete()
+        response = self.client.get(self.changelist)
+        self.assertEqual(response.context['cl'].result_count, 5)
+
+    def test_published_recently_column(self):
+        create_question(question_text="Recent question.", days=0)
+        create_question(question_text="Old question.", days=-5)
+        response = self.client.get(self.changelist)
+        column = {question.question_text: question.published_recently for question in response.context['cl'].result_list}
+        self.assertEqual(column, {"Recent question.": True, "Old question.": False})
+
+    @override_settings(POLLS_ADMIN_CHOICES_PER_PAGE=3)
+    def test_paginated_choices(self):
+        """
+        The change form edits one page of choices, the others are left alone
+        """
+        question = create_question(question_text="Many choices.", days=-1)
+        choices = [question.choice_set.create(choice_text=f"Choice {i}", votes=0) for i in range(7)]
+        url = reverse('admin:polls_question_change', args=(question.id,))
+        response = self.client.get(url, {'choice_page': 3})
+        formset = response.context['inline_admin_formsets'][0].formset
+        self.assertEqual([form.instance for form in formset.forms], choices[6:])
+        response = self.client.get(url, {'choice_page': 2})
+        formset = response.context['inline_admin_formsets'][0].formset
+        data = {
+            'question_text': question.question_text,
+            'pub_date_0': question.pub_date.strftime('%Y-%m-%d'),
+            'pub_date_1': question.pub_date.strftime('%H:%M:%S'),
+            f'{formset.prefix}-TOTAL_FORMS': 3,
+            f'{formset.prefix}-INITIAL_FORMS': 3,
+        }
+        for i, choice in enumerate(choices[3:6]):
+            data.update({
+                f'{formset.prefix}-{i}-id': choice.id,
+                f'{formset.prefix}-{i}-question': question.id,
+                f'{formset.prefix}-{i}-choice_text': choice.choice_text.upper(),
+                f'{formset.prefix}-{i}-votes': 0,
+            })
+        response = self.client.post(url + '?choice_page=2', data)
+        self.assertEqual(response.status_code, 302)
+        self.assertEqual(
+            list(question.choice_set.values_list('choice_text', flat=True)),
+            ['Choice 0', 'Choice 1', 'Choice 2', 'CHOICE 3', 'CHOICE 4', 'CHOICE 5', 'Choice 6'],
+        )
+
+    def test_reset_votes_action(self):
+        question = create_question(question_text="Past question.", days=-5)
+        create_two_choices(question)
+        Choice.objects.filter(question=question).update(votes=3)
+        update_question_counters([question.id])
+        self.client.post(self.changelist, {'action': 'reset_votes', '_selected_action': [question.id]})
+        self.assertEqual(Question.objects.get(pk=question.pk).total_votes, 0)
+        self.assertEqual(find_counter_drift(), [])
+        response = self.client.get(reverse('polls:results_json', args=(question.id,)))
+        self.assertEqual(response.json()['total'], 0)
+
+    @override_settings(POLLS_ADMIN_VOTE_SHARDS=4)
+    def test_vote_shard_actions(self):
+        """
+        Vote shards are changed by actions creating the shard rows, not by the change form
+        """
+        question = create_question(question_text="Past question.", days=-5)
+        create_two_choices(question)
+        url = reverse('admin:polls_question_change', args=(question.id,))
+        self.assertNotIn('name="vote_shards"', self.client.get(url).content.decode())
+        self.client.post(self.changelist, {'action': 'shard_votes', '_selected_action': [question.id]})
+        self.assertEqual(Question.objects.get(pk=question.pk).vote_shards, 4)
+        self.assertEqual(ChoiceVoteShard.objects.filter(choice__question=question).count(), 8)
+        self.client.post(self.changelist, {'action': 'unshard_votes', '_selected_action': [question.id]})
+        self.assertEqual(Question.objects.get(pk=question.pk).vote_shards, 1)
+        self.assertFalse(ChoiceVoteShard.objects.filter(choice__question=question).exists())
+
+
+#test cases for the read-through question cache
+class QuestionCacheTests(TestCase):
+
+    def setUp(self):
+        question_cache.get_cache().clear()
+        question_cache.stats.reset()
+        self.question = create_question(question_text="Past question.", days=-5)
+        create_two_choices(self.question)
+
+    def test_cached_pages_need_no_queries(self):
+        """
+        Once a question is cached its detail and results pages are served without queries
+        """
+        detail_url = reverse('polls:detail', args=(self.question.id,))
+        results_url = reverse('polls:results', args=(self.question.id,))
+        self.client.get(detail_url)
+        with self.assertNumQueries(0):
+            response = self.client.get(detail_url)
+        self.assertContains(response, "choice 1")
+        with self.assertNumQueries(0):
+            response = self.client.get(results_url)
+        self.assertRegex(response.content.decode(), r'choice 2 --\s+<span[^>]*>0 votes')
+        self.assertEqual(question_cache.cache_stats()['hits'], 2)
+
+    def test_vote_invalidates(self):
+        """
+        After a vote the results page shows the new count
+        """
+        results_url = reverse('polls:results', args=(self.question.id,))
+        self.client.get(results_url)
+        choice = self.question.choice_set.first()
+        self.client.post(reverse('polls:vote', args=(self.question.id,)), {'choice': choice.id})
+        response = self.client.get(results_url)
+        self.assertRegex(response.content.decode(), r'choice 1 --\s+<span[^>]*>1 vote<')
+
+    def test_model_changes_invalidate(self):
+        """
+        Saving the question or a choice, or changing a category, is never answered from a stale entry
+        """
+        detail_url = reverse('polls:detail', args=(self.question.id,))
+        self.client.get(detail_url)
+        self.question.question_text = "Changed question."
+        self.question.save()
+        self.assertContains(self.client.get(detail_url), "Changed question.")
+        self.question.choice_set.create(choice_text="choice 3", votes=0)
+        self.assertContains(self.client.get(detail_url), "choice 3")
+        misses = question_cache.cache_stats()['misses']
+        Category.objects.create(name='Food', slug='food')
+        self.client.get(detail_url)
+        self.assertEqual(question_cache.cache_stats()['misses'], misses + 1)
+        self.assertGreater(question_cache.cache_stats()['evictions'], 0)
+
+    def test_read_before_commit(self):
+        """
+        Old rows cached by a reader between a write and its commit are not served after the commit
+        """
+        cache = question_cache.get_cache()
+        old_question, old_choices = question_cache.get_question_with_choices(self.question.id)
+        with self.captureOnCommitCallbacks(execute=True):
+            self.question.question_text = "Changed question."
+            self.question.save()
+            #a concurrent reader doesn't see the uncommitted row yet and fills the new version with it
+            generation, version = question_cache.get_versions(self.question.id)
+            key = question_cache.ENTRY_KEY % (generation, self.question.id, version)
+            cache.set(key, question_cache._pack(old_question, old_choices))
+            page_version = cache.get(pagecache.VERSION_KEY)
+        question, choices = question_cache.get_question_with_choices(self.question.id)
+        self.assertEqual(question.question_text, "Changed question.")
+        self.assertNotEqual(cache.get(pagecache.VERSION_KEY), page_version)
+
+    def test_unpublished_question_stays_hidden(self):
+        """
+        The cached detail view applies the same visibility rules as before
+        """
+        future_question = create_question(question_text="Future question.", days=5)
+        create_two_choices(future_question)
+        url = reverse('polls:detail', args=(future_question.id,))
+        self.assertEqual(self.client.get(url).status_code, 404)
+        self.assertEqual(self.client.get(url).status_code, 404)
+        self.assertEqual(self.client.get(reverse('polls:detail', args=(9999,))).status_code, 404)
+
+
+#test cases for the full-page cache
+class PageCacheTests(TestCase):
+
+    def setUp(self):
+        question_cache.get_cache().clear()
+        pagecache.stats.reset()
+        self.factory = RequestFactory()
+
+    def test_cached_page_needs_no_queries(self):
+        create_two_choices(create_question(question_text="Past question.", days=-1))
+        response = self.client.get(reverse('polls:index'))
+        self.assertEqual(response['X-Page-Cache'], 'miss')
+        with self.assertNumQueries(0):
+            response = self.client.get(reverse('polls:index'))
+        self.assertEqual(response['X-Page-Cache'], 'hit')
+        self.assertContains(response, "Past question.")
+
+    def test_changes_refresh_pages(self):
+        """
+        Saving a question, a choice or a category makes the cached pages stale
+        """
+        category = Category.objects.create(name='Food', slug='food')
+        url = reverse('polls:category', args=('food',))
+        self.client.get(url)
+        question = create_category_question(category, "New question.", days=-1)
+        self.assertContains(self.client.get(url), "New question.")
+        question.choice_set.all().delete()
+        self.assertNotContains(self.client.get(url), "New question.")
+        category.name = 'Drinks'
+        category.save()
+        self.assertContains(self.client.get(url), "Drinks polls")
+
+    def test_key_ignores_unknown_parameters(self):
+        key = pagecache.page_key(self.factory.get('/polls/food/', {'after': 'abc'}), ('after',))
+        self.assertEqual(pagecache.page_key(self.factory.get('/polls/food/', {'after': 'abc', 'utm': 'x'}), ('after',)), key)
+        self.assertNotEqual(pagecache.page_key(self.factory.get('/polls/food/', {'after': 'abd'}), ('after',)), key)
+        self.assertNotEqual(pagecache.page_key(self.factory.get('/polls/drinks/', {'after': 'abc'}), ('after',)), key)
+        #views without key parameters have one entry per path
+        self.assertEqual(pagecache.page_key(self.factory.get('/polls/', {'after': 'abc'})),
+                         pagecache.page_key(self.factory.get('/polls/')))
+
+    def test_junk_query_string_hits_the_index(self):
+        """
+        Query parameters the index doesn't use are served its cached entry
+        """
+        url = reverse('polls:index')
+        self.assertEqual(self.client.get(url)['X-Page-Cache'], 'miss')
+        with self.assertNumQueries(0):
+            response = self.client.get(url, {'page': 'junk', 'after': 'abc', 'utm_source': 'x'})
+        self.assertEqual(response['X-Page-Cache'], 'hit')
+
+    @override_settings(DATABASE_REPLICAS=['replica1'])
+    def test_rebuild_reads_from_primary(self):
+        """
+        Pages are rebuilt from the primary, a lagging replica would be cached under the new version
+        """
+        scheduler.next_publication()
+        router = PrimaryReplicaRouter()
+        cached_view = ReplicaRoutingMiddleware(pagecache.cached_page(
+            lambda request: HttpResponse(router.db_for_read(Question))))
+        self.assertEqual(cached_view(self.factory.get('/polls/')).content, b'default')
+        #outside of the rebuild the request still reads from the replica
+        self.assertEqual(ReplicaRoutingMiddleware(
+            lambda request: HttpResponse(router.db_for_read(Question)))(self.factory.get('/polls/')).content, b'replica1')
+
+    def test_stale_copy_while_rebuilding(self):
+        """
+        While one request rebuilds a page, the others get the stale copy without queries
+        """
+        url = reverse('polls:index')
+        self.client.get(url)
+        pagecache.bump_content_version()
+        cache = question_cache.get_cache()
+        key = pagecache.page_key(self.factory.get(url))
+        cache.add(pagecache.LOCK_KEY % key, 1)
+        with self.assertNumQueries(0):
+            response = self.client.get(url)
+        self.assertEqual(response['X-Page-Cache'], 'stale')
+        cache.delete(pagecache.LOCK_KEY % key)
+        self.assertEqual(self.client.get(url)['X-Page-Cache'], 'miss')
+
+    def test_single_flight(self):
+        """
+        Concurrent requests for an expired page render it once
+        """
+        calls = []
+        rendering = threading.Event()
+        release = threading.Event()
+
+        def view(request):
+            calls.append(1)
+            rendering.set()
+            release.wait(5)
+            return HttpResponse(f'page {len(calls)}')
+
+        cached_view = pagecache.cached_page(view)
+        #the threads only use the cache, not the test database
+        scheduler.next_publication()
+        responses = []
+        #cold cache: the second request waits for the first rendering
+        first = threading.Thread(target=lambda: responses.append(cached_view(self.factory.get('/page/'))))
+        first.start()
+        rendering.wait(5)
+        second = threading.Thread(target=lambda: responses.append(cached_view(self.factory.get('/page/'))))
+        second.start()
+        release.set()
+        first.join()
+        second.join()
+        self.assertEqual([response.content for response in responses], [b'page 1', b'page 1'])
+        self.assertEqual(len(calls), 1)
+
+        #expired: the copy is served while the page is rebuilt
+        pagecache.bump_content_version()
+        rendering.clear()
+        release.clear()
+        rebuild = threading.Thread(target=cached_view, args=(self.factory.get('/page/'),))
+        rebuild.start()
+        rendering.wait(5)
+        stale = [cached_view(self.factory.get('/page/')) for i in range(5)]
+        release.set()
+        rebuild.join()
+        self.assertEqual({response.content for response in stale}, {b'page 1'})
+        self.assertEqual(cached_view(self.factory.get('/page/')).content, b'page 2')
+        self.assertEqual(len(calls), 2)
+        stats = pagecache.page_cache_stats()
+        self.assertEqual((stats['hits'], stats['stale'], stats['regenerations']), (2, 5, 2))
+        self.assertGreater(stats['max_regeneration_ms'], 0)
+
+    async def test_async_views(self):
+        async def view(request):
+            return HttpResponse('async page')
+
+        cached_view = pagecache.cached_page(view)
+        self.assertTrue(iscoroutinefunction(cached_view))
+        request = AsyncRequestFactory().get('/async-page/')
+        self.assertEqual((await cached_view(request))['X-Page-Cache'], 'miss')
+        response = await cached_view(request)
+        self.assertEqual((response['X-Page-Cache'], response.content), ('hit', b'async page'))
+
+    def test_responses_with_cookies_are_not_cached(self):
+        def view(request):
+            response = HttpResponse('private')
+            response.set_cookie('session', 'x')
+            return response
+
+        cached_view = pagecache.cached_page(view)
+        cached_view(self.factory.get('/private/'))
+        self.assertEqual(cached_view(self.factory.get('/private/'))['X-Page-Cache'], 'miss')
+
+
+#test cases for the publication scheduler
+class PublicationSchedulerTests(TestCase):
+
+    def setUp(self):
+        question_cache.get_cache().clear()
+
+    def test_future_question_goes_live(self):
+        """
+        A future question is listed once its pub_date is reached and the scheduler ran
+        """
+        question = create_question(question_text="Future question.", days=1)
+        create_two_choices(question)
+        self.assertFalse(Question.objects.get(pk=question.pk).is_live)
+        self.assertAlmostEqual(scheduler.next_publication(), question.pub_date.timestamp(), places=3)
+        self.assertNotContains(self.client.get(reverse('polls:index')), "Future question.")
+        self.assertEqual(scheduler.publish_due(question.pub_date), [question.pk])
+        self.assertIsNone(scheduler.next_publication())
+        self.assertContains(self.client.get(reverse('polls:index')), "Future question.")
+        self.assertEqual(self.client.get(reverse('polls:detail', args=(question.id,))).status_code, 200)
+
+    def test_requests_publish_due_questions(self):
+        """
+        Without a scheduler process, the first request after the pub_date publishes the question
+        """
+        question = Question.objects.create(
+            question_text="Soon question.", pub_date=timezone.now() + datetime.timedelta(milliseconds=200))
+        create_two_choices(question)
+        self.assertNotContains(self.client.get(reverse('polls:index')), "Soon question.")
+        time.sleep(0.25)
+        self.assertContains(self.client.get(reverse('polls:index')), "Soon question.")
+
+    def test_pub_date_update_fields(self):
+        """
+        Saving only pub_date also writes is_live, a question moved to the future is hidden again
+        """
+        question = create_question(question_text="Past question.", days=-1)
+        create_two_choices(question)
+        question.pub_date = timezone.now() + datetime.timedelta(days=1)
+        question.save(update_fields=['pub_date'])
+        self.assertFalse(Question.objects.get(pk=question.pk).is_live)
+        self.assertNotContains(self.client.get(reverse('polls:index')), "Past question.")
+
+    @override_settings(POLLS_PAGE_CACHE={'ENABLED': False})
+    def test_listings_publish_without_page_cache(self):
+        """
+        The index and category pages publish due questions themselves, not only through the page cache
+        """
+        category = Category.objects.create(name='Food', slug='food')
+        question = Question.objects.create(
+            question_text="Soon question.", question_category=category,
+            pub_date=timezone.now() + datetime.timedelta(milliseconds=200))
+        create_two_choices(question)
+        self.assertNotContains(self.client.get(reverse('polls:index')), "Soon question.")
+        time.sleep(0.25)
+        self.assertContains(self.client.get(reverse('polls:category', args=('food',))), "Soon question.")
+        Question.objects.filter(pk=question.pk).update(is_live=False)
+        question_cache.get_cache().delete(scheduler.NEXT_KEY)
+        self.assertContains(self.client.get(reverse('polls:index')), "Soon question.")
+
+    async def test_async_listings_publish(self):
+        question = await sync_to_async(create_question)(question_text="Due question.", days=-1)
+        await sync_to_async(create_two_choices)(question)
+        await Question.objects.filter(pk=question.pk).aupdate(is_live=False)
+        await question_cache.get_cache().adelete(scheduler.NEXT_KEY)
+        response = await async_views.index(AsyncRequestFactory().get('/polls/'))
+        self.assertContains(response, "Due question.")
+
+    def test_nothing_due_needs_no_queries(self):
+        create_question(question_text="Future question.", days=1)
+        scheduler.ensure_published()
+        with self.assertNumQueries(0):
+            self.assertEqual(scheduler.ensure_published(), [])
+
+    def test_moving_pub_date_to_the_future(self):
+        question = create_question(question_text="Past question.", days=-1)
+        create_two_choices(question)
+        question.pub_date = timezone.now() + datetime.timedelta(days=1)
+        question.save()
+        self.assertFalse(Question.objects.get(pk=question.pk).is_live)
+        self.assertAlmostEqual(scheduler.next_publication(), question.pub_date.timestamp(), places=3)
+
+    def test_command(self):
+        question = create_question(question_text="Future question.", days=1)
+        Question.objects.filter(pk=question.pk).update(pub_date=timezone.now())
+        out = StringIO()
+        call_command('publish_questions', stdout=out)
+        self.assertIn('Published 1 question(s)', out.getvalue())
+        self.assertTrue(Question.objects.get(pk=question.pk).is_live)
+
+
+class PublicationThreadTests(TransactionTestCase):
+
+    def test_thread_publishes_at_pub_date(self):
+        question_cache.get_cache().clear()
+        thread = scheduler.PublicationThread(max_sleep=5)
+        thread.start()
+        self.addCleanup(thread.join)
+        self.addCleanup(thread.stop)
+        question = Question.objects.create(
+            question_text="Soon question.", pub_date=timezone.now() + datetime.timedelta(milliseconds=200))
+        #wakes the thread up, which then sleeps until the pub_date
+        scheduler.schedule_changed()
+        thread.wake()
+        deadline = time.monotonic() + 3
+        while not Question.objects.get(pk=question.pk).is_live and time.monotonic() < deadline:
+            time.sleep(0.02)
+        self.assertTrue(Question.objects.get(pk=question.pk).is_live)
+        self.assertLess(thread.runs, 5)
+
+
+#test cases for the live results stream
+def parse_events(chunk):
+    """
+    Return (event, data) for the server-sent events in a chunk
+    """
+    events = []
+    for block in chunk.decode().strip().split('\n\n'):
+        fields = dict(line.split(': ', 1) for line in block.splitlines() if not line.startswith(':'))
+        if 'event' in fields:
+            events.append((fields['event'], json.loads(fields['data'])))
+    return events
+
+
+@override_settings(POLLS_LIVE_TICK_MS=10)
+class LiveResultsTests(TestCase):
+
+    def setUp(self):
+        self.question = create_question(question_text="Past question.", days=-5)
+        create_two_choices(self.question)
+        self.choice1, self.choice2 = self.question.choice_set.all()
+
+    async def test_deltas_are_coalesced_per_tick(self):
+        """
+        Deltas published within a tick reach every subscriber as one merged frame
+        """
+        live_hub = LiveResultsHub()
+        subscriptions = [live_hub.subscribe(1) for i in range(3)]
+        live_hub.publish(1, {10: 1})
+        live_hub.publish(1, {10: 2, 11: 1})
+        live_hub.publish(2, {20: 1})
+        for subscription in subscriptions:
+            self.assertEqual(await subscription.next(timeout=1), {10: 3, 11: 1})
+        self.assertEqual(live_hub.frames, 1)
+        for subscription in subscriptions:
+            live_hub.unsubscribe(1, subscription)
+        self.assertEqual(live_hub.stats()['channels'], 0)
+
+    async def test_stream_sends_results_and_votes(self):
+        """
+        The stream starts with the current results and then sends the deltas of new votes
+        """
+        response = await self.async_client.get(reverse('polls:results_stream', args=(self.question.id,)))
+        self.assertEqual(response['Content-Type'], 'text/event-stream')
+        content = response.streaming_content
+        events = parse_events(await anext(content))
+        self.assertEqual(events, [('results', {
+            'question': self.question.id,
+            'seq': 0,
+            'total': 0,
+            'choices': {str(self.choice1.id): 0, str(self.choice2.id): 0},
+        })])
+        await self.async_client.post(reverse('polls:vote', args=(self.question.id,)), {'choice': self.choice2.id})
+        events = parse_events(await asyncio.wait_for(anext(content), 5))
+        self.assertEqual(events, [('votes', {'question': self.question.id, 'seq': 1, 'deltas': {str(self.choice2.id): 1}})])
+        #like a disconnected client: the stream is dropped and finalized by the event loop
+        await content.aclose()
+        del content, response
+        gc.collect()
+        await asyncio.sleep(0.05)
+        self.assertEqual(hub.stats()['subscribers'], 0)
+
+    async def test_vote_between_subscribe_and_results(self):
+        """
+        Votes written after subscribing but counted in the first results aren't sent again as deltas
+        """
+        subscription = hub.subscribe(self.question.id)
+        try:
+            await sync_to_async(apply_vote_increments)({(self.question.id, self.choice1.id): 1})
+            question, choices, subscription.sequence = await sync_to_async(read_results)(self.question.id)
+            self.assertEqual((question.total_votes, subscription.sequence), (1, 1))
+            await sync_to_async(apply_vote_increments)({(self.question.id, self.choice1.id): 2})
+            self.assertEqual(await subscription.next(timeout=1), {self.choice1.id: 2})
+            self.assertEqual(subscription.sequence, 2)
+        finally:
+            hub.unsubscribe(self.question.id, subscription)
+
+    def test_stream_under_wsgi(self):
+        """
+        Without ASGI the stream answers 204, browsers stop reconnecting, and the page doesn't open it
+        """
+        response = self.client.get(reverse('polls:results_stream', args=(self.question.id,)))
+        self.assertEqual(response.status_code, 204)
+        response = self.client.get(reverse('polls:results', args=(self.question.id,)))
+        self.assertNotContains(response, 'EventSource')
+        with self.settings(POLLS_LIVE_RESULTS=True):
+            response = self.client.get(reverse('polls:results', args=(self.question.id,)))
+            self.assertContains(response, 'EventSource')
+
+    def test_stream_unknown_question(self):
+        response = self.client.get(reverse('polls:results_stream', args=(9999,)))
+        self.assertEqual(response.status_code, 404)
+
+
+#test cases for the bulk ballot endpoint
+@override_settings(POLLS_BALLOT_API_KEYS=['kiosk-key'])
+class BallotTests(TestCase):
+
+    def setUp(self):
+        self.question = create_question(question_text="Past question.", days=-5)
+        create_two_choices(self.question)
+        self.other = create_question(question_text="Other question.", days=-5)
+        create_two_choices(self.other)
+        self.choice1, self.choice2 = self.question.choice_set.all()
+        self.other_choice = self.other.choice_set.first()
+        self.url = reverse('polls:ballots')
+
+    def post(self, data, key='kiosk-key'):
+        headers = {'HTTP_AUTHORIZATION': f'Bearer {key}'} if key else {}
+        return self.client.post(self.url, json.dumps(data), content_type='application/json', **headers)
+
+    def test_requires_api_key(self):
+        self.assertEqual(self.post({'ballots': []}, key=None).status_code, 401)
+        response = self.post({'ballots': []}, key='wrong')
+        self.assertEqual(response.status_code, 401)
+        self.assertEqual(response['WWW-Authenticate'], 'Bearer')
+        self.assertEqual(self.client.get(self.url, HTTP_AUTHORIZATION='Bearer kiosk-key').status_code, 405)
+
+    def test_ballots_are_applied(self):
+        """
+        Valid ballots are counted, invalid ones are reported by index without affecting the others
+        """
+        response = self.post({'ballots': [
+            [self.question.id, self.choice1.id, 3],
+            [self.question.id, self.choice2.id],
+            [self.question.id, self.other_choice.id, 1],
+            [self.other.id, self.other_choice.id, 2],
+            [self.question.id, self.choice1.id, 0],
+            [self.question.id, 'x', 1],
+            [self.question.id, self.choice1.id, True],
+            {'choice': self.choice1.id},
+            [self.question.id, self.choice1.id, 4],
+        ]})
+        data = response.json()
+        self.assertEqual((data['accepted'], data['votes'], data['rejected']), (4, 10, 5))
+        self.assertEqual([error['index'] for error in data['errors']], [2, 4, 5, 6, 7])
+        self.choice1.refresh_from_db()
+        self.choice2.refresh_from_db()
+        self.assertEqual((self.choice1.votes, self.choice2.votes), (7, 1))
+        self.assertEqual(Question.objects.get(pk=self.question.pk).total_votes, 8)
+        self.assertEqual(Question.objects.get(pk=self.other.pk).total_votes, 2)
+        self.assertEqual(find_counter_drift(), [])
+
+    def test_one_validation_query(self):
+        ballots = [[self.question.id, self.choice1.id, 1]] * 50 + [[self.other.id, self.other_choice.id, 2]] * 50
+        with CaptureQueriesContext(connection) as queries:
+            self.assertEqual(self.post({'ballots': ballots}).json()['votes'], 150)
+        self.assertEqual(len([query for query in queries if 'FROM "polls_choice"' in query['sql']]), 1)
+        #two amounts per table, one UPDATE ... CASE each
+        updates = [query['sql'] for query in queries if query['sql'].startswith('UPDATE')]
+        self.assertEqual(len(updates), 2)
+        self.assertTrue(all('CASE' in sql for sql in updates))
+
+    def test_validation_is_chunked(self):
+        """
+        Large batches look up their choices in chunks, within the query parameter limit of SQLite
+        """
+        choices = Choice.objects.bulk_create([
+            Choice(question=self.question, choice_text=f"choice {i}", votes=0) for i in range(INCREMENT_CHUNK)
+        ])
+        items = [[self.question.id, choice.id, 1] for choice in choices] + [[self.question.id, self.choice1.id, 1]]
+        with CaptureQueriesContext(connection) as queries:
+            self.assertEqual(self.post({'ballots': items}).json()['votes'], INCREMENT_CHUNK + 1)
+        self.assertEqual(len([query for query in queries if 'FROM "polls_choice"' in query['sql']]), 2)
+
+    @override_settings(POLLS_VOTE_BUFFER={'LOCK_RETRIES': 2, 'LOCK_RETRY_DELAY_MS': 0})
+    def test_lock_retries_from_settings(self):
+        """
+        Lock errors are retried as often as POLLS_VOTE_BUFFER allows
+        """
+        calls = []
+
+        def locked(increments):
+            calls.append(increments)
+            raise OperationalError('database is locked')
+
+        with mock.patch('polls.ballots.apply_vote_increments', locked):
+            with self.assertRaises(OperationalError):
+                ballots.ingest_ballots([[self.question.id, self.choice1.id, 1]])
+        self.assertEqual(len(calls), 3)
+
+    def test_ids_out_of_range(self):
+        """
+        Ids beyond the 64-bit range of the database are rejected per ballot
+        """
+        huge = 9999999999999999999999999
+        response = self.post({'ballots': [[huge, huge, 1], [self.question.id, self.choice1.id, 1]]})
+        self.assertEqual(response.status_code, 200)
+        data = response.json()
+        self.assertEqual((data['accepted'], data['votes']), (1, 1))
+        self.assertEqual([error['index'] for error in data['errors']], [0])
+
+    def test_unpublished_questions(self):
+        """
+        Ballots for questions that aren't live or have less than two choices are rejected
+        """
+        future = create_question(question_text="Future question.", days=5)
+        create_two_choices(future)
+        lonely = create_question(question_text="One choice.", days=-5)
+        lonely_choice = lonely.choice_set.create(choice_text="choice 1", votes=0)
+        response = self.post({'ballots': [
+            [future.id, future.choice_set.first().id, 1],
+            [lonely.id, lonely_choice.id, 1],
+            [self.question.id, self.choice1.id, 1],
+        ]})
+        data = response.json()
+        self.assertEqual((data['accepted'], data['votes']), (1, 1))
+        self.assertEqual(data['errors'], [
+            {'index': 0, 'error': 'question is not published'},
+            {'index': 1, 'error': 'question is not published'},
+        ])
+        self.assertEqual(Question.objects.get(pk=future.pk).total_votes, 0)
+
+    @override_settings(POLLS_BALLOT_MAX_ITEMS=2)
+    def test_malformed_requests(self):
+        self.assertEqual(self.post({'ballots': [[1, 1, 1]] * 3}).status_code, 400)
+        self.assertEqual(self.post({'votes': []}).status_code, 400)
+        self.assertEqual(self.post({'ballots': 'x'}).status_code, 400)
+        self.assertEqual(self.post([1, 2]).status_code, 400)
+
+
+#test cases for the JSON results api
+class ResultsJsonTests(TestCase):
+
+    def setUp(self):
+        self.question = create_question(question_text="Past question.", days=-5)
+        create_two_choices(self.question)
+        self.url = reverse('polls:results_json', args=(self.question.id,))
+
+    def test_results(self):
+        response = self.client.get(self.url)
+        data = response.json()
+        self.assertEqual(data['id'], self.question.id)
+        self.assertEqual(data['total'], 0)
+        self.assertEqual([choice['text'] for choice in data['choices']], ["choice 1", "choice 2"])
+        self.assertTrue(response['ETag'].startswith('"'))
+        self.assertIn('Last-Modified', response)
+        self.assertIn('max-age=5', response['Cache-Control'])
+        self.assertIn('public', response['Cache-Control'])
+
+    def test_not_modified_without_queries(self):
+        """
+        A client with the current ETag gets a 304 without database queries
+        """
+        etag = self.client.get(self.url)['ETag']
+        with self.assertNumQueries(0):
+            response = self.client.get(self.url, HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, 304)
+        response = self.client.get(self.url, HTTP_IF_MODIFIED_SINCE=response['Last-Modified'])
+        self.assertEqual(response.status_code, 304)
+
+    def test_vote_changes_etag(self):
+        etag = self.client.get(self.url)['ETag']
+        choice = self.question.choice_set.first()
+        self.client.post(reverse('polls:vote', args=(self.question.id,)), {'choice': choice.id})
+        response = self.client.get(self.url, HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, 200)
+        self.assertNotEqual(response['ETag'], etag)
+        self.assertEqual(response.json()['total'], 1)
+
+    def test_unknown_question(self):
+        response = self.client.get(reverse('polls:results_json', args=(9999,)))
+        self.assertEqual(response.status_code, 404)
+        #no versions are created for ids that don't exist
+        self.assertIsNone(question_cache.get_cache().get(question_cache.VERSION_KEY % 9999))
+        response = self.client.get(reverse('polls:results_json', args=(2 ** 64,)))
+        self.assertEqual(response.status_code, 404)
+
+    def test_unpublished_questions_are_hidden(self):
+        """
+        Questions that aren't live or have less than two choices are hidden like in the HTML views
+        """
+        future_question = create_question(question_text="Future question.", days=5)
+        create_two_choices(future_question)
+        lonely_question = create_question(question_text="One choice.", days=-5)
+        lonely_question.choice_set.create(choice_text="choice 1", votes=0)
+        for question in (future_question, lonely_question):
+            for name in ('results_json', 'trend_json'):
+                response = self.client.get(reverse(f'polls:{name}', args=(question.id,)))
+                self.assertEqual(response.status_code, 404)
+
+    def test_batch_results(self):
+        """
+        Results of many questions come from one query, unknown and unpublished ids are skipped
+        """
+        questions = [self.question]
+        for i in range(5):
+            question = create_question(question_text=f"Question {i}.", days=-1)
+            create_two_choices(question)
+            questions.append(question)
+        future_question = create_question(question_text="Future question.", days=5)
+        create_two_choices(future_question)
+        set_vote_shards(questions[1].id, 4)
+        choice = questions[1].choice_set.first()
+        self.client.post(reverse('polls:vote', args=(questions[1].id,)), {'choice': choice.id})
+        ids = [question.id for question in reversed(questions)] + [future_question.id, 9999]
+        scheduler.next_publication()
+        with self.assertNumQueries(1):
+            response = self.client.get(reverse('polls:results_batch'), {'ids': ','.join(map(str, ids))})
+        data = response.json()['questions']
+        self.assertEqual([question['id'] for question in data], ids[:-2])
+        self.assertEqual(data[-2]['total'], 1)
+        self.assertEqual(data[-2]['choices'][0], {'id': choice.id, 'text': "choice 1", 'votes': 1})
+        self.assertIn('max-age=5', response['Cache-Control'])
+
+    @override_settings(POLLS_BATCH_RESULTS_MAX_IDS=2)
+    def test_batch_results_limits(self):
+        url = reverse('polls:results_batch')
+        self.assertEqual(self.client.get(url, {'ids': '1,2,3'}).status_code, 400)
+        self.assertEqual(self.client.get(url, {'ids': '1,x'}).status_code, 400)
+        self.assertEqual(self.client.get(url).status_code, 400)
+        self.assertEqual(self.client.get(url, {'ids': '1,1,1'}).status_code, 200)
+        #beyond the 64-bit ids of the database
+        self.assertEqual(self.client.get(url, {'ids': '1,99999999999999999999999'}).status_code, 400)
+        self.assertEqual(self.client.get(url, {'ids': '0'}).status_code, 400)
+
+
+#test cases for the import_polls command
+class ImportPollsTests(TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        self.addCleanup(self.directory.cleanup)
+        Category.objects.create(name='Food', slug='food')
+
+    def write_jsonl(self, records, name='polls.jsonl'):
+        path = os.path.join(self.directory.name, name)
+        with open(path, 'w') as f:
+            for record in records:
+                f.write(json.dumps(record) + '\n')
+        return path
+
+    def records(self, count):
+        return [{
+            'question_text': f'Question {i}',
+            'pub_date': '2022-03-21T16:31:00',
+            'category': 'food' if i % 2 else 'sports',
+            'choices': ['Yes', {'choice_text': 'No', 'votes': i}],
+        } for i in range(count)]
+
+    def test_import_jsonl(self):
+        """
+        Questions, choices and missing categories are created, counters are set
+        """
+        path = self.write_jsonl(self.records(5))
+        out = StringIO()
+        call_command('import_polls', path, '--chunk-size', '2', stdout=out)
+        self.assertEqual(Question.objects.count(), 5)
+        self.assertEqual(Choice.objects.count(), 10)
+        self.assertEqual(Category.objects.get(slug='sports').name, 'Sports')
+        question = Question.objects.get(question_text='Question 3')
+        self.assertEqual(question.question_category.slug, 'food')
+        self.assertEqual((question.choice_count, question.total_votes), (2, 3))
+        self.assertIn('rows/s', out.getvalue())
+        self.assertFalse(os.path.exists(path + '.checkpoint'))
+
+    def test_import_csv(self):
+        path = os.path.join(self.directory.name, 'polls.csv')
+        with open(path, 'w', newline='') as f:
+            writer = csv.writer(f)
+            writer.writerow(['question_text', 'pub_date', 'category', 'choices'])
+            writer.writerow(['Pizza or pasta?', '2022-03-21 16:31', 'food', 'Pizza|Pasta'])
+        call_command('import_polls', path, stdout=StringIO())
+        question = Question.objects.get()
+        self.assertEqual([choice.choice_text for choice in question.choice_set.all()], ['Pizza', 'Pasta'])
+
+    def test_resume_after_failure(self):
+        """
+        A broken record stops the import, committed chunks are kept and the next run
+        continues after them
+        """
+        records = self.records(4)
+        del records[3]['question_text']
+        path = self.write_jsonl(records)
+        with self.assertRaisesMessage(CommandError, 'line 4'):
+            call_command('import_polls', path, '--chunk-size', '2', stdout=StringIO())
+        self.assertEqual(Question.objects.count(), 2)
+        self.write_jsonl(self.records(4))
+        out = StringIO()
+        call_command('import_polls', path, '--chunk-size', '2', stdout=out)
+        self.assertIn('Resuming after 2 records', out.getvalue())
+        self.assertEqual(
+            sorted(Question.objects.values_list('question_text', flat=True)),
+            ['Question 0', 'Question 1', 'Question 2', 'Question 3'],
+        )
+
+
+#test cases for the streaming export
+class ExportTests(TestCase):
+
+    def setUp(self):
+        category = Category.objects.create(name='Food', slug='food')
+        self.question = create_question(question_text="Pizza, or pasta?", days=-5)
+        self.question.question_category = category
+        self.question.save()
+        create_two_choices(self.question)
+        self.empty_question = create_question(question_text="No choices", days=-5)
+        User.objects.create_user('staff', password='secret', is_staff=True)
+
+    def test_export_requires_staff(self):
+        response = self.client.get(reverse('polls:export'))
+        self.assertEqual(response.status_code, 302)
+
+    @override_settings(POLLS_EXPORT_CHUNK_SIZE=1)
+    def test_export_csv(self):
+        """
+        One row per choice, choices are fetched once per chunk of questions
+        """
+        self.client.login(username='staff', password='secret')
+        with self.assertNumQueries(5):
+            #session and user, 2 chunks of questions with their choices, empty last chunk
+            response = self.client.get(reverse('polls:export'))
+            rows = list(csv.reader(b''.join(response.streaming_content).decode().splitlines()))
+        self.assertEqual(response['Content-Type'], 'text/csv')
+        self.assertEqual(rows[0][:4], ['question_id', 'question_text', 'pub_date', 'category'])
+        self.assertEqual([row[1] for row in rows[1:]], ["Pizza, or pasta?", "Pizza, or pasta?", "No choices"])
+        self.assertEqual(rows[1][3], 'food')
+        self.assertEqual(rows[3][4:], ['', '', ''])
+
+    def test_export_ndjson_gzip(self):
+        self.client.login(username='staff', password='secret')
+        response = self.client.get(reverse('polls:export'), {'format': 'ndjson', 'gzip': '1'})
+        self.assertEqual(response['Content-Type'], 'application/gzip')
+        lines = gzip.decompress(b''.join(response.streaming_content)).decode().splitlines()
+        records = [json.loads(line) for line in lines]
+        self.assertEqual(records[0]['category'], 'food')
+        self.assertEqual([choice['choice_text'] for choice in records[0]['choices']], ["choice 1", "choice 2"])
+        self.assertEqual(records[1]['choices'], [])
+
+    def test_export_command_output_can_be_imported(self):
+        """
+        The NDJSON export is accepted by import_polls
+        """
+        with tempfile.TemporaryDirectory() as directory:
+            path = os.path.join(directory, 'polls.jsonl')
+            call_command('export_polls', '--format', 'ndjson', '--output', path)
+            call_command('import_polls', path, stdout=StringIO())
+        self.assertEqual(Question.objects.filter(question_text="Pizza, or pasta?").count(), 2)
+        self.assertEqual(Choice.objects.count(), 4)
+
+    def test_export_command_stdout(self):
+        out = StringIO()
+        call_command('export_polls', stdout=out)
+        self.assertEqual(len(out.getvalue().splitlines()), 4)
+
+
+#test cases for the benchmark helpers of bench_polls
+class BenchmarkTests(TestCase):
+
+    def test_seed_dataset_is_reproducible(self):
+        records1 = list(bench.generate_records(50, seed=1))
+        records2 = list(bench.generate_records(50, seed=1))
+        self.assertEqual(
+            [(r['category'], len(r['choices'])) for r in records1],
+            [(r['category'], len(r['choices'])) for r in records2],
+        )
+        bench.seed_dataset(50, categories=5, seed=1)
+        self.assertEqual(Question.objects.count(), 50)
+        self.assertEqual(Choice.objects.count(), sum(len(r['choices']) for r in records1))
+        self.assertEqual(update_question_counters(), 50)
+        self.assertEqual(find_counter_drift(), [])
+
+    def test_run_benchmarks(self):
+        bench.seed_dataset(30, categories=3)
+        results = bench.run_benchmarks(bench.ClientDriver(self.client), requests=3, warmup=1)
+        self.assertEqual(set(results), {'index', 'detail', 'results', 'results_json', 'results_batch', 'search', 'category'})
+        for result in results.values():
+            self.assertEqual((result['requests'], result['errors']), (3, 0))
+            self.assertLessEqual(result['p50_ms'], result['p99_ms'])
+        self.assertEqual(results['detail']['queries_per_request'], 0)
+
+    def test_measure_connections(self):
+        """
+        Open live results streams are held by the event loop, not by threads
+        """
+        bench.seed_dataset(5, categories=1)
+        url = bench.stream_url()
+        #warm the question cache, so the worker threads don't need the test transaction
+        self.client.get(url.replace('stream/', ''))
+        asgi = bench.measure_connections('asgi', url, 100)
+        #only the event loop and executor threads, independent of the connections
+        self.assertLess(asgi['threads'], 10, asgi)
+        self.assertEqual(hub.stats()['subscribers'], 0)
+        wsgi = bench.measure_connections('wsgi', url, 20)
+        self.assertGreater(wsgi['threads'], asgi['threads'])
+
+    def test_admin_benchmarks(self):
+        """
+        Changelist and change form render with a constant number of queries
+        """
+        bench.seed_dataset(30, categories=3)
+        results = bench.run_benchmarks(
+            bench.ClientDriver(bench.admin_client()), bench.admin_endpoints(), requests=3, warmup=1)
+        self.assertEqual(set(results), {'admin_changelist', 'admin_search', 'admin_change'})
+        for result in results.values():
+            self.assertEqual(result['errors'], 0)
+        queries = results['admin_changelist']['queries_per_request']
+        bench.seed_dataset(60, categories=6, seed=1)
+        results = bench.run_benchmarks(
+            bench.ClientDriver(bench.admin_client()), bench.admin_endpoints()[:1], requests=3, warmup=1)
+        self.assertEqual(results['admin_changelist']['queries_per_request'], queries)
+
+    def test_ballot_ingest(self):
+        bench.seed_dataset(30, categories=3)
+        before = Question.objects.aggregate(votes=Sum('total_votes'))['votes']
+        result = bench.ballot_ingest(batches=2, batch_size=100)
+        self.assertEqual(result['votes'], 200)
+        self.assertEqual(Question.objects.aggregate(votes=Sum('total_votes'))['votes'], before + 200)
+
+    def test_compare_results(self):
+        baseline = {'index': {'rps': 100, 'p95_ms': 10, 'queries_per_request': 2}}
+        self.assertEqual(bench.compare_results(
+            {'index': {'rps': 95, 'p95_ms': 10.5, 'queries_per_request': 2}}, baseline, 0.1), [])
+        regressions = bench.compare_results(
+            {'index': {'rps': 50, 'p95_ms': 20, 'queries_per_request': 3}}, baseline, 0.1)
+        self.assertEqual(len(regressions), 3)
+
+
+#test cases for the shared base template and the hashed static files
+class StaticFilesTests(TestCase):
+
+    def setUp(self):
+        static_root = tempfile.TemporaryDirectory()
+        self.addCleanup(static_root.cleanup)
+        storages = {
+            'default': {'BACKEND': 'django.core.files.storage.FileSystemStorage'},
+            'staticfiles': {'BACKEND': 'mysite.staticfiles.GzipManifestStaticFilesStorage'},
+        }
+        settings_override = override_settings(STATIC_ROOT=static_root.name, STORAGES=storages)
+        settings_override.enable()
+        self.addCleanup(settings_override.disable)
+        call_command('collectstatic', interactive=False, verbosity=0)
+        question_cache.get_cache().clear()
+
+    def stylesheet_url(self):
+        response = self.client.get(reverse('polls:index'))
+        self.assertTemplateUsed(response, 'polls/base.html')
+        return re.search(r'href="([^"]+\.css)"', response.content.decode()).group(1)
+
+    def test_hashed_stylesheet_is_immutable(self):
+        """
+        Pages link the content-hashed stylesheet, which is cached without revalidation
+        """
+        url = self.stylesheet_url()
+        self.assertRegex(url, r'^/static/polls/style\.[0-9a-f]{12}\.css$')
+        response = self.client.get(url)
+        self.assertEqual(response['Cache-Control'], 'public, max-age=31536000, immutable')
+        self.assertEqual(response['Content-Type'], 'text/css')
+        self.assertIn(b'.header', b''.join(response.streaming_content))
+
+    def test_gzip_variant(self):
+        url = self.stylesheet_url()
+        response = self.client.get(url, HTTP_ACCEPT_ENCODING='gzip, deflate')
+        self.assertEqual(response['Content-Encoding'], 'gzip')
+        self.assertIn(b'.header', gzip.decompress(b''.join(response.streaming_content)))
+        self.assertEqual(response['Vary'], 'Accept-Encoding')
+
+    def test_unhashed_name_is_revalidated(self):
+        response = self.client.get('/static/polls/style.css')
+        self.assertEqual(response['Cache-Control'], 'public, max-age=0, must-revalidate')
+        response = self.client.get('/static/polls/style.css', HTTP_IF_MODIFIED_SINCE=response['Last-Modified'])
+        self.assertEqual(response.status_code, 304)
+        self.assertEqual(self.client.get('/static/../manage.py').status_code, 404)
+
+
+#test cases for the primary/replica database routing
+@override_settings(DATABASE_REPLICAS=['replica1'], READ_YOUR_WRITES_SECONDS=5)
+class ReplicaRoutingTests(SimpleTestCase):
+
+    def route(self, method, path, **extra):
+        """
+        Database the polls reads of a request would use
+        """
+        router = PrimaryReplicaRouter()
+        def view(request):
+            response = HttpResponse(router.db_for_read(Question))
+            response.status_code = 302 if request.method == 'POST' else 200
+            return response
+        request = getattr(RequestFactory(), method)(path, **extra)
+        response = ReplicaRoutingMiddleware(view)(request)
+        return response.content.decode(), response
+
+    def test_reads_of_polls_pages_go_to_replicas(self):
+        self.assertEqual(self.route('get', '/polls/')[0], 'replica1')
+        self.assertEqual(self.route('get', '/polls/1/results/')[0], 'replica1')
+        self.assertEqual(self.route('get', '/admin/polls/question/')[0], 'default')
+        #outside of requests (commands, threads) everything uses the primary
+        self.assertEqual(PrimaryReplicaRouter().db_for_read(Question), 'default')
+        self.assertEqual(PrimaryReplicaRouter().db_for_write(Question), 'default')
+
+    def test_read_your_writes(self):
+        """
+        After a vote the client reads from the primary until the cookie expires
+        """
+        database, response = self.route('post', '/polls/1/vote/')
+        self.assertEqual(database, 'default')
+        cookie = response.cookies[routers.PIN_COOKIE]
+        self.assertEqual(cookie['max-age'], 5)
+        self.assertEqual(self.route('get', '/polls/1/results/', HTTP_COOKIE=f'{routers.PIN_COOKIE}={cookie.value}')[0], 'default')
+        expired = f'{time.time() - 1:.3f}'
+        self.assertEqual(self.route('get', '/polls/1/results/', HTTP_COOKIE=f'{routers.PIN_COOKIE}={expired}')[0], 'replica1')
+
+    async def test_async_requests(self):
+        async def view(request):
+            return HttpResponse(PrimaryReplicaRouter().db_for_read(Question))
+        response = await ReplicaRoutingMiddleware(view)(AsyncRequestFactory().get('/polls/'))
+        self.assertEqual(response.content, b'replica1')
+
+    def test_copy_database(self):
+        with tempfile.TemporaryDirectory() as directory:
+            primary, replica = os.path.join(directory, 'primary.sqlite3'), os.path.join(directory, 'replica.sqlite3')
+            with sqlite3.connect(primary) as db:
+                db.execute('CREATE TABLE votes (n INTEGER)')
+                db.execute('INSERT INTO votes VALUES (42)')
+            db.close()
+            copy_database(primary, replica)
+            db = sqlite3.connect(replica)
+            self.assertEqual(db.execute('SELECT n FROM votes').fetchall(), [(42,)])
+            db.close()
+
+
+#test cases for the shared cache system check
+class SharedCacheCheckTests(SimpleTestCase):
+
+    def test_single_process(self):
+        self.assertEqual(checks.check_shared_cache(None), [])
+
+    @override_settings(POLLS_WORKER_PROCESSES=4)
+    def test_per_process_cache_with_workers(self):
+        self.assertEqual([error.id for error in checks.check_shared_cache(None)], ['polls.E001', 'polls.E002'])
+
+    @override_settings(
+        POLLS_WORKER_PROCESSES=4,
+        CACHES={'default': {'BACKEND': 'django.core.cache.backends.redis.RedisCache', 'LOCATION': 'redis://cache:6379/0'}},
+        POLLS_VOTE_DEDUP={'BACKEND': 'cache', 'TTL': 600, 'CACHE': 'default'},
+    )
+    def test_shared_cache_with_workers(self):
+        self.assertEqual(checks.check_shared_cache(None), [])
+
+
+#test cases for the sqlite production profile
+"""
+The profile is chosen when the settings are imported, so every check runs in a worker
+process of its own (PROFILE_PROBE) on a migrated sqlite file, like a deployment with
+several workers. Votes take the real write path: the vote buffer, which retries lock
+errors as configured in POLLS_VOTE_BUFFER, and apply_vote_increments().
+"""
+PROFILE_PROBE = """
+import json, sys, threading
+import django
+django.setup()
+from django.db import connection, connections
+from django.db.models import Sum
+from django.utils import timezone
+from polls.models import Question, Choice
+from polls.votebuffer import get_vote_buffer
+
+def pragma(name):
+    with connection.cursor() as cursor:
+        cursor.execute(f'PRAGMA {name}')
+        return cursor.fetchone()[0]
+
+result = {name: pragma(name) for name in ('journal_mode', 'synchronous', 'cache_size', 'busy_timeout')}
+result['errors'] = []
+if sys.argv[1] == 'setup':
+    question = Question.objects.create(question_text='Busy question.', pub_date=timezone.now())
+    result['choices'] = [question.choice_set.create(choice_text=f'choice {i}', votes=0).id for i in range(4)]
+    result['question'] = question.id
+elif sys.argv[1] == 'vote':
+    question_id, votes, choice_ids = int(sys.argv[2]), int(sys.argv[3]), json.loads(sys.argv[4])
+    voting = threading.Event()
+
+    def reader():
+        try:
+            while not voting.is_set():
+                Choice.objects.filter(question_id=question_id).aggregate(Sum('votes'))
+        except Exception as e:
+            result['errors'].append(repr(e))
+        finally:
+            connections.close_all()
+
+    readers = [threading.Thread(target=reader) for i in range(2)]
+    for thread in readers:
+        thread.start()
+    try:
+        for i in range(votes):
+            get_vote_buffer().add(question_id, choice_ids[i % len(choice_ids)])
+    except Exception as e:
+        result['errors'].append(repr(e))
+    voting.set()
+    for thread in readers:
+        thread.join()
+    result['lock_retries'] = get_vote_buffer().stats()['lock_retries']
+print(json.dumps(result))
+"""
+
+
+class SQLiteProfileTests(SimpleTestCase):
+
+    def setUp(self):
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        self.path = os.path.join(directory.name, 'db.sqlite3')
+        startup.prepare_database(self.path)
+
+    def probe(self, *args, profile='production'):
+        return subprocess.Popen(
+            [sys.executable, '-c', PROFILE_PROBE, *map(str, args)], cwd=startup.PROJECT_DIR,
+            env={**os.environ, 'DJANGO_DB_NAME': self.path, 'DJANGO_DB_PROFILE': profile},
+            stdout=subprocess.PIPE, text=True,
+        )
+
+    def result(self, process):
+        output, _ = process.communicate(timeout=120)
+        self.assertEqual(process.returncode, 0)
+        return json.loads(output.splitlines()[-1])
+
+    def test_pragmas_come_from_the_profile(self):
+        """
+        Django connections get the PRAGMAs of the production profile from the connection_created hook
+        """
+        #first, WAL mode is kept by the database file once it is set
+        result = self.result(self.probe('pragmas', profile='development'))
+        self.assertEqual((result['journal_mode'], result['synchronous'], result['cache_size']), ('delete', 2, -2000))
+        result = self.result(self.probe('pragmas'))
+        #synchronous NORMAL is 1
+        self.assertEqual((result['journal_mode'], result['synchronous'], result['cache_size']), ('wal', 1, -65536))
+        self.assertEqual(result['busy_timeout'], 5000)
+
+    def test_retry_on_lock(self):
+        """
+        Lock errors are retried, other errors are raised right away
+        """
+        calls = []
+
+        def locked_twice():
+            calls.append(1)
+            if len(calls) < 3:
+                raise sqlite3.OperationalError('database is locked')
+            return 'done'
+
+        def missing_table():
+            calls.append(1)
+            raise sqlite3.OperationalError('no such table: choice')
+
+        self.assertEqual(retry_on_lock(locked_twice, 5, 0, errors=(sqlite3.OperationalError,)), 'done')
+        self.assertEqual(len(calls), 3)
+        with self.assertRaises(sqlite3.OperationalError):
+            retry_on_lock(missing_table, 5, 0, errors=(sqlite3.OperationalError,))
+        self.assertEqual(len(calls), 4)
+
+    def test_concurrent_reads_and_votes(self):
+        """
+        Workers voting and reading at the same time on the WAL database finish
+        without lock errors and without lost votes
+        """
+        setup = self.result(self.probe('setup'))
+        voters = [self.probe('vote', setup['question'], 100, json.dumps(setup['choices'])) for i in range(4)]
+        results = [self.result(process) for process in voters]
+        self.assertEqual([result['errors'] for result in results], [[]] * 4)
+        self.assertTrue(all(result['journal_mode'] == 'wal' for result in results))
+        with sqlite3.connect(self.path) as db:
+            votes = db.execute('SELECT SUM(votes) FROM polls_choice WHERE question_id = ?', (setup['question'],)).fetchone()[0]
+            total = db.execute('SELECT total_votes FROM polls_question WHERE id = ?', (setup['question'],)).fetchone()[0]
+        db.close()
+        self.assertEqual((votes, total), (400, 400))
+
+
+class StartupBudgetTests(SimpleTestCase):
+    """
+    Cold starts of the WSGI and ASGI applications stay within STARTUP_BUDGET
+    """
+
+    @classmethod
+    def setUpClass(cls):
+        super().setUpClass()
+        directory = tempfile.TemporaryDirectory()
+        cls.addClassCleanup(directory.cleanup)
+        cls.database = os.path.join(directory.name, 'db.sqlite3')
+        startup.prepare_database(cls.database)
+
+    def test_parse_importtime(self):
+        output = (
+            'import time: self [us] | cumulative | imported package\n'
+            'import time:       120 |        120 |   _io\n'
+            'import time:      2045 |       3100 | polls.views\n'
+            'Traceback (most recent call last):\n'
+        )
+        self.assertEqual(startup.parse_importtime(output), [('_io', 120, 120), ('polls.views', 2045, 3100)])
+
+    def test_unwanted_imports(self):
+        self.assertEqual(startup.find_unwanted_imports(), [])
+        #prefixes match whole module names, relative imports are project modules
+        self.assertEqual(
+            startup.find_unwanted_imports({'polls.models': ('django.db.models', 'datetim', 'models')}),
+            [('polls.models', 'django.db.models'), ('polls.models', 'django.db.models.functions')],
+        )
 
+    def test_startup_budget(self):
+        results = startup.measure_startup('/polls/', runs=1, database=self.database)
+        self.assertEqual(set(results), {'wsgi', 'asgi'})
+        for mode, result in results.items():
+            self.assertEqual(result['status'], 200)
+            self.assertEqual(result['unwanted'], [])
+            self.assertTrue(result['slowest_imports'])
+        self.assertEqual(startup.check_budget(results), [])
@@ -0,0 +1,104 @@
+# Vote trends: append-only vote log compacted into hourly and daily buckets
+'''
+Every flush of the vote buffer appends one VoteEvent per choice with the number
+of votes it received. rollup_votes() (manage.py rollup_votes) compacts the log:
+
+    VoteEvent   (choice, created_at, count)     raw, pruned after the retention window
+    VoteRollup  (choice, 'hour'|'day', bucket, votes)
+
+Buckets are recomputed from the log rather than incremented, so running the
+rollup again (or concurrently) gives the same result. Only hours that are over
+are rolled up, a run starts again at the newest hourly bucket to pick up votes
+of transactions that committed late. Trend queries only read VoteRollup, so
+they cost one row per choice and bucket no matter how many votes there were.
+'''
+
+import datetime
+
+from django.conf import settings
+from django.db import transaction
+from django.db.models import Max, Sum
+from django.db.models.functions import TruncDay, TruncHour
+from django.utils import timezone
+
+from .models import VoteEvent, VoteRollup
+
+
+def events_enabled():
+    return getattr(settings, 'POLLS_VOTE_EVENTS', True)
+
+
+def retention():
+    return datetime.timedelta(days=getattr(settings, 'POLLS_VOTE_EVENT_RETENTION_DAYS', 7))
+
+
+def log_votes(choice_counts, now=None):
+    #has to run in the transaction writing the votes
+    if events_enabled() and choice_counts:
+        now = now or timezone.now()
+        VoteEvent.objects.bulk_create([
+            VoteEvent(choice_id=choice_id, created_at=now, count=count)
+            for choice_id, count in choice_counts.items()
+        ])
+
+
+def hour_start(value):
+    return value.replace(minute=0, second=0, microsecond=0)
+
+
+def day_start(value):
+    return timezone.localtime(value).replace(hour=0, minute=0, second=0, microsecond=0)
+
+
+def _store(period, rows):
+    VoteRollup.objects.bulk_create(
+        [VoteRollup(choice_id=choice_id, period=period, bucket=bucket, votes=votes) for choice_id, bucket, votes in rows],
+        update_conflicts=True,
+        unique_fields=['choice', 'period', 'bucket'],
+        update_fields=['votes'],
+        batch_size=500,
+    )
+
+
+def rollup_votes(now=None):
+    """
+    Compute the hourly buckets of all closed hours since the last run and the
+    daily buckets containing them, then prune raw events older than the
+    retention window that are rolled up. Returns (hourly buckets, pruned events).
+    """
+    now = now or timezone.now()
+    cutoff = hour_start(now)
+    with transaction.atomic():
+        start = VoteRollup.objects.filter(period='hour').aggregate(start=Max('bucket'))['start']
+        events = VoteEvent.objects.filter(created_at__lt=cutoff)
+        if start is not None:
+            events = events.filter(created_at__gte=start)
+        hours = list(
+            events.annotate(bucket=TruncHour('created_at')).order_by()
+            .values_list('choice_id', 'bucket').annotate(votes=Sum('count'))
+        )
+        _store('hour', hours)
+        if hours:
+            first_day = day_start(min(bucket for choice_id, bucket, votes in hours))
+            days = (
+                VoteRollup.objects.filter(period='hour', bucket__gte=first_day)
+                .annotate(day=TruncDay('bucket')).order_by()
+                .values_list('choice_id', 'day').annotate(total=Sum('votes'))
+            )
+            _store('day', list(days))
+        #events of the current hour are needed by the next run, whatever the retention
+        pruned, deleted = VoteEvent.objects.filter(created_at__lt=min(now - retention(), cutoff)).delete()
+    return len(hours), pruned
+
+
+def question_trend(question_id, period='hour', since=None):
+    """
+    Return [(bucket, {choice_id: votes})] of a question, oldest bucket first
+    """
+    rows = VoteRollup.objects.filter(choice__question_id=question_id, period=period)
+    if since is not None:
+        rows = rows.filter(bucket__gte=since)
+    trend = {}
+    for choice_id, bucket, votes in rows.order_by('bucket').values_list('choice_id', 'bucket', 'votes'):
+        trend.setdefault(bucket, {})[choice_id] = votes
+    return list(trend.items())
@@ -1,14 +1,43 @@
 #urlconf of app
 
+from django.conf import settings
 from django.urls import path        # path() returns a URLPattern object
 from . import views
+from .pagecache import cached_page
+
+#ASGI deployments can use the native async views (see async_views.py)
+if settings.POLLS_ASYNC_VIEWS:
+    from . import async_views
+    index_view = async_views.index
+    detail_view = async_views.detail
+    results_view = async_views.results
+    vote_view = async_views.vote
+    category_view = async_views.show_category
+else:
+    index_view = views.IndexView.as_view()
+    detail_view = views.DetailView.as_view()
+    results_view = views.ResultsView.as_view()
+    vote_view = views.vote
+    category_view = views.show_category
+
+#the index and category pages are the same for all visitors (see pagecache.py)
+index_view = cached_page(index_view)
+category_view = cached_page(category_view, key_params=('after',))
 
 app_name = 'polls'
 urlpatterns = [
-    path('', views.IndexView.as_view(), name='index'),
-    path('<int:pk>/', views.DetailView.as_view(), name='detail'),
-    path('<int:pk>/results/', views.ResultsView.as_view(), name='results'),
-    path('<int:question_id>/vote/', views.vote, name='vote'),
+    path('', index_view, name='index'),
+    #these have to come before the category path, which would match them as well
+    path('export/', views.export_results, name='export'),
+    path('search/', views.search, name='search'),
+    path('results/batch', views.results_batch, name='results_batch'),
+    path('ballots/', views.ballots, name='ballots'),
+    path('<int:pk>/', detail_view, name='detail'),
+    path('<int:pk>/results/', results_view, name='results'),
+    path('<int:pk>/results/stream/', views.results_stream, name='results_stream'),
+    path('<int:pk>/results.json', views.results_json, name='results_json'),
+    path('<int:pk>/trend.json', views.trend_json, name='trend_json'),
+    path('<int:question_id>/vote/', vote_view, name='vote'),
     # category path
-    path('<slug:slug>/', views.show_category, name='category'),
-]
\ No newline at end of file
+    path('<slug:slug>/', category_view, name='category'),
+]
@@ -5,16 +5,35 @@ request -> response (action)
 '''
 
 
-from re import template
-from unicodedata import category
+import base64
+import binascii
+import datetime
+import json
+
+from asgiref.sync import sync_to_async
+from django.conf import settings
+from django.contrib.admin.views.decorators import staff_member_required
+from django.core.exceptions import BadRequest
+from django.core.handlers.asgi import ASGIRequest
 from django.shortcuts import render, get_object_or_404
-from django.http import HttpResponse, HttpResponseRedirect
+from django.http import Http404, HttpResponse, HttpResponseRedirect, JsonResponse, StreamingHttpResponse
+from django.db.models import Q
 from django.urls import reverse
 from django.views import generic
+from django.views.decorators.cache import cache_control
+from django.views.decorators.csrf import csrf_exempt
+from django.views.decorators.http import condition, require_POST, require_safe
 from django.utils import timezone
-from django.db.models import Count
 
-from .models import Question, Choice, Category
+from .ballots import ingest_ballots, is_authorized, max_ballots
+from .cache import aget_question_with_choices, get_question_with_choices, get_versions, version_timestamp
+from .dedup import get_dedup_store, new_vote_token, vote_token_key
+from .live import hub, live_results_enabled
+from .models import MAX_ID, Question, Choice, Category
+from .scheduler import ensure_published
+from .search import search_questions
+from .trends import question_trend
+from .votebuffer import get_vote_buffer
 
 # list of recently published questions 
 class IndexView(generic.ListView):
@@ -36,67 +55,423 @@ class IndexView(generic.ListView):
         #return the last 8 published questions, not including future ones
         #lte => 'less than or equal
         """
-        Using the annotate function to get count of choices associated with a question 
-        and filter questions without sufficient choice count
+        Questions without sufficient choice count are filtered with the denormalized
+        choice_count column, so no join/GROUP BY over the choice table is needed
         """
-        return Question.objects.annotate(number_of_choices=Count('choice')).filter(
-            number_of_choices__gte=2
-            ).filter(
-            pub_date__lte=timezone.now()
-            ).order_by('-pub_date')[:8]
+        #questions whose pub_date has been reached go live first (see scheduler.py)
+        ensure_published()
+        return Question.objects.published().order_by('-pub_date')[:8]
 
 
-#detailed view for a chosen question
-class DetailView(generic.DetailView):
+#base for views showing a question with its choices
+"""
+The question and its choices come from the read-through cache (cache.py),
+so hot polls are served without database queries.
+"""
+class CachedQuestionMixin:
     model = Question
+
+    def get_object(self, queryset=None):
+        try:
+            question, self.choices = get_question_with_choices(self.kwargs['pk'])
+        except Question.DoesNotExist:
+            raise Http404('No question found matching the query')
+        if not self.is_visible(question):
+            raise Http404('No question found matching the query')
+        return question
+
+    def is_visible(self, question):
+        return True
+
+    def get_context_data(self, **kwargs):
+        context = super().get_context_data(**kwargs)
+        context['choices'] = self.choices
+        return context
+
+
+#detailed view for a chosen question
+class DetailView(CachedQuestionMixin, generic.DetailView):
     #override auto-generated template name
     template_name = 'polls/detail.html'
 
-    def get_queryset(self):
+    def get_object(self, queryset=None):
+        #a question whose pub_date was reached is published before it's looked up
+        ensure_published()
+        return super().get_object(queryset)
+
+    def is_visible(self, question):
         #exclude any question that aren't published yet
         """
         Access to questions with insufficient amount of choices has to be prevented through url guessing as well
         """
-        return Question.objects.annotate(number_of_choices=Count('choice')).filter(
-            number_of_choices__gte=2
-            ).filter(
-            pub_date__lte=timezone.now())
-        #return Question.objects.filter(pub_date__lte=timezone.now())
+        return question.is_published()
+
+    def get_context_data(self, **kwargs):
+        context = super().get_context_data(**kwargs)
+        context['vote_token'] = new_vote_token()
+        return context
 
 #results view for a chosen question (votes)
-class ResultsView(generic.DetailView):
-    model = Question
+class ResultsView(CachedQuestionMixin, generic.DetailView):
     #override auto-generated template name
     template_name = 'polls/results.html'
 
+    def get_context_data(self, **kwargs):
+        context = super().get_context_data(**kwargs)
+        context['live_results'] = live_results_enabled()
+        return context
+
+
+#live results as server-sent events
+"""
+Sends the current results as a 'results' event, followed by a 'votes' event with
+the vote deltas whenever votes were flushed (at most once per POLLS_LIVE_TICK_MS).
+Both carry the sequence of the last vote batch they include (see live.py).
+Only ASGI servers can hold the connection open, under WSGI the stream answers
+204 No Content, which tells the browser to stop reconnecting.
+"""
+def sse_event(event, data):
+    return f'event: {event}\ndata: {json.dumps(data, separators=(",", ":"))}\n\n'.encode()
+
+
+def results_event(question, choices, sequence):
+    return sse_event('results', {
+        'question': question.id,
+        'seq': sequence,
+        'total': question.total_votes,
+        'choices': {choice.id: choice.votes for choice in choices},
+    })
+
+
+def read_results(question_id):
+    """
+    Return (question, choices, sequence of the last vote batch they include):
+    no vote of this process is written while the hub's write_lock is held
+    """
+    with hub.write_lock:
+        question, choices = get_question_with_choices(question_id)
+        return question, choices, hub.sequence(question_id)
+
+
+async def results_stream(request, pk):
+    try:
+        question, choices = await aget_question_with_choices(pk)
+    except Question.DoesNotExist:
+        raise Http404('No question found matching the query')
+    if not isinstance(request, ASGIRequest):
+        return HttpResponse(status=204)
+
+    async def events():
+        #subscribe before reading the results again, so no vote is missed in between,
+        #the votes the results include already are dropped by their sequence
+        subscription = hub.subscribe(question.id)
+        try:
+            current, current_choices, subscription.sequence = await sync_to_async(read_results)(question.id)
+            yield results_event(current, current_choices, subscription.sequence)
+            heartbeat = getattr(settings, 'POLLS_LIVE_HEARTBEAT_S', 15)
+            while True:
+                deltas = await subscription.next(timeout=heartbeat)
+                if deltas:
+                    yield sse_event('votes', {'question': question.id, 'seq': subscription.sequence, 'deltas': deltas})
+                else:
+                    yield b': keep-alive\n\n'
+        finally:
+            hub.unsubscribe(question.id, subscription)
+
+    response = StreamingHttpResponse(events(), content_type='text/event-stream')
+    response['Cache-Control'] = 'no-cache'
+    response['X-Accel-Buffering'] = 'no'
+    return response
+
+
+#results as JSON for embeds and dashboards
+"""
+The ETag and Last-Modified headers are derived from the cache versions of the
+question, which change with every vote. Conditional requests of clients that
+are up to date are answered with 304 without touching the database.
+Like the HTML views, only published questions are shown.
+"""
+def get_published_question(pk):
+    ensure_published()
+    try:
+        question, choices = get_question_with_choices(pk)
+    except Question.DoesNotExist:
+        raise Http404('No question found matching the query')
+    if not question.is_published():
+        raise Http404('No question found matching the query')
+    return question, choices
+
+
+def results_etag(request, pk):
+    get_published_question(pk)
+    generation, version = get_versions(pk)
+    return f'{pk}-{generation}-{version}'
+
+
+def results_last_modified(request, pk):
+    get_published_question(pk)
+    generation, version = get_versions(pk)
+    timestamp = max(version_timestamp(generation), version_timestamp(version))
+    return datetime.datetime.fromtimestamp(timestamp, tz=datetime.timezone.utc)
+
+
+@require_safe
+@cache_control(public=True, max_age=getattr(settings, 'POLLS_RESULTS_JSON_MAX_AGE', 5))
+@condition(etag_func=results_etag, last_modified_func=results_last_modified)
+def results_json(request, pk):
+    question, choices = get_published_question(pk)
+    return JsonResponse({
+        'id': question.id,
+        'question': question.question_text,
+        'total': question.total_votes,
+        'choices': [
+            {'id': choice.id, 'text': choice.choice_text, 'votes': choice.votes}
+            for choice in choices
+        ],
+    })
+
+
+#results of many questions at once for dashboards
+"""
+?ids=1,2,3 (at most POLLS_BATCH_RESULTS_MAX_IDS), unknown and unpublished ids are
+skipped. All questions come from one query over the choices joined with their
+questions, the votes of sharded counters are added by a subquery.
+"""
+def parse_ids(value, max_ids):
+    try:
+        ids = list(dict.fromkeys(int(pk) for pk in value.split(',') if pk.strip()))
+    except ValueError:
+        raise BadRequest('ids has to be a comma separated list of numbers')
+    if not ids:
+        raise BadRequest('ids is required')
+    if len(ids) > max_ids:
+        raise BadRequest(f'At most {max_ids} ids are allowed')
+    if not all(1 <= pk <= MAX_ID for pk in ids):
+        raise BadRequest(f'ids have to be between 1 and {MAX_ID}')
+    return ids
+
+
+@require_safe
+@cache_control(public=True, max_age=getattr(settings, 'POLLS_RESULTS_JSON_MAX_AGE', 5))
+def results_batch(request):
+    ids = parse_ids(request.GET.get('ids', ''), getattr(settings, 'POLLS_BATCH_RESULTS_MAX_IDS', 100))
+    ensure_published()
+    rows = (
+        Choice.objects.filter(question_id__in=ids, question__is_live=True, question__choice_count__gte=2)
+        .with_shard_votes().order_by('question_id', 'id')
+        .values_list('question_id', 'question__question_text', 'question__total_votes',
+                     'id', 'choice_text', 'votes', 'shard_votes')
+    )
+    questions = {}
+    for question_id, question_text, total_votes, choice_id, choice_text, votes, shard_votes in rows:
+        question = questions.setdefault(question_id, {
+            'id': question_id, 'question': question_text, 'total': total_votes, 'choices': [],
+        })
+        question['total'] += shard_votes
+        question['choices'].append({'id': choice_id, 'text': choice_text, 'votes': votes + shard_votes})
+    return JsonResponse(
+        {'questions': [questions[pk] for pk in ids if pk in questions]},
+        json_dumps_params={'separators': (',', ':')},
+    )
+
+
+#votes over time per hour or day, read from the rollups of the vote log (see trends.py)
+TREND_DAYS = {'hour': 2, 'day': 30}
+
+
+@require_safe
+@cache_control(public=True, max_age=getattr(settings, 'POLLS_TREND_JSON_MAX_AGE', 300))
+def trend_json(request, pk):
+    period = request.GET.get('period', 'hour')
+    if period not in TREND_DAYS:
+        raise BadRequest('period has to be hour or day')
+    try:
+        days = int(request.GET.get('days', TREND_DAYS[period]))
+    except ValueError:
+        raise BadRequest('days has to be a number')
+    if not 1 <= days <= 366:
+        raise BadRequest('days has to be between 1 and 366')
+    question, choices = get_published_question(pk)
+    trend = question_trend(question.id, period, timezone.now() - datetime.timedelta(days=days))
+    return JsonResponse({
+        'id': question.id,
+        'period': period,
+        'choices': [{'id': choice.id, 'text': choice.choice_text} for choice in choices],
+        'buckets': [
+            {'start': bucket.isoformat(), 'total': sum(votes.values()), 'votes': votes}
+            for bucket, votes in trend
+        ],
+    })
+
+
+#export of all questions with choices and votes for analysts
+"""
+?format=csv|ndjson, ?gzip=1 compresses the download on the fly
+"""
+@staff_member_required
+@require_safe
+def export_results(request):
+    #imported on use, workers that never export don't load it (see startup.py)
+    from .export import CONTENT_TYPES, iter_export
+    format = request.GET.get('format', 'csv')
+    if format not in CONTENT_TYPES:
+        raise BadRequest('Unknown export format')
+    compress = request.GET.get('gzip') == '1'
+    filename = f'polls.{format}' + ('.gz' if compress else '')
+    chunk_size = getattr(settings, 'POLLS_EXPORT_CHUNK_SIZE', 1000)
+    response = StreamingHttpResponse(
+        iter_export(format, chunk_size, compress),
+        content_type='application/gzip' if compress else CONTENT_TYPES[format],
+    )
+    response['Content-Disposition'] = f'attachment; filename="{filename}"'
+    return response
+
 
 #voting handler
+"""
+The form carries an idempotency token (see dedup.py): a repeated submission of the
+same form is redirected to the results without touching the database.
+"""
 def vote(request, question_id):
-    question = get_object_or_404(Question, pk=question_id)
+    token_key = vote_token_key(request, question_id)
+    dedup = get_dedup_store()
+    if token_key is not None and not dedup.claim(token_key):
+        return HttpResponseRedirect(reverse('polls:results', args=(question_id,)))
+    voted = False
     try:
-        #selected choice contains id of voted choice, accessed with name 'choice'
-        selected_choice = question.choice_set.get(pk=request.POST['choice'])
-    except (KeyError, Choice.DoesNotExist):
-        #Redisplaying question voting form in case missing vote
-        return render(request, 'polls/detail.html', {
-            'question': question,
-            'error_message': "You didn't select a choice",
-        })
-    else:
-        selected_choice.votes +=1
-        selected_choice.save()
+        question = get_object_or_404(Question, pk=question_id)
+        try:
+            #selected choice contains id of voted choice, accessed with name 'choice'
+            selected_choice = question.choice_set.only('id').get(pk=request.POST['choice'])
+        except (KeyError, ValueError, Choice.DoesNotExist):
+            #Redisplaying question voting form in case missing vote
+            question, choices = get_question_with_choices(question.id)
+            return render(request, 'polls/detail.html', {
+                'question': question,
+                'choices': choices,
+                'vote_token': new_vote_token(),
+                'error_message': "You didn't select a choice",
+            })
+        #a failed flush keeps the vote in the buffer, so the token counts as used from here on
+        voted = True
+        #the vote is buffered and written as 'votes = votes + n', see votebuffer.py
+        get_vote_buffer().add(question.id, selected_choice.id)
         #using HttpResponseRedirect prevents data being posted twice by hitting back button
         return HttpResponseRedirect(reverse('polls:results', args=(question_id,)))
+    finally:
+        if token_key is not None and not voted:
+            dedup.release(token_key)
+
+
+#bulk vote submission of kiosks and edge collectors (see ballots.py)
+"""
+Authenticated with an API key instead of a session, so there is no CSRF token to check.
+"""
+@csrf_exempt
+@require_POST
+def ballots(request):
+    if not is_authorized(request):
+        response = JsonResponse({'error': 'Invalid API key'}, status=401)
+        response['WWW-Authenticate'] = 'Bearer'
+        return response
+    try:
+        items = json.loads(request.body)['ballots']
+    except (ValueError, KeyError, TypeError):
+        raise BadRequest('Expected {"ballots": [[question_id, choice_id, count], ...]}')
+    if not isinstance(items, list):
+        raise BadRequest('ballots has to be a list')
+    if len(items) > max_ballots():
+        raise BadRequest(f'At most {max_ballots()} ballots are allowed per request')
+    #questions whose pub_date has been reached accept ballots right away
+    ensure_published()
+    accepted, votes, errors = ingest_ballots(items)
+    return JsonResponse({'accepted': accepted, 'votes': votes, 'rejected': len(errors), 'errors': errors})
+
+
+#keyset pagination cursors
+"""
+A cursor is the (pub_date, id) of the last question on a page, encoded to be opaque.
+The next page continues after it, so every page costs the same no matter how deep it is.
+"""
+def encode_cursor(question):
+    value = f'{question.pub_date.isoformat()}|{question.id}'
+    return base64.urlsafe_b64encode(value.encode()).decode().rstrip('=')
+
+
+def decode_cursor(cursor):
+    try:
+        value = base64.urlsafe_b64decode(cursor + '=' * (-len(cursor) % 4)).decode()
+        pub_date, pk = value.split('|')
+        pub_date, pk = datetime.datetime.fromisoformat(pub_date), int(pk)
+    except (binascii.Error, UnicodeDecodeError, ValueError):
+        raise BadRequest('Invalid cursor')
+    if not 1 <= pk <= MAX_ID:
+        raise BadRequest('Invalid cursor')
+    return pub_date, pk
 
 
 #category view
 """
 This takes a request and a slug as arguments.
 With the slug, questions can be filtered after category and only questions belonging 
-into the desired category are given to the template as context
+into the desired category are given to the template as context.
+The same visibility rules as on the index page apply, newest questions come first
+and the list is paginated with a cursor (?after=...).
 """
+def category_page_queryset(category, cursor):
+    """
+    Questions of the page after the cursor, with one extra row that tells whether there is a next page
+    """
+    page_size = getattr(settings, 'POLLS_CATEGORY_PAGE_SIZE', 20)
+    questions = Question.objects.published().filter(question_category=category).order_by('-pub_date', '-id')
+    if cursor:
+        pub_date, pk = decode_cursor(cursor)
+        questions = questions.filter(Q(pub_date__lt=pub_date) | Q(pub_date=pub_date, id__lt=pk))
+    return questions[:page_size + 1]
+
+
+def category_context(category, cursor, category_question_list):
+    page_size = getattr(settings, 'POLLS_CATEGORY_PAGE_SIZE', 20)
+    next_cursor = None
+    if len(category_question_list) > page_size:
+        category_question_list = category_question_list[:page_size]
+        next_cursor = encode_cursor(category_question_list[-1])
+    return {
+        'category_question_list': category_question_list,
+        'category_name': category.name,
+        'category_slug': category.slug,
+        'next_cursor': next_cursor,
+        'is_first_page': not cursor,
+    }
+
+
 def show_category(request, slug):
+    ensure_published()
     category = get_object_or_404(Category, slug=slug)
-    category_question_list = Question.objects.filter(question_category__slug=slug)
-    context = {'category_question_list': category_question_list, 'category_name': category.name}
-    return render(request, 'polls/category.html', context)
\ No newline at end of file
+    cursor = request.GET.get('after')
+    category_question_list = list(category_page_queryset(category, cursor))
+    return render(request, 'polls/category.html', category_context(category, cursor, category_question_list))
+
+
+#full-text search of published questions, ranked by relevance (see search.py)
+SEARCH_MAX_PAGES = 50
+
+
+def search(request):
+    query = request.GET.get('q', '').strip()[:200]
+    try:
+        page = int(request.GET.get('page', 1))
+    except ValueError:
+        raise BadRequest('Invalid page')
+    if not 1 <= page <= SEARCH_MAX_PAGES:
+        raise BadRequest('Invalid page')
+    page_size = getattr(settings, 'POLLS_SEARCH_PAGE_SIZE', 20)
+    ensure_published()
+    #one extra result tells whether there is a next page, without counting all matches
+    results = search_questions(query, page_size + 1, (page - 1) * page_size) if query else []
+    return render(request, 'polls/search.html', {
+        'query': query,
+        'search_question_list': results[:page_size],
+        'previous_page': page - 1 if page > 1 else None,
+        'next_page': page + 1 if len(results) > page_size and page < SEARCH_MAX_PAGES else None,
+    })
@@ -0,0 +1,252 @@
+# Write-behind buffer for votes
+'''
+Instead of a read-modify-write of a Choice row per vote, votes are collected in
+memory keyed by (question id, choice id) and applied in batches as single
+UPDATE ... SET votes = votes + n statements.
+
+Durability is configured with the POLLS_VOTE_BUFFER setting:
+    FLUSH_EVERY        flush once this many votes are pending (1 => every request)
+    FLUSH_INTERVAL_MS  flush pending votes at the latest after this many ms (0 => off)
+
+Writes that fail because the database is locked (SQLite allows one writer at a
+time) are retried LOCK_RETRIES times with exponential backoff, starting at
+LOCK_RETRY_DELAY_MS.
+'''
+
+import atexit
+import random
+import threading
+import time
+from collections import defaultdict
+
+from django.conf import settings
+from django.core.signals import setting_changed
+from django.db import OperationalError, connection, transaction
+from django.dispatch import receiver
+
+from .cache import invalidate_question
+from .live import hub
+from .models import Question, Choice
+from .shards import get_vote_shards, increment, increment_shards
+from .trends import log_votes
+
+
+DEFAULTS = {
+    'FLUSH_EVERY': 1,
+    'FLUSH_INTERVAL_MS': 0,
+    'LOCK_RETRIES': 5,
+    'LOCK_RETRY_DELAY_MS': 10,
+}
+
+
+def retry_on_lock(func, retries=5, delay=0.01, errors=(OperationalError,), on_retry=None):
+    """
+    Call func(), retrying with exponential backoff and jitter while it fails
+    with a 'database is locked' error
+    """
+    for attempt in range(retries + 1):
+        try:
+            return func()
+        except errors as e:
+            if 'locked' not in str(e) or attempt == retries:
+                raise
+            if on_retry is not None:
+                on_retry()
+            time.sleep(delay * 2 ** attempt * random.uniform(0.5, 1.5))
+
+
+def apply_vote_increments(increments):
+    """
+    Apply {(question_id, choice_id): n} increments to the database.
+    Rows receiving the same amount of votes share one UPDATE statement,
+    the increment is done by the database so concurrent writers can't
+    overwrite each other. Question.total_votes is incremented along with the choices,
+    cached questions are invalidated and the deltas are published to live viewers.
+    Votes of questions with sharded counters go to a shard instead (see shards.py).
+    The votes are appended to the vote event log for trends (see trends.py).
+    """
+    question_deltas = defaultdict(dict)
+    logged_counts = {}
+    for (question_id, choice_id), count in increments.items():
+        question_deltas[question_id][choice_id] = count
+        logged_counts[choice_id] = count
+    #live viewers read their first results under the same lock (see live.py)
+    with hub.write_lock:
+        #read before the transaction, so it starts with a write: sqlite can't wait for the
+        #write lock in a transaction that has read an older snapshot and fails at once with
+        #"database is locked" in WAL mode. A question resharded meanwhile keeps its votes,
+        #rollup_vote_shards() moves the shards of any question.
+        vote_shards = get_vote_shards(question_deltas)
+        choice_counts = {}
+        question_counts = defaultdict(int)
+        shard_counts = {}
+        choice_shards = {}
+        for (question_id, choice_id), count in increments.items():
+            if question_id in vote_shards:
+                shard_counts[choice_id] = count
+                choice_shards[choice_id] = vote_shards[question_id]
+            else:
+                choice_counts[choice_id] = count
+                question_counts[question_id] += count
+        with transaction.atomic():
+            increment(Choice, 'votes', choice_counts)
+            increment(Question, 'total_votes', question_counts)
+            increment_shards(shard_counts, choice_shards)
+            log_votes(logged_counts)
+        invalidate_question(*question_deltas)
+        for question_id, deltas in question_deltas.items():
+            hub.publish(question_id, deltas)
+
+
+class VoteBuffer:
+
+    def __init__(self, flush_every=1, flush_interval_ms=0, lock_retries=5, lock_retry_delay_ms=10):
+        self.flush_every = max(int(flush_every or 1), 1)
+        self.flush_interval = (flush_interval_ms or 0) / 1000
+        self.lock_retries = lock_retries
+        self.lock_retry_delay = lock_retry_delay_ms / 1000
+        self._lock = threading.Lock()
+        self._flush_lock = threading.Lock()
+        self._pending = defaultdict(int)
+        self._pending_count = 0
+        self._timer = None
+        #counters
+        self.votes_buffered = 0
+        self.votes_flushed = 0
+        self.flushes = 0
+        self.last_batch_size = 0
+        self.max_batch_size = 0
+        self.flush_time_total = 0.0
+        self.last_flush_time = 0.0
+        self.lock_retries_done = 0
+
+    def add(self, question_id, choice_id, count=1):
+        """
+        Buffer votes for a choice. Flushes synchronously when the size threshold is reached.
+        """
+        with self._lock:
+            self._pending[(question_id, choice_id)] += count
+            self._pending_count += count
+            self.votes_buffered += count
+            flush_now = self._pending_count >= self.flush_every
+            if not flush_now and self.flush_interval and self._timer is None:
+                self._timer = threading.Timer(self.flush_interval, self._timed_flush)
+                self._timer.daemon = True
+                self._timer.start()
+        if flush_now:
+            self.flush()
+
+    def _timed_flush(self):
+        #runs in the timer thread, which has its own db connection
+        try:
+            self.flush()
+        finally:
+            connection.close()
+
+    def flush(self):
+        """
+        Write all pending votes, returns the number of votes written.
+        """
+        with self._flush_lock:
+            with self._lock:
+                if self._timer is not None:
+                    self._timer.cancel()
+                    self._timer = None
+                batch, self._pending = self._pending, defaultdict(int)
+                batch_size, self._pending_count = self._pending_count, 0
+            if not batch:
+                return 0
+            start = time.perf_counter()
+            try:
+                retry_on_lock(
+                    lambda: apply_vote_increments(batch),
+                    self.lock_retries, self.lock_retry_delay, on_retry=self._count_retry,
+                )
+            except Exception:
+                #put the votes back so they aren't lost
+                with self._lock:
+                    for key, count in batch.items():
+                        self._pending[key] += count
+                    self._pending_count += batch_size
+                raise
+            elapsed = time.perf_counter() - start
+            with self._lock:
+                self.flushes += 1
+                self.votes_flushed += batch_size
+                self.last_batch_size = batch_size
+                self.max_batch_size = max(self.max_batch_size, batch_size)
+                self.flush_time_total += elapsed
+                self.last_flush_time = elapsed
+            return batch_size
+
+    def _count_retry(self):
+        with self._lock:
+            self.lock_retries_done += 1
+
+    @property
+    def pending(self):
+        return self._pending_count
+
+    def stats(self):
+        with self._lock:
+            return {
+                'pending': self._pending_count,
+                'votes_buffered': self.votes_buffered,
+                'votes_flushed': self.votes_flushed,
+                'flushes': self.flushes,
+                'last_batch_size': self.last_batch_size,
+                'max_batch_size': self.max_batch_size,
+                'avg_batch_size': self.votes_flushed / self.flushes if self.flushes else 0,
+                'last_flush_ms': self.last_flush_time * 1000,
+                'avg_flush_ms': self.flush_time_total * 1000 / self.flushes if self.flushes else 0,
+                'lock_retries': self.lock_retries_done,
+            }
+
+
+_buffer = None
+_buffer_lock = threading.Lock()
+
+
+def vote_buffer_settings():
+    return {**DEFAULTS, **getattr(settings, 'POLLS_VOTE_BUFFER', {})}
+
+
+def get_vote_buffer():
+    """
+    Return the process wide vote buffer, configured from settings.POLLS_VOTE_BUFFER
+    """
+    global _buffer
+    if _buffer is None:
+        with _buffer_lock:
+            if _buffer is None:
+                options = vote_buffer_settings()
+                _buffer = VoteBuffer(
+                    flush_every=options['FLUSH_EVERY'],
+                    flush_interval_ms=options['FLUSH_INTERVAL_MS'],
+                    lock_retries=options['LOCK_RETRIES'],
+                    lock_retry_delay_ms=options['LOCK_RETRY_DELAY_MS'],
+                )
+    return _buffer
+
+
+def buffer_stats():
+    return get_vote_buffer().stats()
+
+
+@receiver(setting_changed)
+def reset_vote_buffer(setting, **kwargs):
+    #rebuild the buffer when the setting is overridden (tests)
+    global _buffer
+    if setting == 'POLLS_VOTE_BUFFER':
+        if _buffer is not None:
+            _buffer.flush()
+        _buffer = None
+
+
+@atexit.register
+def _flush_on_exit():
+    if _buffer is not None and _buffer.pending:
+        try:
+            _buffer.flush()
+        except Exception:
+            pass